@@ -1,57 +1,222 @@
-from flask import Flask, request
+import os
+import orjson
+import log
+import metrics
+from flask import Blueprint, Flask, Response, current_app, request, abort, stream_with_context
+from werkzeug.local import LocalProxy
 from energymanager import EnergyManager
+from fleet import Fleet, DEVICES
 
 version = "0.1.0"
 
-energyManager = EnergyManager()
+log.setup()
 
-app = Flask(__name__)
+api = Blueprint("api", __name__)
 
-@app.route('/api')
+# Site served by the app handling the current request
+energyManager = LocalProxy(lambda: current_app.extensions["energy_manager"])
+
+
+def create_app(energy_manager=None, fleet=None):
+    """
+    Creates the app serving energy_manager and an optional fleet.
+
+    Without a site, as under `flask run`, a live one is started from the
+    environment.
+    """
+    if energy_manager is None:
+        # TIME_SCALE runs the simulation clock faster than wall time, e.g. 60 for a minute per second.
+        # CHARGE_POINTS adds an EV charging station with that many points.
+        energy_manager = EnergyManager(time_scale=float(os.environ.get("TIME_SCALE", 1)),
+                                       charge_points=int(os.environ.get("CHARGE_POINTS", 0)))
+        # Optional fleet of headless sites, configured by a JSON file with the site list
+        if os.environ.get("FLEET_CONFIG"):
+            fleet = Fleet.from_config(os.environ["FLEET_CONFIG"])
+    app = Flask(__name__)
+    app.extensions["energy_manager"] = energy_manager
+    app.extensions["fleet"] = fleet
+    app.register_blueprint(api)
+    return app
+
+@api.route('/api')
 def api_index():
     return {"version": version}
 
-@app.route('/api/load', methods=['GET'])
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not metrics.enabled:
+        abort(404)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@api.route('/api/state', methods=['GET'])
+def get_state():
+    etag, body = energyManager.get_snapshot()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+@api.route('/api/clock', methods=['GET'])
+def get_clock():
+    scheduler = energyManager.scheduler
+    return {"time": energyManager.sim_time, "time_scale": scheduler.time_scale,
+            "tick_interval": scheduler.tick_interval}
+
+@api.route('/api/clock', methods=['POST'])
+def set_clock():
+    try:
+        energyManager.scheduler.set_time_scale(float(request.json["time_scale"]))
+    except (KeyError, TypeError, ValueError) as e:
+        return {"error": f"Invalid time scale: {e}"}, 400
+    return {"status": "success"}
+
+@api.route('/api/history', methods=['GET'])
+def get_history():
+    history = energyManager.history
+    if history is None:
+        abort(404)
+    signals = request.args.get('signals')
+    signals = signals.split(',') if signals else history.signals
+    end = request.args.get('to', energyManager.sim_time, type=float)
+    start = request.args.get('from', end - 3600, type=float)
+    # Default to about 1000 points over the requested range
+    step = request.args.get('step', max(1, (end - start) / 1000), type=float)
+    try:
+        result = history.query(signals, start, end, step)
+    except KeyError as e:
+        return {"error": f"Unknown signal {e}"}, 400
+    # Thousands of floats, orjson encodes them an order of magnitude faster than Flask's encoder
+    return Response(orjson.dumps(result), mimetype='application/json')
+
+@api.route('/api/stream', methods=['GET'])
+def get_stream():
+    return Response(stream_with_context(energyManager.stream.subscribe()), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@api.route('/api/load', methods=['GET'])
 def get_load():
     return energyManager.load.to_json()
 
-@app.route('/api/load', methods=['POST'])
+@api.route('/api/load', methods=['POST'])
 def set_load():
-    energyManager.load.update_from_json(request.json)
+    if not energyManager.update_device("load", request.json):
+        return {"error": "Invalid load settings"}, 400
     return {"status": "success"}
 
-@app.route('/api/powermeter', methods=['GET'])
+@api.route('/api/powermeter', methods=['GET'])
 def get_powermeter():
     return energyManager.power_meter.to_json()
 
-@app.route('/api/powermeter', methods=['POST'])
+@api.route('/api/powermeter', methods=['POST'])
 def set_powermeter():
-    energyManager.power_meter.update_from_json(request.json)
+    if not energyManager.update_device("power_meter", request.json):
+        return {"error": "Invalid power meter settings"}, 400
     return {"status": "success"}
 
-@app.route('/api/solar', methods=['GET'])
+@api.route('/api/solar', methods=['GET'])
 def get_solar():
     return energyManager.solar_panel.to_json()
 
-@app.route('/api/solar', methods=['POST'])
+@api.route('/api/solar', methods=['POST'])
 def set_solar():
-    energyManager.solar_panel.update_from_json(request.json)
+    if not energyManager.update_device("solar_panel", request.json):
+        return {"error": "Invalid solar panel settings"}, 400
     return {"status": "success"}
 
-@app.route('/api/battery', methods=['GET'])
+@api.route('/api/battery', methods=['GET'])
 def get_battery():
     return energyManager.battery.to_json()
 
-@app.route('/api/battery', methods=['POST'])
+@api.route('/api/battery', methods=['POST'])
 def set_battery():
-    energyManager.battery.update_from_json(request.json)
+    if not energyManager.update_device("battery", request.json):
+        return {"error": "Invalid battery settings"}, 400
     return {"status": "success"}
 
-@app.route('/api/inverter', methods=['GET'])
+@api.route('/api/inverter', methods=['GET'])
 def get_inverter():
     return energyManager.inverter.to_json()
 
-@app.route('/api/inverter', methods=['POST'])
+@api.route('/api/inverter', methods=['POST'])
 def set_inverter():
-    energyManager.inverter.update_from_json(request.json)
-    return {"status": "success"}
\ No newline at end of file
+    if not energyManager.update_device("inverter", request.json):
+        return {"error": "Invalid inverter settings"}, 400
+    return {"status": "success"}
+
+@api.route('/api/inverter/schedule', methods=['GET'])
+def get_inverter_schedule():
+    """Planned battery power and energy per slot of the Optimized mode, from the current state of charge."""
+    dispatch = energyManager.inverter.optimizer
+    times = dispatch.times if dispatch is not None else None
+    if times is None:
+        abort(404)
+    power, energy = dispatch.schedule(energyManager.battery.state_of_charge)
+    return {
+        "times": times.tolist(),
+        "battery_power": power.tolist(),
+        "battery_energy": energy.tolist(),
+        **dispatch.to_dict(),
+    }
+
+@api.route('/api/charging', methods=['GET'])
+def get_charging():
+    if energyManager.charging_station is None:
+        abort(404)
+    return energyManager.charging_station.to_json()
+
+@api.route('/api/charging', methods=['POST'])
+def set_charging():
+    if energyManager.charging_station is None:
+        abort(404)
+    if not energyManager.update_device("charging_station", request.json):
+        return {"error": "Invalid charging station settings"}, 400
+    return {"status": "success"}
+
+@api.route('/api/loadbalancer', methods=['GET'])
+def get_loadbalancer():
+    return energyManager.load_balancer.to_json()
+
+@api.route('/api/loadbalancer', methods=['POST'])
+def set_loadbalancer():
+    if not energyManager.update_device("load_balancer", request.json):
+        return {"error": "Invalid load balancer settings"}, 400
+    return {"status": "success"}
+
+def get_fleet():
+    fleet = current_app.extensions["fleet"]
+    if fleet is None:
+        abort(404)
+    return fleet
+
+@api.route('/api/fleet', methods=['GET'])
+def get_fleet_totals():
+    return get_fleet().totals().to_json()
+
+@api.route('/api/sites', methods=['GET'])
+def get_sites():
+    return {"sites": get_fleet().site_ids()}
+
+@api.route('/api/sites/<site_id>/<device>', methods=['GET'])
+def get_site_device(site_id, device):
+    if device not in DEVICES:
+        abort(404)
+    data = get_fleet().get(site_id, device)
+    if data is None:
+        abort(404)
+    if isinstance(data, dict):
+        return data, 503
+    return data
+
+@api.route('/api/sites/<site_id>/<device>', methods=['POST'])
+def set_site_device(site_id, device):
+    if device not in DEVICES:
+        abort(404)
+    result = get_fleet().update(site_id, device, request.json)
+    if result is None:
+        abort(404)
+    if result is not True:
+        return result, 503 if result.get("unavailable") else 400
+    return {"status": "success"}
@@ -0,0 +1,161 @@
+import numpy as np
+import pandas as pd
+from inverter import SolarUseMode, BatteryUseMode
+import optimizer
+from irradiance import to_seconds
+
+# Initial window (samples) scanned for the battery swinging between full and empty
+WINDOW = 4096
+
+
+def time_steps(seconds):
+    """
+    Returns the step length (s) that ends at each sample, like a tick of the
+    live scheduler. The first sample reuses the length of the second one.
+    """
+    dt = np.empty_like(seconds)
+    if len(seconds) > 1:
+        dt[1:] = np.diff(seconds)
+        dt[0] = dt[1]
+    elif len(seconds) == 1:
+        dt[0] = 0
+    return dt
+
+
+def bounded_cumsum(delta, start, lower, upper):
+    """
+    Computes level[i] = clip(level[i-1] + delta[i], lower, upper) without a
+    Python loop per sample.
+
+    A level clipped at one bound only is a cumulative sum minus its running
+    extreme past that bound (the Skorokhod reflection), which NumPy computes
+    with an accumulate. The level is reflected at the bound it touched last
+    until it crosses the opposite one, so the loop only runs once per
+    full/empty swing of the battery, not once per sample.
+    """
+    n = len(delta)
+    level = np.empty(n, dtype=np.float64)
+    i = 0
+    current = float(start)
+    at_upper = False
+    window = WINDOW
+    while i < n:
+        stop = min(n, i + window)
+        path = current + np.cumsum(delta[i:stop])
+        if at_upper:
+            path -= np.maximum(np.maximum.accumulate(path - upper), 0)
+            outside = path < lower
+        else:
+            path -= np.minimum(np.minimum.accumulate(path - lower), 0)
+            outside = path > upper
+        k = outside.argmax()
+        if not outside[k]:
+            level[i:stop] = path
+            current = path[-1]
+            i = stop
+            window *= 2
+            continue
+        level[i:i + k] = path[:k]
+        current = lower if at_upper else upper
+        level[i + k] = current
+        i += k + 1
+        at_upper = not at_upper
+        window = WINDOW
+    return level
+
+
+def optimized_power(seconds, dt, net_power, battery, tariff=optimizer.DEFAULT_TARIFF):
+    """
+    Battery power per sample of a schedule optimized with perfect foresight:
+    the whole run is one horizon and the forecast of each slot is the
+    time-weighted mean of its samples.
+
+    Args:
+        seconds: Epoch seconds per sample
+        dt: Step length (s) per sample
+        net_power: Load minus PV power per sample (W)
+        battery: Battery providing capacity, limits and initial state of charge
+        tariff: optimizer.Tariff
+
+    Returns:
+        Requested battery power per sample (W, positive when charging)
+    """
+    dispatch = optimizer.DispatchOptimizer()
+    start = seconds[0] - seconds[0] % dispatch.slot
+    index = ((seconds - start) // dispatch.slot).astype(np.int64)
+    count = int(index[-1]) + 1
+    duration = np.bincount(index, dt, count)
+    net = np.bincount(index, net_power * dt, count) / np.where(duration > 0, duration, 1)
+    times = start + np.arange(count) * float(dispatch.slot)
+    import_price, export_price = tariff.prices(times + dispatch.slot / 2)
+    dispatch.solve(times, net, import_price, export_price, battery.capacity,
+                   battery.max_charge_current * battery.volts, battery.max_discharge_current * battery.volts)
+    power, _ = dispatch.schedule(battery.state_of_charge)
+    return power[index]
+
+
+def simulate(times, ghi, temperature, load_power, solar_panel, battery,
+             solar_use_mode=SolarUseMode.SelfUse, battery_use_mode=BatteryUseMode.Stop, tariff=None):
+    """
+    Simulates a site over a whole time axis at once.
+
+    Args:
+        times: Time axis (datetime64 / DatetimeIndex or seconds)
+        ghi: Global Horizontal Irradiance per sample (W/m²)
+        temperature: Temperature per sample (°C)
+        load_power: Household consumption per sample (W)
+        solar_panel: SolarPanel providing the PV parameters and orientations
+        battery: Battery providing capacity, limits and initial state of charge
+        solar_use_mode: Inverter dispatch mode
+        battery_use_mode: Battery mode used when solar_use_mode is Manual
+        tariff: optimizer.Tariff of the Optimized mode, the default tariff if None
+
+    Returns:
+        DataFrame indexed by times with one row per sample. Powers are in W
+        (battery_power positive when charging, grid_power positive when
+        importing), energies in Wh.
+    """
+    seconds = to_seconds(times)
+    n = len(seconds)
+    dt = time_steps(seconds)
+    ghi = np.broadcast_to(np.asarray(ghi, dtype=np.float64), (n,))
+    temperature = np.broadcast_to(np.asarray(temperature, dtype=np.float64), (n,))
+    load_power = np.broadcast_to(np.asarray(load_power, dtype=np.float64), (n,))
+
+    solar_power = solar_panel.calculate_pv_power(solar_panel.plane_of_array(ghi, seconds), temperature)
+
+    volts = battery.volts
+    max_charge_power = battery.max_charge_current * volts
+    max_discharge_power = battery.max_discharge_current * volts
+    if solar_use_mode == SolarUseMode.SelfUse:
+        requested = np.clip(solar_power - load_power, -max_discharge_power, max_charge_power)
+    elif solar_use_mode == SolarUseMode.Backup:
+        requested = np.zeros(n)
+    elif solar_use_mode == SolarUseMode.Optimized:
+        requested = optimized_power(seconds, dt, load_power - solar_power, battery, tariff or optimizer.DEFAULT_TARIFF)
+    elif battery_use_mode == BatteryUseMode.Charge:
+        requested = np.full(n, float(max_charge_power))
+    elif battery_use_mode == BatteryUseMode.Discharge:
+        requested = np.full(n, -float(max_discharge_power))
+    else:
+        requested = np.zeros(n)
+
+    # The battery can only exchange what fits between empty and full
+    energy = bounded_cumsum(requested * dt / 3600, battery.state_of_charge, 0, battery.capacity)
+    exchanged = np.diff(energy, prepend=battery.state_of_charge)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        battery_power = np.where(dt > 0, exchanged * 3600 / dt, 0)
+
+    frame = pd.DataFrame({
+        "solar_power": solar_power,
+        "load_power": load_power,
+        "battery_power": battery_power,
+        "battery_current": battery_power / volts,
+        "battery_energy": energy,
+        "state_of_charge": energy * 100 / battery.capacity,
+        "grid_power": load_power - solar_power + battery_power,
+        "solar_energy": np.cumsum(solar_power * dt / 3600),
+        "feed_in": battery.feed_in + np.cumsum(np.maximum(exchanged, 0)),
+        "feed_out": battery.feed_out + np.cumsum(np.maximum(-exchanged, 0)),
+    }, index=pd.Index(times))
+    return frame
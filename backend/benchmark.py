@@ -0,0 +1,242 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import time
+from datetime import datetime, timezone
+import numpy as np
+
+# Offline and reproducible: every source of weather is the clear-sky model
+os.environ.setdefault("IRRADIANCE_SOURCE", "clearsky")
+
+import batch
+import scenario
+from energymanager import EnergyManager
+from irradiance import ClearSkySource
+from scheduler import Scheduler
+
+SEED = 1
+START_TIME = 1718942400.0  # 2024-06-21 04:00 UTC
+BENCHMARK_PORT = 5120
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks")
+
+
+def timeit(func, number=1000, repeat=5):
+    """Runs func number times per round; reports the best and median round."""
+    rounds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        rounds.append((time.perf_counter() - start) / number)
+    best = min(rounds)
+    return {
+        "ops_per_s": round(1 / best, 1),
+        "best_us": round(best * 1e6, 3),
+        "median_us": round(float(np.median(rounds)) * 1e6, 3),
+    }
+
+
+def latency(samples):
+    samples = np.asarray(samples) * 1e6
+    return {
+        "requests": len(samples),
+        "p50_us": round(float(np.percentile(samples, 50)), 1),
+        "p90_us": round(float(np.percentile(samples, 90)), 1),
+        "p99_us": round(float(np.percentile(samples, 99)), 1),
+        "max_us": round(float(samples.max()), 1),
+    }
+
+
+def create_site(servers=False, history=True):
+    energy_manager = EnergyManager(scheduler=Scheduler(), start_time=START_TIME, seed=SEED,
+                                   irradiance_source=ClearSkySource(), servers=servers,
+                                   history=history, autostart=False)
+    # Run into the morning so every device has a non-trivial state
+    energy_manager.scheduler.run(3 * 3600)
+    return energy_manager
+
+
+def bench_modbus_context(quick):
+    from inverter import Inverter
+    site = create_site()
+    inverter = Inverter(site.solar_panel, site.battery, site.power_meter, modbus_port=BENCHMARK_PORT)
+    try:
+        return timeit(inverter.update_modbus_context, 200 if quick else 2000)
+    finally:
+        inverter.modbus.stop_modbus_server()
+
+
+def bench_p1_telegram(quick):
+    from p1 import crc16
+    site = create_site()
+    telegram = site.power_meter.get_p1_data_1()
+    return {
+        "telegram": timeit(site.power_meter.get_p1_data_1, 1000 if quick else 10000),
+        "crc16": timeit(lambda: crc16(telegram), 1000 if quick else 10000),
+    }
+
+
+def bench_to_json(quick):
+    site = create_site()
+    results = {name: timeit(getattr(site, attribute).to_json, 1000 if quick else 10000)
+               for name, attribute in (("load", "load"), ("powermeter", "power_meter"), ("solar", "solar_panel"),
+                                       ("battery", "battery"), ("inverter", "inverter"))}
+    results["state"] = timeit(lambda: (site.get_snapshot(), setattr(site, "snapshot", None)), 200 if quick else 2000)
+    return results
+
+
+def bench_flask(quick):
+    from app import create_app
+    client = create_app(create_site()).test_client()
+    number = 200 if quick else 2000
+    results = {}
+    for path in ("/api", "/api/state", "/api/load", "/api/powermeter", "/api/solar", "/api/battery",
+                 "/api/inverter", "/api/history"):
+        results[path] = timeit(lambda: client.get(path), number, 3)
+    etag = client.get("/api/state").headers["ETag"]
+    results["/api/state (304)"] = timeit(lambda: client.get("/api/state", headers={"If-None-Match": etag}), number, 3)
+    results["/api/load (POST)"] = timeit(
+        lambda: client.post("/api/load", json={"phase1": {"load_limit_max": 10}}), number, 3)
+    return results
+
+
+async def poll_modbus(port, clients, requests):
+    from pymodbus.client import AsyncModbusTcpClient
+
+    async def client_loop(client):
+        samples = []
+        for _ in range(requests):
+            start = time.perf_counter()
+            await client.read_input_registers(0, 100, slave=1)
+            samples.append(time.perf_counter() - start)
+        return samples
+
+    connections = [AsyncModbusTcpClient("127.0.0.1", port=port) for _ in range(clients)]
+    for client in connections:
+        await client.connect()
+    try:
+        results = await asyncio.gather(*(client_loop(client) for client in connections))
+    finally:
+        for client in connections:
+            client.close()
+    return [sample for samples in results for sample in samples]
+
+
+def bench_modbus_latency(quick):
+    from inverter import Inverter
+    site = create_site()
+    inverter = Inverter(site.solar_panel, site.battery, site.power_meter, modbus_port=BENCHMARK_PORT + 1)
+    inverter.update_modbus_context()
+    time.sleep(0.5)
+    try:
+        results = {}
+        for clients in (1, 8, 32) if quick else (1, 8, 32, 128):
+            results[f"{clients} clients"] = latency(
+                asyncio.run(poll_modbus(BENCHMARK_PORT + 1, clients, 50 if quick else 200)))
+        return results
+    finally:
+        inverter.modbus.stop_modbus_server()
+
+
+def bench_simulation(quick):
+    site = create_site()
+    ticks = 2000 if quick else 20000
+    start = time.perf_counter()
+    site.scheduler.run(ticks)
+    live = ticks / (time.perf_counter() - start)
+
+    samples = (30 if quick else 365) * 1440
+    seconds = START_TIME + np.arange(samples) * 60.0
+    ghi, temperature = ClearSkySource().series(52.52, 13.41, seconds)
+    load_power = scenario.trace_power(scenario.generate_traces("household", 1, START_TIME, samples, 60, seed=SEED))[0]
+    start = time.perf_counter()
+    batch.simulate(seconds, ghi, temperature, load_power, site.solar_panel, site.battery)
+    return {
+        "live_ticks_per_s": round(live, 1),
+        "batch_ticks_per_s": round(samples / (time.perf_counter() - start), 1),
+    }
+
+
+BENCHMARKS = {
+    "modbus_context": bench_modbus_context,
+    "p1_telegram": bench_p1_telegram,
+    "to_json": bench_to_json,
+    "flask": bench_flask,
+    "modbus_latency": bench_modbus_latency,
+    "simulation": bench_simulation,
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def flatten(results, prefix=""):
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{prefix}{key}."))
+        else:
+            values[f"{prefix}{key}"] = value
+    return values
+
+
+def compare(results, baseline):
+    """Prints every metric next to the baseline run with its relative change."""
+    current = flatten(results["results"])
+    previous = flatten(baseline["results"])
+    print(f"Compared with {baseline.get('commit')} ({baseline.get('time')}):")
+    for key, value in current.items():
+        if key in previous and previous[key]:
+            change = (value - previous[key]) * 100 / previous[key]
+            print(f"  {key}: {previous[key]} -> {value} ({change:+.1f}%)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the simulator's hot paths")
+    parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK",
+                        help=f"Benchmarks to run, all if omitted: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--quick", action="store_true", help="Fewer iterations, for a smoke test")
+    parser.add_argument("--output", help="JSON result file (default: benchmarks/<time>-<commit>.json)")
+    parser.add_argument("--compare", help="Earlier JSON result to compare with")
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}")
+
+    results = {
+        "commit": git_commit(),
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "quick": args.quick,
+        "results": {},
+    }
+    for name in args.benchmarks or BENCHMARKS:
+        print(f"Running {name}")
+        results["results"][name] = BENCHMARKS[name](args.quick)
+        print(json.dumps(results["results"][name], indent=2))
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{results['commit'] or 'unknown'}.json")
+    with open(output, "w") as result_file:
+        json.dump(results, result_file, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(results, json.load(baseline_file))
+
+
+if __name__ == "__main__":
+    main()
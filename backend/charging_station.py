@@ -1,39 +1,301 @@
+from device import Device
+import numpy as np
+import orjson
+import log
+
+logger = log.get_logger("charging")
+
+PHASES = ("phase1", "phase2", "phase3")
+
+# Vehicle types of arriving vehicles: (battery capacity kWh, max charging current A, phases)
+VEHICLES = np.array([
+    (40, 32, 1),
+    (58, 16, 3),
+    (77, 16, 3),
+    (100, 32, 3),
+])
+# Above this state of charge the charging current tapers linearly to zero at full
+TAPER_SOC = 0.8
+# Share of the drawn energy that ends up in the vehicle battery
+CHARGING_EFFICIENCY = 0.9
+# Load balancing priority of a charge point, higher is served first
+DEFAULT_PRIORITY = 1
+# State of charge (%) of a vehicle plugged in without its charge
+DEFAULT_SOC = 20
+
 
 class VehicleBattery:
-    def __init__(self, max_capacity=100, current_capacity=100):
+    """Battery of a vehicle, capacities in kWh. The charge defaults to DEFAULT_SOC."""
+
+    __slots__ = ("max_capacity", "current_capacity")
+
+    def __init__(self, max_capacity=100, current_capacity=None):
         self.max_capacity = max_capacity
-        self.current_capacity = current_capacity
+        self.current_capacity = max_capacity * DEFAULT_SOC / 100 if current_capacity is None else current_capacity
 
-    def to_json(self):
-        return json.dumps({
+    def to_dict(self):
+        return {
             'max_capacity': self.max_capacity,
             'current_capacity': self.current_capacity
-        })
-    
+        }
+
+    def to_json(self):
+        return orjson.dumps(self.to_dict()).decode()
+
     def update_from_json(self, data):
         if 'max_capacity' in data:
             self.max_capacity = data['max_capacity']
         if 'current_capacity' in data:
             self.current_capacity = data['current_capacity']
+        elif 'state_of_charge' in data:
+            if not 0 <= data['state_of_charge'] <= 100:
+                raise ValueError(f"state of charge {data['state_of_charge']} is not within 0-100 %")
+            self.current_capacity = self.max_capacity * data['state_of_charge'] / 100
+
+
+class ChargingStation(Device):
+    """
+    EV charging station with any number of charge points.
+
+    The state of the points and of the plugged-in vehicles is kept in arrays
+    with one row per point, so a tick updates every session at once whatever
+    the size of the depot. A vehicle draws the same current on each of its
+    phases: the smallest of the per-phase setpoints (A) of its point, the
+    rating of the point, the limit of its on-board charger and the allowance
+    of a load balancer, tapering off above TAPER_SOC and stopping at its
+    target state of charge.
+
+    With an arrival_rate vehicles arrive at free points at random and leave
+    after an exponentially distributed dwell time. Single phase vehicles
+    charge on the first phase of their point; points are rotated over the
+    phases so those spread evenly.
+    """
 
-class ChargingStation:
-    def __init__(self):
-        self.max_num_charging_points = 2
+    __slots__ = ("voltage", "max_current", "setpoint", "phase_mask", "current", "occupied", "capacity", "energy",
+                 "target", "departure", "vehicle_current", "session_energy", "delivered_energy", "sessions",
+                 "arrival_rate", "dwell_time", "rng", "power", "phase_current", "allowance", "priority", "active")
+
+    def __init__(self, charge_points=2, max_current=16, voltage=230, arrival_rate=0, dwell_time=4, seed=None):
+        """
+        Args:
+            charge_points: Number of charge points
+            max_current: Rating of each point (A per phase)
+            voltage: Phase voltage (V)
+            arrival_rate: Vehicles arriving per free point and hour
+            dwell_time: Mean time a vehicle stays plugged in (h)
+            seed: Seed of the arrivals
+        """
+        self.voltage = np.full(3, float(voltage))
+        self.arrival_rate = arrival_rate
+        self.dwell_time = dwell_time
+        self.rng = np.random.default_rng(seed)
+        self.delivered_energy = 0.0
+        self.sessions = 0
+        self.power = 0.0
+        self.phase_current = np.zeros(3)
+        # Number of occupied points, kept so an idle station costs nothing per tick
+        self.active = 0
+        self.resize(charge_points, max_current)
+
+    def resize(self, charge_points, max_current=16):
+        """Sets the number of charge points. Existing points keep their state, new points are free."""
+        arrays = {
+            "max_current": np.full(charge_points, float(max_current)),
+            "setpoint": np.full((charge_points, 3), float(max_current)),
+            "phase_mask": np.zeros((charge_points, 3), dtype=bool),
+            "current": np.zeros((charge_points, 3)),
+            "occupied": np.zeros(charge_points, dtype=bool),
+            "capacity": np.zeros(charge_points),
+            "energy": np.zeros(charge_points),
+            "target": np.zeros(charge_points),
+            "departure": np.full(charge_points, np.inf),
+            "vehicle_current": np.zeros(charge_points),
+            "session_energy": np.zeros(charge_points),
+            # Current granted by a load balancer (A per phase) and the priority it serves the point with
+            "allowance": np.full(charge_points, np.inf),
+            "priority": np.full(charge_points, DEFAULT_PRIORITY, dtype=np.int64),
+        }
+        kept = min(charge_points, len(self.occupied)) if hasattr(self, "occupied") else 0
+        for name, array in arrays.items():
+            if kept:
+                array[:kept] = getattr(self, name)[:kept]
+            setattr(self, name, array)
+        self.active = int(np.count_nonzero(self.occupied))
+
+    def get_power(self):
+        return self.power
+
+    def phase_currents(self):
+        """Total current per phase (A) of all charge points."""
+        return self.phase_current
+
+    def demand(self):
+        """Current (A per phase) each point would draw without an allowance, 0 for free points."""
+        soc = self.energy / np.where(self.occupied, self.capacity, 1)
+        taper = np.clip((1 - soc) / (1 - TAPER_SOC), 0, 1) * (soc < self.target)
+        setpoint = np.where(self.phase_mask, self.setpoint, np.inf).min(axis=1)
+        return np.maximum(np.minimum(setpoint, np.minimum(self.max_current, self.vehicle_current)), 0) * taper
+
+    def update(self, now, dt):
+        if self.arrival_rate > 0:
+            self.arrive(now, dt)
+        if not self.active:
+            if self.power:
+                self.power = 0.0
+                self.phase_current[:] = 0
+            return
+        leaving = self.occupied & (self.departure <= now)
+        if leaving.any():
+            self.unplug(leaving)
+        np.multiply(np.minimum(self.demand(), self.allowance)[:, None], self.phase_mask, out=self.current)
+        self.current.sum(axis=0, out=self.phase_current)
+        power = self.current @ self.voltage
+        self.power = float(power.sum())
+        energy = power * dt / 3600000
+        self.session_energy += energy
+        self.delivered_energy += float(energy.sum())
+        np.minimum(self.energy + energy * CHARGING_EFFICIENCY, self.capacity, out=self.energy)
+
+    def arrive(self, now, dt):
+        free = np.flatnonzero(~self.occupied)
+        if not len(free):
+            return
+        points = free[self.rng.random(len(free)) < self.arrival_rate * dt / 3600]
+        count = len(points)
+        if not count:
+            return
+        vehicles = VEHICLES[self.rng.integers(0, len(VEHICLES), count)]
+        self.plug(points, vehicles[:, 0], self.rng.uniform(0.1, 0.6, count) * vehicles[:, 0],
+                  self.rng.uniform(0.8, 1, count), now + self.rng.exponential(self.dwell_time * 3600, count),
+                  vehicles[:, 1], vehicles[:, 2])
+        logger.debug("%d vehicles arrived at points %s", count, points.tolist())
+
+    def plug(self, points, capacity, energy, target, departure=np.inf, max_current=16, phases=3):
+        """
+        Starts charging sessions at the given points.
+
+        Args:
+            points: Index or array of indices of the charge points
+            capacity: Battery capacity of the vehicles (kWh)
+            energy: Energy in the vehicle batteries (kWh)
+            target: State of charge (0-1) at which charging stops
+            departure: Simulation time the vehicles leave, inf to stay
+            max_current: Limit of the on-board chargers (A per phase)
+            phases: Number of phases the vehicles charge on
+        """
+        points = np.atleast_1d(points)
+        self.occupied[points] = True
+        self.capacity[points] = capacity
+        self.energy[points] = np.minimum(energy, capacity)
+        self.target[points] = target
+        self.departure[points] = departure
+        self.vehicle_current[points] = max_current
+        self.session_energy[points] = 0
+        self.active = int(np.count_nonzero(self.occupied))
+        offsets = (np.arange(3) - points[:, None]) % 3
+        self.phase_mask[points] = offsets < np.broadcast_to(phases, points.shape)[:, None]
+
+    def unplug(self, points):
+        """Ends the sessions at the given points (indices or a boolean mask)."""
+        self.sessions += int(np.count_nonzero(self.occupied[points]))
+        self.occupied[points] = False
+        self.active = int(np.count_nonzero(self.occupied))
+        self.phase_mask[points] = False
+        self.current[points] = 0
+        self.target[points] = 0
+        self.departure[points] = np.inf
+        self.vehicle_current[points] = 0
+
+    def to_dict(self):
+        currents = self.phase_currents().tolist()
+        voltage = self.voltage.tolist()
+        data = {
+            "charge_points": len(self.occupied),
+            "power": round(self.get_power(), 3),
+            "delivered_energy": round(self.delivered_energy, 3),
+            "sessions": self.sessions,
+            "arrival_rate": self.arrival_rate,
+            "dwell_time": self.dwell_time,
+        }
+        for i, phase in enumerate(PHASES):
+            data[phase] = {
+                "current": round(currents[i], 3),
+                "voltage": round(voltage[i], 1),
+            }
+        points = []
+        for occupied, max_current, setpoint, current, capacity, energy, target, departure, vehicle_current, \
+                phases, session_energy, allowance, priority in zip(
+                    self.occupied.tolist(), self.max_current.tolist(), self.setpoint.tolist(), self.current.tolist(),
+                    self.capacity.tolist(), self.energy.tolist(), self.target.tolist(), self.departure.tolist(),
+                    self.vehicle_current.tolist(), self.phase_mask.sum(axis=1).tolist(),
+                    self.session_energy.tolist(), self.allowance.tolist(), self.priority.tolist()):
+            point = {
+                "max_current": max_current,
+                "setpoint": setpoint,
+                "priority": priority,
+                "allowance": allowance if allowance != np.inf else None,
+                "current": [round(value, 3) for value in current],
+                "vehicle": None,
+            }
+            if occupied:
+                point["vehicle"] = {
+                    "max_capacity": capacity,
+                    "current_capacity": round(energy, 3),
+                    "state_of_charge": round(energy * 100 / capacity, 1),
+                    "target": round(target * 100, 1),
+                    "departure": departure if departure != np.inf else None,
+                    "max_current": vehicle_current,
+                    "phases": phases,
+                    "session_energy": round(session_energy, 3),
+                }
+            points.append(point)
+        data["points"] = points
+        return data
 
     def to_json(self):
-        return json.dumps({
-            'charging': self.station_id,
-            'location': self.location,
-            'capacity': self.capacity,
-            'current_load': self.current_load
-        })
-    
+        return orjson.dumps(self.to_dict()).decode()
+
     def update_from_json(self, data):
-        if 'station_id' in data:
-            self.station_id = data['station_id']
-        if 'location' in data:
-            self.location = data['location']
-        if 'capacity' in data:
-            self.capacity = data['capacity']
-        if 'current_load' in data:
-            self.current_load = data['current_load']
\ No newline at end of file
+        try:
+            logger.debug("Updating charging station settings: %s", data)
+            if "charge_points" in data:
+                self.resize(int(data["charge_points"]), self.max_current[0] if len(self.max_current) else 16)
+            if "max_current" in data:
+                # A new rating also resets the setpoints
+                self.max_current[:] = data["max_current"]
+                self.setpoint[:] = self.max_current[:, None]
+            if "setpoint" in data:
+                self.setpoint[:] = data["setpoint"]
+            if "voltage" in data:
+                self.voltage[:] = data["voltage"]
+            if "arrival_rate" in data:
+                self.arrival_rate = data["arrival_rate"]
+            if "dwell_time" in data:
+                self.dwell_time = data["dwell_time"]
+            for index, point_data in data.get("points", {}).items():
+                self.update_point(int(index), point_data)
+        except Exception as e:
+            logger.warning("Invalid charging station settings %s: %s", data, e)
+            return False
+        return True
+
+    def update_point(self, index, data):
+        if index < 0 or index >= len(self.occupied):
+            raise IndexError(f"no charge point {index}")
+        if "max_current" in data:
+            self.max_current[index] = data["max_current"]
+        if "setpoint" in data:
+            self.setpoint[index] = data["setpoint"]
+        if "priority" in data:
+            self.priority[index] = data["priority"]
+        if "vehicle" in data:
+            vehicle_data = data["vehicle"]
+            if vehicle_data is None:
+                self.unplug(index)
+                return
+            vehicle = VehicleBattery(vehicle_data.get("max_capacity", 100))
+            vehicle.update_from_json(vehicle_data)
+            departure = vehicle_data.get("departure")
+            self.plug(index, vehicle.max_capacity, vehicle.current_capacity, vehicle_data.get("target", 100) / 100,
+                      np.inf if departure is None else departure, vehicle_data.get("max_current", 16),
+                      vehicle_data.get("phases", 3))
@@ -1,4 +1,6 @@
 
 class Device:
+    __slots__ = ()
+
     def get_power(self):
         raise NotImplementedError("Subclasses should implement this method")
\ No newline at end of file
@@ -1,11 +1,198 @@
+import orjson
+import threading
+import time
+import uuid
 from smartmeter import PowerMeter
 from load import Load
 from inverter import SolarPanel, Battery, Inverter
+from charging_station import ChargingStation
+from loadbalancer import LoadBalancer
+from scheduler import Scheduler
+from stream import StateStream
+from history import History
+from recorder import Recorder
+import batch
+
+HISTORY_SIGNALS = [
+    "solar_power",
+    "load_power",
+    "load_current_l1",
+    "load_current_l2",
+    "load_current_l3",
+    "battery_current",
+    "battery_power",
+    "state_of_charge",
+    "inverter_power",
+    "grid_power",
+]
+# Recorded only by sites with a charging station
+CHARGING_SIGNALS = ["charging_power"]
 
 class EnergyManager:
-    def __init__(self):
-        self.load = Load()
-        self.power_meter = PowerMeter()
-        self.solar_panel = SolarPanel(latitude=52.52, longitude=13.41)
-        self.battery = Battery(capacity=3000)
-        self.inverter = Inverter(self.solar_panel, self.battery, self.power_meter)
\ No newline at end of file
+    def __init__(self, latitude=52.52, longitude=13.41, battery_capacity=3000, tick_interval=1,
+                 scheduler=None, start_time=None, seed=None, load_profile=None, irradiance_source=None,
+                 servers=True, history=True, autostart=True, time_scale=1, charge_points=0):
+        self.load = Load(seed=seed, profile=load_profile)
+        self.charging_station = ChargingStation(charge_points, seed=seed) if charge_points else None
+        self.power_meter = PowerMeter(serve=servers)
+        self.solar_panel = SolarPanel(latitude=latitude, longitude=longitude, irradiance_source=irradiance_source)
+        self.battery = Battery(capacity=battery_capacity)
+        self.inverter = Inverter(self.solar_panel, self.battery, self.power_meter,
+                                 modbus_port=5020 if servers else None, load=self.load, seed=seed)
+        self.load_balancer = LoadBalancer(self.load, self.power_meter, self.inverter, self.charging_station)
+        self.sim_time = time.time() if start_time is None else start_time
+        self.tick_count = 0
+        self.stream = StateStream(self.read_state)
+        self.instance_id = uuid.uuid4().hex[:8]
+        self.snapshot = None
+        # Held for a tick and while the state is read or changed from other threads
+        self.lock = threading.Lock()
+        # Count of settings changes, part of the snapshot version
+        self.revision = 0
+        signals = HISTORY_SIGNALS if self.charging_station is None else HISTORY_SIGNALS + CHARGING_SIGNALS
+        self.history = History(signals) if history else None
+        self.recorder = None
+        # Index of this site in the sites of a shared recorder
+        self.record_site = 0
+        self.scheduler = scheduler if scheduler is not None else Scheduler(tick_interval, time_scale=time_scale)
+        self.scheduler.add(self)
+        if autostart:
+            self.scheduler.start()
+
+    def tick(self, dt):
+        """
+        Advances every device by dt seconds of simulation time.
+
+        The order matters: the load is drawn and solar generation computed
+        first, so the load balancer can set the limits of the controllable
+        devices for this tick. Then the charging vehicles draw, the inverter
+        dispatches the battery against the load, the battery integrates the
+        dispatched current and the meter sees the resulting grid flow.
+        """
+        with self.lock:
+            self.advance(dt)
+
+    def advance(self, dt):
+        now = self.sim_time + dt
+        self.load.update(now, dt)
+        self.solar_panel.update(now, dt)
+        self.load_balancer.update(now, dt)
+        load_power = self.load.get_power()
+        if self.charging_station is not None:
+            self.charging_station.update(now, dt)
+            load_power += self.charging_station.power
+        self.inverter.update(now, dt, load_power)
+        self.battery.update(now, dt)
+        self.power_meter.update(self.load, self.inverter, now, dt, self.charging_station)
+        self.sim_time = now
+        self.tick_count += 1
+        if self.history is not None:
+            self.record_history()
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.record(self, self.record_site)
+        if self.stream.has_subscribers():
+            self.stream.publish(self.get_state())
+
+    def record_history(self):
+        load_current = self.load.load_current
+        battery = self.battery
+        values = (
+            self.solar_panel.solar_power,
+            self.load.get_power(),
+            load_current[0],
+            load_current[1],
+            load_current[2],
+            battery.current,
+            battery.current * battery.volts,
+            battery.state_of_charge * 100 / battery.capacity,
+            self.inverter.get_power(),
+            self.power_meter.get_power(),
+        )
+        if self.charging_station is not None:
+            values += (self.charging_station.get_power(),)
+        self.history.record(self.sim_time, values)
+
+    def get_state(self):
+        """Returns the state of all devices, keyed like the REST API routes."""
+        state = {
+            "load": self.load.to_dict(),
+            "powermeter": self.power_meter.to_dict(),
+            "solar": self.solar_panel.to_dict(),
+            "battery": self.battery.to_dict(),
+            "inverter": self.inverter.to_dict(),
+            "loadbalancer": self.load_balancer.to_dict(),
+        }
+        if self.charging_station is not None:
+            state["charging"] = self.charging_station.to_dict()
+        return state
+
+    def read_state(self):
+        """get_state() between two ticks, for readers on other threads."""
+        with self.lock:
+            return self.get_state()
+
+    def get_snapshot(self):
+        """
+        Returns (etag, body) of the combined state document.
+
+        The document is serialized at most once per tick and settings change,
+        between two ticks, so it never mixes device states of different
+        ticks. The ETag combines an id of this instance with the tick count
+        and the settings revision, so it changes on every tick, on every
+        update_device() and after a restart.
+        """
+        snapshot = self.snapshot
+        if snapshot is None or snapshot[0] != (self.tick_count, self.revision):
+            with self.lock:
+                version = (self.tick_count, self.revision)
+                snapshot = self.snapshot
+                if snapshot is None or snapshot[0] != version:
+                    body = orjson.dumps({"version": version[0], "time": self.sim_time, **self.get_state()})
+                    snapshot = (version, f"{self.instance_id}-{version[0]}.{version[1]}", body)
+                    self.snapshot = snapshot
+        return snapshot[1], snapshot[2]
+
+    def update_device(self, attribute, data):
+        """
+        Applies settings to a device (an attribute like "battery") between two
+        ticks and invalidates the state snapshot.
+
+        Returns:
+            The result of the device's update_from_json
+        """
+        with self.lock:
+            result = getattr(self, attribute).update_from_json(data)
+            self.revision += 1
+        return result
+
+    def start_recording(self, path, format="parquet"):
+        """Records every following tick to a Parquet or Arrow file until stop_recording()."""
+        self.stop_recording()
+        self.attach_recorder(Recorder(path, format))
+
+    def stop_recording(self):
+        recorder = self.detach_recorder()
+        if recorder is not None:
+            recorder.close()
+
+    def attach_recorder(self, recorder, site=0):
+        """Records every following tick to a Recorder, shared with other sites as rows of site."""
+        with self.lock:
+            self.recorder = recorder
+            self.record_site = site
+
+    def detach_recorder(self):
+        """Stops recording and returns the recorder, which the caller closes."""
+        # Detached between two ticks, the tick thread no longer touches the recorder when it is closed
+        with self.lock:
+            recorder, self.recorder = self.recorder, None
+        return recorder
+
+    def stop(self):
+        self.scheduler.remove(self)
+
+    def simulate_batch(self, times, ghi, temperature, load_power):
+        """Replays a whole time axis offline with this site's devices and current inverter modes."""
+        return batch.simulate(times, ghi, temperature, load_power, self.solar_panel, self.battery,
+                              self.inverter.solar_use_mode, self.inverter.battery_use_mode, self.inverter.tariff)
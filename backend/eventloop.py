@@ -0,0 +1,23 @@
+import asyncio
+import threading
+
+# One asyncio loop per process hosts all the protocol servers
+loop = None
+loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    """Returns the shared event loop, starting its thread on first use."""
+    global loop
+    with loop_lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="protocol-servers")
+            thread.daemon = True
+            thread.start()
+    return loop
+
+
+def submit(coroutine):
+    """Schedules a coroutine on the shared loop and returns its concurrent Future."""
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop())
@@ -0,0 +1,351 @@
+import json
+import orjson
+import multiprocessing
+import os
+import threading
+import queue
+import log
+from energymanager import EnergyManager
+from recorder import Recorder
+from scheduler import Scheduler
+
+logger = log.get_logger("fleet")
+
+# Device names used by the REST API, mapped to EnergyManager attributes
+DEVICES = {
+    "load": "load",
+    "powermeter": "power_meter",
+    "solar": "solar_panel",
+    "battery": "battery",
+    "inverter": "inverter",
+    "charging": "charging_station",
+    "loadbalancer": "load_balancer",
+}
+
+SOC_BINS = 10
+
+# Load samples generated at once per site, kept small so a shard of thousands
+# of sites does not hold an hour of samples for each of them
+LOAD_BLOCK = 60
+
+# Time (s) to wait for a shard to answer a request
+REQUEST_TIMEOUT = 5
+
+
+class FleetTotals:
+    """
+    Running totals over a set of sites.
+
+    Every site reports its own change after each tick, so the totals are kept
+    up to date in O(1) per site without ever walking the whole fleet.
+    """
+
+    def __init__(self):
+        self.sites = 0
+        self.grid_import_power = 0.0
+        self.grid_export_power = 0.0
+        self.grid_import_energy = 0.0
+        self.grid_export_energy = 0.0
+        self.solar_power = 0.0
+        self.state_of_charge_sum = 0.0
+        self.soc_histogram = [0]*SOC_BINS
+
+    def add_site(self, grid_power, soc):
+        self.sites += 1
+        self.grid_import_power += max(grid_power, 0)
+        self.grid_export_power += max(-grid_power, 0)
+        self.state_of_charge_sum += soc
+        self.soc_histogram[soc_bin(soc)] += 1
+
+    def update_site(self, old_grid_power, new_grid_power, old_soc, new_soc, solar_power_delta, dt):
+        self.grid_import_power += max(new_grid_power, 0) - max(old_grid_power, 0)
+        self.grid_export_power += max(-new_grid_power, 0) - max(-old_grid_power, 0)
+        self.grid_import_energy += max(new_grid_power, 0) * dt / 3600
+        self.grid_export_energy += max(-new_grid_power, 0) * dt / 3600
+        self.solar_power += solar_power_delta
+        self.state_of_charge_sum += new_soc - old_soc
+        old_bin, new_bin = soc_bin(old_soc), soc_bin(new_soc)
+        if old_bin != new_bin:
+            self.soc_histogram[old_bin] -= 1
+            self.soc_histogram[new_bin] += 1
+
+    def merge(self, other):
+        self.sites += other["sites"]
+        self.grid_import_power += other["grid_import_power"]
+        self.grid_export_power += other["grid_export_power"]
+        self.grid_import_energy += other["grid_import_energy"]
+        self.grid_export_energy += other["grid_export_energy"]
+        self.solar_power += other["solar_power"]
+        self.state_of_charge_sum += other["state_of_charge_sum"]
+        for i, count in enumerate(other["soc_histogram"]):
+            self.soc_histogram[i] += count
+
+    def to_dict(self):
+        return {
+            "sites": self.sites,
+            "grid_import_power": self.grid_import_power,
+            "grid_export_power": self.grid_export_power,
+            "grid_import_energy": self.grid_import_energy,
+            "grid_export_energy": self.grid_export_energy,
+            "solar_power": self.solar_power,
+            "state_of_charge_sum": self.state_of_charge_sum,
+            "soc_histogram": list(self.soc_histogram),
+        }
+
+    def to_json(self):
+        data = {
+            "sites": self.sites,
+            "grid_import_power": round(self.grid_import_power, 3),
+            "grid_export_power": round(self.grid_export_power, 3),
+            "grid_import_energy": round(self.grid_import_energy, 3),
+            "grid_export_energy": round(self.grid_export_energy, 3),
+            "solar_power": round(self.solar_power, 3),
+            "mean_state_of_charge": round(self.state_of_charge_sum / self.sites, 1) if self.sites else 0,
+            "soc_histogram": list(self.soc_histogram),
+        }
+        return orjson.dumps(data).decode()
+
+
+def soc_bin(soc):
+    return min(int(soc * SOC_BINS / 100), SOC_BINS - 1)
+
+
+class FleetSite:
+    """Ticks one EnergyManager and reports its change to the shard totals."""
+
+    def __init__(self, energy_manager, totals):
+        self.energy_manager = energy_manager
+        self.totals = totals
+        self.grid_power, self.soc, self.solar_power = self.measure()
+        totals.add_site(self.grid_power, self.soc)
+
+    def measure(self):
+        battery = self.energy_manager.battery
+        return (self.energy_manager.power_meter.get_power(),
+                battery.state_of_charge * 100 / battery.capacity,
+                self.energy_manager.solar_panel.solar_power)
+
+    def tick(self, dt):
+        self.energy_manager.tick(dt)
+        grid_power, soc, solar_power = self.measure()
+        self.totals.update_site(self.grid_power, grid_power, self.soc, soc, solar_power - self.solar_power, dt)
+        self.grid_power, self.soc, self.solar_power = grid_power, soc, solar_power
+
+
+class ShardPublisher:
+    """Registered after the sites of a shard so it runs once their tick is complete."""
+
+    def __init__(self, shard, totals, summaries):
+        self.shard = shard
+        self.totals = totals
+        self.summaries = summaries
+
+    def tick(self, dt):
+        self.summaries.put((self.shard, self.totals.to_dict()))
+
+
+def create_site(config):
+    """Builds the EnergyManager of a site; it is not started, the shard scheduler ticks it through a FleetSite."""
+    energy_manager = EnergyManager(
+        latitude=config.get("latitude", 52.52),
+        longitude=config.get("longitude", 13.41),
+        battery_capacity=config.get("battery_capacity", 3000),
+        seed=config.get("seed"),
+        load_profile=config.get("profile"),
+        charge_points=config.get("charge_points", 0),
+        servers=False,
+        history=False,
+        autostart=False)
+    energy_manager.load.block = LOAD_BLOCK
+    if "load" in config:
+        energy_manager.load.update_from_json(config["load"])
+    if "charging" in config and energy_manager.charging_station is not None:
+        energy_manager.charging_station.update_from_json(config["charging"])
+    if "load_balancer" in config:
+        energy_manager.load_balancer.update_from_json(config["load_balancer"])
+    return energy_manager
+
+
+def handle_command(sites, command):
+    """
+    Runs a get or post command of the REST API against a site of the shard.
+
+    Returns:
+        The device JSON for a get, True for a post, a dict with an "error"
+        for rejected settings and None for an unknown site or device
+    """
+    action, site_id, device = command[:3]
+    energy_manager = sites.get(site_id)
+    if energy_manager is None or device not in DEVICES:
+        return None
+    target = getattr(energy_manager, DEVICES[device])
+    if target is None:
+        return None
+    if action == "get":
+        with energy_manager.lock:
+            return target.to_json()
+    if action == "post":
+        if energy_manager.update_device(DEVICES[device], command[3]) is False:
+            return {"error": f"Invalid {device} settings"}
+        return True
+    return None
+
+
+def run_shard(shard, configs, conn, summaries, tick_interval, record_dir=None, time_scale=1):
+    """Worker process entry point: simulates a shard of sites until told to stop."""
+    log.setup()
+    scheduler = Scheduler(tick_interval, time_scale=time_scale)
+    totals = FleetTotals()
+    sites = {}
+    recording = None
+    if record_dir is not None:
+        # One writer for the whole shard, its rows are tagged with the site id
+        try:
+            recording = Recorder(os.path.join(record_dir, f"shard-{shard}.parquet"),
+                                 sites=[config["id"] for config in configs])
+        except OSError as e:
+            logger.warning("Cannot record shard %d: %s", shard, e)
+    for index, config in enumerate(configs):
+        energy_manager = create_site(config)
+        site = FleetSite(energy_manager, totals)
+        scheduler.add(site)
+        sites[str(config["id"])] = energy_manager
+        if recording is not None:
+            energy_manager.attach_recorder(recording, index)
+    scheduler.add(ShardPublisher(shard, totals, summaries))
+    scheduler.start()
+
+    # Commands and replies carry a sequence number, so a reply the parent gave up waiting for is not taken
+    # as the answer to the next request
+    while True:
+        sequence, *command = conn.recv()
+        if command[0] == "stop":
+            scheduler.stop()
+            if recording is not None:
+                try:
+                    recording.close()
+                except Exception as e:
+                    logger.warning("Recording of shard %d failed: %s", shard, e)
+            conn.send((sequence, True))
+            return
+        try:
+            result = handle_command(sites, command)
+        except Exception as e:
+            logger.warning("Command %s of shard %d failed: %s", command[:3], shard, e, exc_info=True)
+            result = {"error": f"{type(e).__name__}: {e}"}
+        conn.send((sequence, result))
+
+
+class Fleet:
+    """
+    Simulates many sites, sharded over worker processes.
+
+    Each worker process hosts its share of the sites on one Scheduler and
+    pushes its shard totals after every tick. The fleet totals are the sum of
+    the latest summary of each shard, so reading them costs O(processes).
+    """
+
+    def __init__(self, sites, processes=None, tick_interval=1, record_dir=None, time_scale=1):
+        self.processes = processes or os.cpu_count() or 1
+        self.processes = max(1, min(self.processes, len(sites)))
+        self.site_shards = {}
+        shards = [[] for _ in range(self.processes)]
+        for index, config in enumerate(sites):
+            config = dict(config)
+            config.setdefault("id", index)
+            shard = index % self.processes
+            shards[shard].append(config)
+            self.site_shards[str(config["id"])] = shard
+
+        context = multiprocessing.get_context("spawn")
+        self.summaries = context.Queue()
+        self.shard_totals = [None]*self.processes
+        self.connections = []
+        self.locks = []
+        self.sequences = []
+        self.workers = []
+        for shard, configs in enumerate(shards):
+            parent_conn, child_conn = context.Pipe()
+            worker = context.Process(target=run_shard, args=(shard, configs, child_conn, self.summaries, tick_interval, record_dir,
+                                                                time_scale))
+            worker.daemon = True
+            worker.start()
+            self.connections.append(parent_conn)
+            self.locks.append(threading.Lock())
+            self.sequences.append(0)
+            self.workers.append(worker)
+
+        self.summary_thread = threading.Thread(target=self.collect_summaries)
+        self.summary_thread.daemon = True
+        self.summary_thread.start()
+
+    @classmethod
+    def from_config(cls, path):
+        with open(path) as config_file:
+            config = json.load(config_file)
+        if isinstance(config, list):
+            return cls(config)
+        return cls(config["sites"], config.get("processes"), config.get("tick_interval", 1), config.get("record_dir"),
+                   config.get("time_scale", 1))
+
+    def collect_summaries(self):
+        while True:
+            try:
+                shard, totals = self.summaries.get()
+            except (EOFError, OSError, queue.Empty):
+                return
+            self.shard_totals[shard] = totals
+
+    def site_ids(self):
+        return list(self.site_shards)
+
+    def request(self, site_id, *command):
+        """
+        Sends a command to the shard of a site and waits for its reply.
+
+        Returns:
+            The reply of handle_command(), None for an unknown site, or a dict
+            with an "error" and "unavailable" set when the shard does not
+            answer within REQUEST_TIMEOUT
+        """
+        shard = self.site_shards.get(str(site_id))
+        if shard is None:
+            return None
+        return self.send(shard, (command[0], str(site_id)) + command[1:])
+
+    def send(self, shard, command, timeout=REQUEST_TIMEOUT):
+        conn = self.connections[shard]
+        with self.locks[shard]:
+            self.sequences[shard] += 1
+            sequence = self.sequences[shard]
+            try:
+                conn.send((sequence,) + command)
+                # Skip replies to earlier requests that timed out
+                while conn.poll(timeout):
+                    reply_sequence, result = conn.recv()
+                    if reply_sequence == sequence:
+                        return result
+            except (EOFError, OSError) as e:
+                logger.warning("Shard %d is not reachable: %s", shard, e)
+                return {"error": f"Shard {shard} is not reachable", "unavailable": True}
+        logger.warning("Shard %d did not answer %s within %s s", shard, command[:3], timeout)
+        return {"error": f"Shard {shard} did not answer", "unavailable": True}
+
+    def get(self, site_id, device):
+        return self.request(site_id, "get", device)
+
+    def update(self, site_id, device, data):
+        return self.request(site_id, "post", device, data)
+
+    def totals(self):
+        totals = FleetTotals()
+        for shard in self.shard_totals:
+            if shard is not None:
+                totals.merge(shard)
+        return totals
+
+    def stop(self):
+        for shard in range(self.processes):
+            self.send(shard, ("stop",))
+        for worker in self.workers:
+            worker.join()
@@ -0,0 +1,189 @@
+import os
+import threading
+import time
+import numpy as np
+import openmeteo_requests
+import requests_cache
+from retry_requests import retry
+import log
+import metrics
+
+logger = log.get_logger("forecast")
+
+API_URL = os.environ.get("OPENMETEO_API_URL", "https://api.open-meteo.com/v1/forecast")
+
+FETCH_SECONDS = metrics.Histogram("forecast_fetch_duration_seconds", "Duration of a batched Open-Meteo request")
+FETCHED_CELLS = metrics.Counter("forecast_fetched_cells", "Grid cells fetched from Open-Meteo")
+FETCH_ERRORS = metrics.Counter("forecast_fetch_errors", "Failed forecast refreshes")
+
+
+class Forecast:
+    """Decoded minutely_15 forecast of one grid cell, kept as NumPy arrays."""
+
+    def __init__(self, times, ghi, temperature, fetched_at=None):
+        self.times = times
+        self.ghi = ghi
+        self.temperature = temperature
+        # Wall-clock time of the request, None for forecasts computed locally
+        self.fetched_at = fetched_at
+
+    def interpolate(self, now):
+        """Returns (ghi, temperature) linearly interpolated at time now (s since epoch)."""
+        return (float(np.interp(now, self.times, self.ghi)),
+                float(np.interp(now, self.times, self.temperature)))
+
+
+class ForecastService:
+    """
+    Shared Open-Meteo forecast fetcher.
+
+    Locations are snapped to a grid of grid_size degrees, and every cell is
+    fetched again once its forecast is window (s) old. All the cells that are
+    due then are refreshed together in batched requests of up to batch_size
+    locations. The whole decoded forecast is kept in memory,
+    so panels interpolate from it on every tick without touching the network.
+
+    Fetches run on a background thread, outside the lock of the service and
+    of the sites that ask for a forecast: callers always get the forecast at
+    hand right away (None before the first fetch of a cell), so a slow or
+    unreachable API only delays the next forecast. The age of a forecast is
+    measured on the wall clock, so an accelerated simulation clock does not
+    fetch any more often.
+    """
+
+    def __init__(self, api_url=API_URL, grid_size=0.1, window=900, batch_size=100,
+                 retry_interval=60, session=None, background=True):
+        self.api_url = api_url
+        self.grid_size = grid_size
+        self.window = window
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        if session is None:
+            cache_session = requests_cache.CachedSession('.cache', expire_after = 3600)
+            session = retry(cache_session, retries = 5, backoff_factor = 0.2)
+        self.openmeteo = openmeteo_requests.Client(session = session)
+        self.forecasts = {}
+        self.failed_until = None
+        self.fetch_count = 0
+        # Run fetches on their own thread; False fetches on the caller's thread, still outside the lock
+        self.background = background
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def cell(self, latitude, longitude):
+        return (round(latitude / self.grid_size), round(longitude / self.grid_size))
+
+    def subscribe(self, latitude, longitude):
+        """Registers a location so it is included in the next batched fetch."""
+        with self.lock:
+            self.forecasts.setdefault(self.cell(latitude, longitude), None)
+
+    def expired(self, forecast, wall_time):
+        return forecast is None or wall_time - forecast.fetched_at >= self.window
+
+    def get_forecast(self, latitude, longitude, now=None):
+        """
+        Returns the Forecast at hand for a location, None before its first
+        fetch, and starts a refresh when it is window seconds old. now (the
+        simulated time) does not age the forecast.
+        """
+        cell = self.cell(latitude, longitude)
+        wall_time = time.time()
+        start = False
+        with self.lock:
+            forecast = self.forecasts.get(cell)
+            if self.expired(forecast, wall_time):
+                self.forecasts.setdefault(cell, None)
+                if not self.refreshing and (self.failed_until is None or wall_time >= self.failed_until):
+                    self.refreshing = start = True
+        if start:
+            if self.background:
+                threading.Thread(target=self.refresh, daemon=True).start()
+            else:
+                self.refresh()
+                with self.lock:
+                    forecast = self.forecasts[cell]
+        return forecast
+
+    def get(self, latitude, longitude, now):
+        """Returns (ghi W/m², temperature °C) for a location at time now, or None before the first fetch."""
+        forecast = self.get_forecast(latitude, longitude, now)
+        if forecast is None:
+            return None
+        if now > forecast.times[-1]:
+            # An accelerated clock outran the forecast, interpolation holds its last values
+            logger.warning("Time %d is past the end of the forecast at %d, holding its last values",
+                           now, forecast.times[-1])
+        return forecast.interpolate(now)
+
+    def series(self, latitude, longitude, times):
+        """Returns (ghi, temperature) arrays over times (epoch seconds) from the current forecast."""
+        forecast = self.get_forecast(latitude, longitude)
+        if forecast is None:
+            return None
+        times = np.asarray(times, dtype=np.float64)
+        return np.interp(times, forecast.times, forecast.ghi), np.interp(times, forecast.times, forecast.temperature)
+
+    def coverage(self, latitude, longitude):
+        """Last time (epoch seconds) of the current forecast, None before the first fetch."""
+        forecast = self.get_forecast(latitude, longitude)
+        return None if forecast is None else float(forecast.times[-1])
+
+    def refresh(self):
+        """Fetches every expired cell, without holding the lock while a request runs."""
+        try:
+            fetched_at = time.time()
+            with self.lock:
+                stale = [cell for cell, forecast in self.forecasts.items() if self.expired(forecast, fetched_at)]
+            for start in range(0, len(stale), self.batch_size):
+                cells = stale[start:start + self.batch_size]
+                started = time.perf_counter() if metrics.enabled else None
+                forecasts = self.fetch(cells, fetched_at)
+                if started is not None:
+                    FETCH_SECONDS.observe(time.perf_counter() - started)
+                    FETCHED_CELLS.inc(len(cells))
+                with self.lock:
+                    for cell, forecast in zip(cells, forecasts):
+                        self.forecasts[cell] = forecast
+            with self.lock:
+                self.failed_until = None
+        except Exception as e:
+            if metrics.enabled:
+                FETCH_ERRORS.inc()
+            # Keep serving the previous forecasts, try again later
+            with self.lock:
+                self.failed_until = time.time() + self.retry_interval
+            logger.warning("Forecast fetch failed, retrying in %d s: %s", self.retry_interval, e)
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def fetch(self, cells, fetched_at):
+        params = {
+            "latitude": [round(cell[0] * self.grid_size, 4) for cell in cells],
+            "longitude": [round(cell[1] * self.grid_size, 4) for cell in cells],
+            "minutely_15": ["shortwave_radiation", "temperature_2m"],
+            "past_minutely_15": 1,
+            # Today and tomorrow, the horizon of the battery schedule
+            "forecast_days": 2,
+        }
+        self.fetch_count += 1
+        responses = self.openmeteo.weather_api(self.api_url, params=params)
+        forecasts = []
+        for response in responses:
+            minutely_15 = response.Minutely15()
+            times = np.arange(minutely_15.Time(), minutely_15.TimeEnd(), minutely_15.Interval(), dtype=np.float64)
+            forecasts.append(Forecast(times,
+                                      minutely_15.Variables(0).ValuesAsNumpy().astype(np.float64),
+                                      minutely_15.Variables(1).ValuesAsNumpy().astype(np.float64),
+                                      fetched_at))
+        return forecasts
+
+
+default_service = None
+
+def get_default_service():
+    global default_service
+    if default_service is None:
+        default_service = ForecastService()
+    return default_service
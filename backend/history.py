@@ -0,0 +1,152 @@
+import threading
+import numpy as np
+
+# (bucket length in s, number of buckets kept): 1 h of 1 s, 2 days of 1 min, 30 days of 15 min
+RESOLUTIONS = ((1, 3600), (60, 2880), (900, 2880))
+
+
+class RollupLevel:
+    """
+    Fixed-size ring buffer of min/max/mean buckets of step seconds, with the
+    number of samples of each bucket.
+
+    Samples are folded into the current bucket; the bucket is written to the
+    ring when a sample falls into the next one, overwriting the oldest bucket
+    once the ring is full.
+    """
+
+    def __init__(self, step, capacity, signals):
+        self.step = step
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.min = np.zeros((capacity, signals), dtype=np.float32)
+        self.max = np.zeros((capacity, signals), dtype=np.float32)
+        self.mean = np.zeros((capacity, signals), dtype=np.float32)
+        self.samples = np.zeros(capacity, dtype=np.int64)
+        self.count = 0
+        self.bucket = None
+        self.bucket_min = np.full(signals, np.inf)
+        self.bucket_max = np.full(signals, -np.inf)
+        self.bucket_sum = np.zeros(signals)
+        self.bucket_samples = 0
+
+    def add(self, time, values):
+        bucket = int(time // self.step)
+        if self.bucket is not None and bucket != self.bucket:
+            self.flush()
+        self.bucket = bucket
+        np.minimum(self.bucket_min, values, out=self.bucket_min)
+        np.maximum(self.bucket_max, values, out=self.bucket_max)
+        self.bucket_sum += values
+        self.bucket_samples += 1
+
+    def flush(self):
+        index = self.count % self.capacity
+        self.times[index] = self.bucket * self.step
+        self.min[index] = self.bucket_min
+        self.max[index] = self.bucket_max
+        self.mean[index] = self.bucket_sum / self.bucket_samples
+        self.samples[index] = self.bucket_samples
+        self.count += 1
+        self.bucket_min.fill(np.inf)
+        self.bucket_max.fill(-np.inf)
+        self.bucket_sum.fill(0)
+        self.bucket_samples = 0
+
+    def oldest(self):
+        if self.count == 0:
+            return None if self.bucket is None else self.bucket * self.step
+        return self.times[self.count % self.capacity if self.count > self.capacity else 0]
+
+    def rows(self, columns):
+        """Returns (times, min, max, mean, samples) in time order, including the open bucket."""
+        if self.count > self.capacity:
+            start = self.count % self.capacity
+            order = np.r_[start:self.capacity, 0:start]
+        else:
+            order = np.arange(self.count)
+        times = self.times[order]
+        low = self.min[order][:, columns]
+        high = self.max[order][:, columns]
+        mean = self.mean[order][:, columns]
+        samples = self.samples[order]
+        if self.bucket_samples:
+            times = np.append(times, self.bucket * self.step)
+            low = np.vstack([low, self.bucket_min[columns]])
+            high = np.vstack([high, self.bucket_max[columns]])
+            mean = np.vstack([mean, self.bucket_sum[columns] / self.bucket_samples])
+            samples = np.append(samples, self.bucket_samples)
+        return times, low, high, mean, samples
+
+
+class History:
+    """
+    Per-signal history of a site at several resolutions, in constant memory.
+
+    record() runs on the tick thread and query() on request threads; a lock
+    keeps a query from reading a bucket that is half written.
+    """
+
+    def __init__(self, signals, resolutions=RESOLUTIONS):
+        self.signals = list(signals)
+        self.columns = {name: index for index, name in enumerate(self.signals)}
+        self.levels = [RollupLevel(step, capacity, len(self.signals)) for step, capacity in resolutions]
+        self.values = np.zeros(len(self.signals))
+        self.lock = threading.Lock()
+
+    def record(self, time, values):
+        """Adds one sample; values are in the order of signals."""
+        with self.lock:
+            self.values[:] = values
+            for level in self.levels:
+                level.add(time, self.values)
+
+    def select_level(self, start, step):
+        """Coarsest level not coarser than step, falling back to any level that still covers start."""
+        candidates = [level for level in self.levels if level.step <= step] or self.levels[:1]
+        for level in reversed(candidates):
+            oldest = level.oldest()
+            if oldest is not None and oldest <= start:
+                return level
+        for level in self.levels:
+            oldest = level.oldest()
+            if oldest is not None and oldest <= start:
+                return level
+        return candidates[-1]
+
+    def query(self, signals, start, end, step):
+        """
+        Returns min/max/mean of signals over [start, end] in buckets of step seconds.
+
+        Raises KeyError for an unknown signal name.
+        """
+        columns = [self.columns[name] for name in signals]
+        with self.lock:
+            level = self.select_level(start, step)
+            times, low, high, mean, samples = level.rows(columns)
+        first = np.searchsorted(times, start, side='left')
+        last = np.searchsorted(times, end, side='right')
+        times, low, high, mean = times[first:last], low[first:last], high[first:last], mean[first:last]
+        samples = samples[first:last]
+        step = max(step, level.step)
+        if step > level.step and len(times):
+            buckets = (times // step).astype(np.int64)
+            edges = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+            times = buckets[edges] * float(step)
+            low = np.minimum.reduceat(low, edges, axis=0)
+            high = np.maximum.reduceat(high, edges, axis=0)
+            # Weighted by the samples of each bucket, so a partly filled bucket counts for what it holds
+            weights = samples[:, None].astype(np.float64)
+            mean = np.add.reduceat(mean * weights, edges, axis=0) / np.add.reduceat(weights, edges, axis=0)
+        return {
+            "step": step,
+            "time": times.tolist(),
+            "signals": {
+                name: {
+                    "min": low[:, index].tolist(),
+                    "max": high[:, index].tolist(),
+                    "mean": mean[:, index].tolist(),
+                }
+                for index, name in enumerate(signals)
+            },
+        }
@@ -1,14 +1,21 @@
-import openmeteo_requests
-import requests_cache
-import pandas as pd
-from retry_requests import retry
-import threading
-import json
+import orjson
 from enum import Enum
 from modbus import Modbus
+import irradiance
+import log
+import optimizer
+import solar_geometry
+
+solar_logger = log.get_logger("solar")
+inverter_logger = log.get_logger("inverter")
+battery_logger = log.get_logger("battery")
 
 class SolarPanel:
-    def __init__(self, latitude, longitude):
+    __slots__ = ("panel_efficiency", "panel_area", "inverter_efficiency", "shading_factor", "latitude", "longitude",
+                 "temperature", "solar_power", "solar_energy", "manual_mode", "irradiance_source", "strings",
+                 "albedo")
+
+    def __init__(self, latitude, longitude, irradiance_source=None):
         self.panel_efficiency = 0.2 # 20% Nominal panel efficiency (decimal)
         self.panel_area = 10 # Total surface area of the PV panel (m²)
         self.inverter_efficiency = 0.95 # 95% Inverter efficiency (decimal)
@@ -19,20 +26,19 @@ class SolarPanel:
         self.solar_power = 0
         self.solar_energy = 0
         self.manual_mode = False
-        self.polling_interval = 60
-        self.api_url = "https://api.open-meteo.com/v1/forecast"
-        cache_session = requests_cache.CachedSession('.cache', expire_after = 3600)
-        retry_session = retry(cache_session, retries = 5, backoff_factor = 0.2)
-        self.openmeteo = openmeteo_requests.Client(session = retry_session)
-        self.timer = None
-        self.schedule_power_generation()
-        
+        # (tilt °, azimuth ° clockwise from north, share of panel_area) per orientation;
+        # a flat panel gets exactly the horizontal irradiance
+        self.strings = ((0, 180, 1.0),)
+        self.albedo = solar_geometry.ALBEDO
+        self.irradiance_source = irradiance_source if irradiance_source is not None else irradiance.get_default_source()
+        self.irradiance_source.subscribe(latitude, longitude)
+
     def calculate_pv_power(self, ghi, temp):
         """
         Calculates PV power output considering advanced factors.
 
         Args:
-            ghi: Global Horizontal Irradiance (W/m²)
+            ghi: Irradiance on the panel plane (W/m²), the GHI for a flat panel
             temp: Temperature (°C)
             shading_factor: Factor to account for shading (0-1)
 
@@ -57,60 +63,87 @@ class SolarPanel:
 
         return final_power
     
-    def get_weather_forecast(self):
-        params = {
-            'latitude': self.latitude,
-            'longitude': self.longitude,
-            'current': "temperature_2m",
-            "minutely_15": "shortwave_radiation",
-            "past_minutely_15": 1,
-            "timezone": "auto"
-        }
-        responses = self.openmeteo.weather_api(self.api_url, params=params)
-        # Process first location. Add a for-loop for multiple locations or weather models
-        response = responses[0]
-        return response.Current(), response.Minutely15()
-    
-    def generate_power(self):
-        current, minutely_15 = self.get_weather_forecast()
-        self.temperature = current.Variables(0).Value()
-        print(f"Temperature: {self.temperature}°C")
-        print(f"GHI: {minutely_15.Variables(0).ValuesAsNumpy()[1]} W/m²")
-        self.solar_power = self.calculate_pv_power(float(minutely_15.Variables(0).ValuesAsNumpy()[1]), self.temperature)
-        self.solar_energy += self.solar_power * self.polling_interval / 3660
-
-    def schedule_power_generation(self):
+    def is_flat(self):
+        return all(string[0] == 0 for string in self.strings)
+
+    def plane_of_array(self, ghi, seconds):
+        """Irradiance on the panel (W/m²) for GHI over a time axis (epoch seconds)."""
+        if self.is_flat():
+            return ghi
+        return solar_geometry.array_irradiance(self.strings, ghi, self.latitude, self.longitude, seconds, self.albedo)
+
+    def plane_of_array_at(self, ghi, now):
+        """Irradiance on the panel (W/m²) for the GHI at time now."""
+        if self.is_flat():
+            return ghi
+        return solar_geometry.point_irradiance(self.strings, ghi, self.latitude, self.longitude, now, self.albedo)
+
+    def get_weather_forecast(self, now):
+        """Returns the Forecast (times, ghi and temperature arrays) covering this panel."""
+        return self.irradiance_source.get_forecast(self.latitude, self.longitude, now)
+
+    def generate_power(self, now):
+        weather = self.irradiance_source.get(self.latitude, self.longitude, now)
+        if weather is not None:
+            ghi, self.temperature = weather
+            self.solar_power = self.calculate_pv_power(self.plane_of_array_at(ghi, now), self.temperature)
+
+    def update(self, now, dt):
         if not self.manual_mode:
-            self.generate_power()
-            self.timer = threading.Timer(self.polling_interval, self.schedule_power_generation)
-            self.timer.start()
+            try:
+                self.generate_power(now)
+            except Exception as e:
+                # Keep the last value, a failed source must not stop the simulation clock
+                solar_logger.warning("Error reading irradiance: %s", e)
+        self.solar_energy += self.solar_power * dt / 3600
 
-    def to_json(self):
+    def to_dict(self):
         data = {
             "latitude": self.latitude,
             "longitude": self.longitude,
             "temperature": round(self.temperature, 1),
             "solar_power": round(self.solar_power, 3),
-            "manual_mode": self.manual_mode
+            "manual_mode": self.manual_mode,
+            "strings": [{"tilt": tilt, "azimuth": azimuth, "share": share} for tilt, azimuth, share in self.strings],
         }
-        return json.dumps(data)
+        return data
+
+    def to_json(self):
+        return orjson.dumps(self.to_dict()).decode()
     
     def update_from_json(self, data):
+        if "strings" in data:
+            shares = [string.get("share", 1) for string in data["strings"]]
+            if not all(isinstance(share, (int, float)) and share >= 0 for share in shares) or sum(shares) <= 0:
+                solar_logger.warning("Invalid string shares %s, must be non-negative with a positive total", shares)
+                return False
         if "latitude" in data:
             self.latitude = data["latitude"]
         if "longitude" in data:
             self.longitude = data["longitude"]
+        if "latitude" in data or "longitude" in data:
+            self.irradiance_source.subscribe(self.latitude, self.longitude)
         if "temperature" in data:
             self.temperature = data["temperature"]
         if "solar_power" in data:
             self.solar_power = data["solar_power"]
-        if "manual_mode" in data and self.manual_mode != data["manual_mode"]:
+        if "manual_mode" in data:
             self.manual_mode = data["manual_mode"]
-            self.timer.cancel()
-            if not self.manual_mode:
-                self.schedule_power_generation()
+        if "tilt" in data or "azimuth" in data:
+            tilt, azimuth, _ = self.strings[0]
+            self.strings = ((data.get("tilt", tilt), data.get("azimuth", azimuth), 1.0),)
+        if "strings" in data:
+            total = sum(string.get("share", 1) for string in data["strings"])
+            self.strings = tuple((string.get("tilt", 0), string.get("azimuth", 180), string.get("share", 1) / total)
+                                 for string in data["strings"])
+        if "albedo" in data:
+            self.albedo = data["albedo"]
+        return True
 
 class Battery:
+    __slots__ = ("capacity", "state_of_charge", "max_charge_current", "max_discharge_current", "volts", "current",
+                 "feed_in", "feed_out", "manual_mode", "grid_charge_limit")
+
     def __init__(self, capacity):
         self.capacity = capacity
         self.state_of_charge = 0
@@ -121,30 +154,25 @@ class Battery:
         self.feed_in = 0
         self.feed_out = 0
         self.manual_mode = False
-        self.polling_interval = 30
-        self.timer = None
-        self.schedule_charge_update()
+        # Charging current (A) the battery may draw from the grid, set by a load balancer
+        self.grid_charge_limit = float("inf")
 
-    def update_charge(self):
+    def update(self, now, dt):
+        self.update_charge(dt)
+
+    def update_charge(self, dt):
         if not self.manual_mode:
             # Assuming a simple model where state of charge is updated based on current and voltage
             # This is a placeholder for a more complex battery management algorithm
-            energy_exchanged = self.current * self.volts * self.polling_interval / 3600
+            energy_exchanged = self.current * self.volts * dt / 3600
             if energy_exchanged > 0:
                 self.feed_in += energy_exchanged
             else:
                 self.feed_out -= energy_exchanged
             self.state_of_charge += energy_exchanged
             self.state_of_charge = min(max(self.state_of_charge, 0), self.capacity)
-            print(f"Battery charge: {round(self.state_of_charge, 3)} Wh")
-            print(f"SoC: {round(self.state_of_charge * 100 /self.capacity, 1)}%")
-            self.timer = threading.Timer(self.polling_interval, self.update_charge)
-            self.timer.start()
-
-    def schedule_charge_update(self):
-        self.update_charge()
 
-    def to_json(self):
+    def to_dict(self):
         data = {
             "capacity": self.capacity,
             "voltage": self.volts,
@@ -155,9 +183,16 @@ class Battery:
             "max_discharge_current": self.max_discharge_current,
             "manual_mode": self.manual_mode
         }
-        return json.dumps(data)
+        return data
+
+    def to_json(self):
+        return orjson.dumps(self.to_dict()).decode()
     
     def update_from_json(self, data):
+        for name in ("capacity", "voltage"):
+            if name in data and not (isinstance(data[name], (int, float)) and data[name] > 0):
+                battery_logger.warning("Invalid battery %s %s, must be positive", name, data[name])
+                return False
         if "capacity" in data:
             self.capacity = data["capacity"]
         if "voltage" in data:
@@ -170,17 +205,17 @@ class Battery:
             self.max_charge_current = data["max_charge_current"]
         if "max_discharge_current" in data:
             self.max_discharge_current = data["max_discharge_current"]
-        if "manual_mode" in data and self.manual_mode != data["manual_mode"]:
+        if "manual_mode" in data:
             self.manual_mode = data["manual_mode"]
-            self.timer.cancel()
-            if not self.manual_mode:
-                self.schedule_charge_update()
+        return True
 
 
 class SolarUseMode(Enum):
     SelfUse = 0
     Backup = 2
     Manual = 3
+    # Battery schedule optimized against the PV and load forecast and the tariff
+    Optimized = 4
 
 class BatteryUseMode(Enum):
     Stop = 0
@@ -198,12 +233,12 @@ solax_parameters = [
                 { "name": "battery_discharge_max_current", "function_code": 3, "address": 145, "type": "u16", "default": 0 },
                 { "name": "battery_absorb_voltage", "function_code": 3, "address": 146, "type": "u16", "default": 0 },
                 { "name": "grid_current", "function_code": 4, "address": 1, "type": "i16", "default": 0 },
-                { "name": "grid_power", "function_code": 4, "address": 2, "type": "u32", "default": 0 },
+                { "name": "grid_power", "function_code": 4, "address": 2, "type": "i16", "default": 0 },
                 { "name": "solar_connected", "function_code": 4, "address": 3, "type": "u16", "default": 0 },
                 { "name": "pv_power", "function_code": 4, "address": 10, "type": "u32", "default": 0 },
                 { "name": "battery_voltage", "function_code": 4, "address": 20, "type": "i16", "default": 0 },
                 { "name": "battery_current", "function_code": 4, "address": 21, "type": "i16", "default": 0 },
-                { "name": "battery_power", "function_code": 4, "address": 22, "type": "i32", "default": 0 },
+                { "name": "battery_power", "function_code": 4, "address": 22, "type": "i16", "default": 0 },
                 { "name": "battery_connected", "function_code": 4, "address": 23, "type": "u16", "default": 0 },
                 { "name": "state_of_charge", "function_code": 4, "address": 28, "type": "u16", "default": 0 },
                 { "name": "out_charge_energy", "function_code": 4, "address": 29, "type": "u32", "default": 0 },
@@ -214,67 +249,129 @@ solax_parameters = [
                 { "name": "feeding_energy", "function_code": 4, "address": 72, "type": "u32", "default": 0 },
                 { "name": "consum_energy", "function_code": 4, "address": 74, "type": "u32", "default": 0 },
                 { "name": "total_energy_to_grid", "function_code": 4, "address": 82, "type": "u32", "default": 0 },
-                { "name": "solar_energy_index", "function_code": 4, "address": 148, "type": "u32", "default": 0 }
+                { "name": "solar_energy_index", "function_code": 4, "address": 148, "type": "u32", "default": 0 },
+                { "name": "inverter_state", "function_code": 4, "address": 0x100, "type": "u16", "default": 6 }
             ]
 
 class Inverter:
-    def __init__(self, solar_panel, battery, power_meter):
-        self.modbus = Modbus(5020, solax_parameters)
+    __slots__ = ("modbus", "solar_panel", "battery", "update_timer", "last_publish", "manual_mode", "solar_use_mode",
+                 "battery_use_mode", "power_meter", "load", "tariff", "optimizer", "seed")
+
+    def __init__(self, solar_panel, battery, power_meter, modbus_port=5020, unit_id=None, load=None, seed=None):
+        self.modbus = Modbus(modbus_port, solax_parameters, unit_id) if modbus_port is not None else None
         self.solar_panel = solar_panel
         self.battery = battery
         self.update_timer = 2
+        self.last_publish = None
         self.manual_mode = False
         self.solar_use_mode = SolarUseMode.SelfUse
         self.battery_use_mode = BatteryUseMode.Stop
         self.power_meter = power_meter
-        self.timer = None
-        self.schedule_power_output()
-    
-    def schedule_power_output(self):
+        # Load whose profile is the load forecast of the Optimized mode, tariff and optimizer created on demand
+        self.load = load
+        self.tariff = None
+        self.optimizer = None
+        # Seed of the optimizer's re-solve phase
+        self.seed = seed
+
+    def update(self, now, dt, load_power=None):
+        """
+        Args:
+            now: Simulation time (s)
+            dt: Step (s)
+            load_power: Site consumption (W) of this tick; the power meter's reading of the previous tick if None
+        """
+        if not self.manual_mode:
+            self.schedule_power_output(now, load_power)
+            if self.modbus is not None and (self.last_publish is None or now - self.last_publish >= self.update_timer):
+                self.last_publish = now
+                self.update_modbus_context()
+
+    def schedule_power_output(self, now=None, load_power=None):
         if not self.manual_mode:
             #print(f"solar_use_mode: {self.solar_use_mode}")
             #print(f"battery_use_mode: {self.battery_use_mode}")
             if self.solar_use_mode == SolarUseMode.SelfUse:
-                if(self.solar_panel.solar_power > self.power_meter.get_load()) and (self.battery.state_of_charge < self.battery.capacity):
-                    self.battery.current = min(self.battery.max_charge_current, (self.solar_panel.solar_power - self.power_meter.get_load()) / self.battery.volts)
-                elif self.solar_panel.solar_power < self.power_meter.get_load() and self.battery.state_of_charge > 0:
-                    self.battery.current = -min(self.battery.max_discharge_current, (self.power_meter.get_load() - self.solar_panel.solar_power) / self.battery.volts)
-                else:
-                    self.battery.current = 0
+                self.schedule_self_use(load_power)
+            elif self.solar_use_mode == SolarUseMode.Optimized and now is not None:
+                self.schedule_optimized(now, load_power)
             elif self.solar_use_mode == SolarUseMode.Backup:
                 self.battery.current = 0
             elif self.battery_use_mode == BatteryUseMode.Charge:
-                self.battery.current = self.battery.max_charge_current
+                self.battery.current = min(self.battery.max_charge_current,
+                                           self.battery.grid_charge_limit + self.solar_panel.solar_power / self.battery.volts)
             elif self.battery_use_mode == BatteryUseMode.Discharge:
                 self.battery.current = -self.battery.max_discharge_current
             else:
                 self.battery.current = 0
             #print(f"Current: {self.battery.current}")
-            self.update_modbus_context()
-            self.timer = threading.Timer(self.update_timer, self.schedule_power_output)
-            self.timer.start()
+
+    def schedule_self_use(self, load_power=None):
+        load = self.power_meter.get_load() if load_power is None else load_power
+        if(self.solar_panel.solar_power > load) and (self.battery.state_of_charge < self.battery.capacity):
+            self.battery.current = min(self.battery.max_charge_current, (self.solar_panel.solar_power - load) / self.battery.volts)
+        elif self.solar_panel.solar_power < load and self.battery.state_of_charge > 0:
+            self.battery.current = -min(self.battery.max_discharge_current, (load - self.solar_panel.solar_power) / self.battery.volts)
+        else:
+            self.battery.current = 0
+
+    def schedule_optimized(self, now, load_power=None):
+        """
+        Follows the battery power of the optimized schedule, re-planned every
+        optimizer.RESOLVE_INTERVAL. Falls back to self use without a schedule.
+        """
+        if self.optimizer is None:
+            self.optimizer = optimizer.DispatchOptimizer(seed=self.seed)
+        battery = self.battery
+        if self.optimizer.needs_plan(now):
+            try:
+                if self.optimizer.plan(now, self.solar_panel, self.load, battery,
+                                       self.tariff or optimizer.DEFAULT_TARIFF) is None:
+                    inverter_logger.warning("No forecast to plan the battery schedule, retrying later")
+            except Exception as e:
+                inverter_logger.warning("Could not plan the battery schedule: %s", e)
+        power = self.optimizer.power(now, battery.state_of_charge)
+        if power is None:
+            self.schedule_self_use(load_power)
+        elif power > 0 and battery.state_of_charge < battery.capacity:
+            battery.current = min(power / battery.volts, battery.max_charge_current,
+                                  battery.grid_charge_limit + self.solar_panel.solar_power / battery.volts)
+        elif power < 0 and battery.state_of_charge > 0:
+            battery.current = max(power / battery.volts, -battery.max_discharge_current)
+        else:
+            battery.current = 0
             
     def update_modbus_context(self):
-        
-        self.modbus.set_modbus_server_parameter_value("battery_charge_max_current", self.battery.max_charge_current * 10)
-        self.modbus.set_modbus_server_parameter_value("battery_discharge_max_current", self.battery.max_discharge_current * 10)
-        self.modbus.set_modbus_server_parameter_value("power_limit", 100)
-        self.modbus.set_modbus_server_parameter_value("battery_voltage", self.battery.volts * 10)
-        self.modbus.set_modbus_server_parameter_value("battery_current", self.battery.current * 10)
-        self.modbus.set_modbus_server_parameter_value("battery_capacity", self.battery.capacity)
-        self.modbus.set_modbus_server_parameter_value("state_of_charge", round(self.battery.state_of_charge * 100 /self.battery.capacity, 1))
-        self.modbus.set_modbus_server_parameter_value("solar_charge_use_mode", self.solar_use_mode.value)
-        self.modbus.set_modbus_server_parameter_value("manual_mode", self.battery_use_mode.value)
-        self.modbus.set_modbus_server_parameter_value("battery_type", 1)
-        self.modbus.set_modbus_server_parameter_value("battery_power", self.battery.current * self.battery.volts)
-        self.modbus.set_modbus_server_parameter_value("pv_power", self.solar_panel.solar_power)
-        self.modbus.set_modbus_server_parameter_value("solar_energy_index", 705)
-        self.modbus.context[0].setValues(4, 0x100, [6])
-    
+        self.modbus.set_modbus_server_parameter_values({
+            "battery_charge_max_current": self.battery.max_charge_current * 10,
+            "battery_discharge_max_current": self.battery.max_discharge_current * 10,
+            "power_limit": 100,
+            "battery_voltage": self.battery.volts * 10,
+            "battery_current": self.battery.current * 10,
+            "battery_capacity": self.battery.capacity,
+            "state_of_charge": round(self.battery.state_of_charge * 100 /self.battery.capacity, 1),
+            "solar_charge_use_mode": self.solar_use_mode.value,
+            "manual_mode": self.battery_use_mode.value,
+            "battery_type": 1,
+            "battery_power": self.battery.current * self.battery.volts,
+            "pv_power": self.solar_panel.solar_power,
+            "solar_energy_index": 705,
+            "inverter_state": 6,
+        })
+
     def get_power(self):
         return (self.solar_panel.solar_power - self.battery.current * self.battery.volts)
+
+    def is_charging_from_grid(self):
+        """True in the modes where schedule_power_output() may charge the battery regardless of the solar surplus."""
+        if self.manual_mode:
+            return False
+        if self.solar_use_mode == SolarUseMode.Optimized:
+            return self.optimizer is not None and self.optimizer.held_power() > self.solar_panel.solar_power
+        return (self.solar_use_mode not in (SolarUseMode.SelfUse, SolarUseMode.Backup)
+                and self.battery_use_mode == BatteryUseMode.Charge)
     
-    def to_json(self):
+    def to_dict(self):
         data = {
             #"solar_panel": self.solar_panel.to_json(),
             #"battery": self.battery.to_json(),
@@ -283,21 +380,32 @@ class Inverter:
             "battery_use_mode": self.battery_use_mode.name,
             "manual_mode": self.manual_mode
         }
-        return json.dumps(data)
+        if self.optimizer is not None:
+            data["optimizer"] = self.optimizer.to_dict()
+        return data
+
+    def to_json(self):
+        return orjson.dumps(self.to_dict()).decode()
     
     def update_from_json(self, data):
+        if "tariff" in data:
+            tariff = self.tariff or optimizer.Tariff()
+            if not tariff.update_from_json(data["tariff"]):
+                return False
+            self.tariff = tariff
+            if self.optimizer is not None:
+                # Re-plan with the new prices on the next tick
+                self.optimizer.planned_at = None
         #if "solar_panel" in data:
         #    self.solar_panel.update_from_json(json.loads(data["solar_panel"]))
         #if "battery" in data:
         #    self.battery.update_from_json(json.loads(data["battery"]))
         if "solar_use_mode" in data:
-            print(f"Setting solar use mode to {data['solar_use_mode']}")
+            inverter_logger.info("Setting solar use mode to %s", data["solar_use_mode"])
             self.solar_use_mode = SolarUseMode[data["solar_use_mode"]]
         if "battery_use_mode" in data:
-            print(f"Setting battery use mode to {data['battery_use_mode']}")
+            inverter_logger.info("Setting battery use mode to %s", data["battery_use_mode"])
             self.battery_use_mode = BatteryUseMode[data["battery_use_mode"]]
-        if "manual_mode" in data and self.manual_mode != data["manual_mode"]:
+        if "manual_mode" in data:
             self.manual_mode = data["manual_mode"]
-            self.timer.cancel()
-            if not self.manual_mode:
-                self.schedule_power_output()
+        return True
@@ -0,0 +1,146 @@
+import os
+import numpy as np
+import pandas as pd
+import forecast
+from forecast import Forecast
+from solar_geometry import cos_zenith
+
+
+class IrradianceSource:
+    """
+    Base class of the weather inputs of a SolarPanel.
+
+    A source hands out a Forecast (times, GHI and temperature arrays) for a
+    location; panels interpolate from it on every tick.
+    """
+
+    def subscribe(self, latitude, longitude):
+        pass
+
+    def get_forecast(self, latitude, longitude, now):
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def get(self, latitude, longitude, now):
+        """Returns (ghi W/m², temperature °C) for a location at time now, or None if unavailable."""
+        weather = self.get_forecast(latitude, longitude, now)
+        if weather is None:
+            return None
+        return weather.interpolate(now)
+
+    def series(self, latitude, longitude, times):
+        """Returns (ghi, temperature) arrays over a whole time axis (datetime64 or epoch seconds)."""
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def coverage(self, latitude, longitude):
+        """Last time (epoch seconds) series() has data for, inf without an end, None without data."""
+        return float("inf")
+
+
+def to_seconds(times):
+    """Converts a time axis (datetime-like or numeric seconds) to float seconds."""
+    values = np.asarray(times)
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values.astype('datetime64[ns]').astype(np.int64) / 1e9
+    return values.astype(np.float64)
+
+
+class ClearSkySource(IrradianceSource):
+    """
+    Offline clear-sky irradiance (Haurwitz model) with a sinusoidal daily temperature.
+
+    Forecasts are computed per location and UTC day at a 15-minute step and
+    kept, so live panels interpolate from them like from an Open-Meteo forecast.
+    """
+
+    def __init__(self, mean_temperature=15, temperature_amplitude=5, step=900):
+        self.mean_temperature = mean_temperature
+        self.temperature_amplitude = temperature_amplitude
+        self.step = step
+        self.forecasts = {}
+
+    def series(self, latitude, longitude, times):
+        seconds = to_seconds(times)
+        cosz = cos_zenith(latitude, longitude, seconds)
+        with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+            ghi = np.where(cosz > 0, 1098 * cosz * np.exp(-0.057 / cosz), 0.0)
+        # Warmest around 15:00 local solar time
+        solar_hours = (seconds / 3600 + longitude / 15) % 24
+        temperature = self.mean_temperature + self.temperature_amplitude * np.cos((solar_hours - 15) * np.pi / 12)
+        return ghi, temperature
+
+    def get_forecast(self, latitude, longitude, now):
+        day = int(now // 86400)
+        key = (latitude, longitude, day)
+        weather = self.forecasts.get(key)
+        if weather is None:
+            times = np.arange(day * 86400, (day + 1) * 86400 + self.step, self.step, dtype=np.float64)
+            ghi, temperature = self.series(latitude, longitude, times)
+            weather = Forecast(times, ghi, temperature)
+            # Only the current day of each location is kept
+            self.forecasts = {k: v for k, v in self.forecasts.items() if k[2] >= day}
+            self.forecasts[key] = weather
+        return weather
+
+
+class ReplaySource(IrradianceSource):
+    """
+    Replays recorded GHI and temperature from a CSV or Parquet file.
+
+    The same recording is used for every location. With loop enabled, times
+    past the end of the recording wrap around to its start, so a year of data
+    can be replayed indefinitely.
+    """
+
+    def __init__(self, path, time_column="time", ghi_column="ghi", temperature_column="temperature", loop=True):
+        if path.endswith(".parquet"):
+            data = pd.read_parquet(path)
+        else:
+            data = pd.read_csv(path)
+        times = pd.to_datetime(data[time_column], utc=True)
+        times = times.dt.tz_localize(None).to_numpy()
+        self.forecast = Forecast(to_seconds(times),
+                                 data[ghi_column].to_numpy(dtype=np.float64),
+                                 data[temperature_column].to_numpy(dtype=np.float64))
+        self.loop = loop
+        self.start = self.forecast.times[0]
+        self.duration = self.forecast.times[-1] - self.start
+
+    def wrap(self, seconds):
+        if self.loop and self.duration > 0:
+            return self.start + (seconds - self.start) % self.duration
+        return seconds
+
+    def get_forecast(self, latitude, longitude, now):
+        return self.forecast
+
+    def coverage(self, latitude, longitude):
+        return float("inf") if self.loop else float(self.forecast.times[-1])
+
+    def get(self, latitude, longitude, now):
+        return self.forecast.interpolate(self.wrap(now))
+
+    def series(self, latitude, longitude, times):
+        seconds = self.wrap(to_seconds(times))
+        return (np.interp(seconds, self.forecast.times, self.forecast.ghi),
+                np.interp(seconds, self.forecast.times, self.forecast.temperature))
+
+
+def from_config(config):
+    """
+    Creates a source from a short description: "openmeteo", "clearsky" or
+    the path of a CSV/Parquet recording.
+    """
+    if config in (None, "", "openmeteo"):
+        return forecast.get_default_service()
+    if config == "clearsky":
+        return ClearSkySource()
+    return ReplaySource(config)
+
+
+default_source = None
+
+def get_default_source():
+    global default_source
+    if default_source is None:
+        default_source = from_config(os.environ.get("IRRADIANCE_SOURCE"))
+    return default_source
@@ -1,68 +1,98 @@
 from device import Device
-import threading
-import time
-import random
-import json
+import numpy as np
+import orjson
+import scenario
+import log
+
+logger = log.get_logger("load")
+
+# Rows of Load.phases, one column per phase
+VOLTAGE, LIMIT_MAX, LIMIT_MIN, CURRENT = range(4)
+PHASES = ("phase1", "phase2", "phase3")
 
 class Load(Device):
-    def __init__(self, current_limit=30, voltage=230, phase=1):
+    __slots__ = ("current_limit", "phases", "seed", "profile", "block", "blocks", "samples", "index", "dt")
+
+    def __init__(self, current_limit=30, voltage=230, phase=1, seed=None, profile=None, block=scenario.BLOCK):
         self.current_limit = current_limit
-        self.voltage = [voltage]*3
-        self.load_limit_max = [10]*3
-        self.load_limit_min = [0]*3
-        self.load_current = [0]*3
+        # Per-phase settings and currents, one row each
+        self.phases = np.zeros((4, 3))
+        self.phases[VOLTAGE] = voltage
+        self.phases[LIMIT_MAX] = 10
+        # Every block of samples gets its own Generator seeded from (seed, block
+        # number), so a load carries no generator state between blocks
+        self.seed = np.random.SeedSequence(seed).entropy
+        self.profile = scenario.from_config(profile)
+        self.block = block
+        self.blocks = 0
+        self.samples = None
+        self.index = 0
+        # Tick length the pre-drawn samples were generated for
+        self.dt = None
+
+    @property
+    def voltage(self):
+        return self.phases[VOLTAGE]
+
+    @property
+    def load_limit_max(self):
+        return self.phases[LIMIT_MAX]
+
+    @property
+    def load_limit_min(self):
+        return self.phases[LIMIT_MIN]
 
-        self.update_load_current_thread = threading.Thread(target=self.update_current_randomly)
-        self.update_load_current_thread.daemon = True
-        self.update_load_current_thread.start()
+    @property
+    def load_current(self):
+        return self.phases[CURRENT]
 
     def get_power(self):
-        return sum([self.voltage[i] * self.load_current[i] for i in range(3)])
+        phases = self.phases
+        return float(np.dot(phases[VOLTAGE], phases[CURRENT]))
 
-    def update_current_randomly(self):
-        while True:
-            self.load_current[0] = random.uniform(self.load_limit_min[0] * self.current_limit / 100, self.load_limit_max[0] * self.current_limit / 100)
-            self.load_current[1] = random.uniform(self.load_limit_min[1] * self.current_limit / 100, self.load_limit_max[1] * self.current_limit / 100)
-            self.load_current[2] = random.uniform(self.load_limit_min[2] * self.current_limit / 100, self.load_limit_max[2] * self.current_limit / 100)
-            time.sleep(1)
-    
-    def to_json(self):
+    def update(self, now, dt):
+        # A new block is also drawn when the tick length changes, e.g. after a catch-up tick
+        if self.samples is None or self.index >= len(self.samples) or dt != self.dt:
+            rng = np.random.default_rng([self.seed, self.blocks])
+            self.samples = self.profile.sample(self, rng, now, self.block, dt)
+            self.blocks += 1
+            self.index = 0
+            self.dt = dt
+        self.phases[CURRENT] = self.samples[self.index]
+        self.index += 1
+
+    def to_dict(self):
+        voltage, limit_max, limit_min, current = self.phases.tolist()
         data = {
-            "total_power": round(sum(self.load_current[i] * self.voltage[i] for i in range(3)), 3),
+            "total_power": round(sum(voltage[i] * current[i] for i in range(3)), 3),
             "current_limit": self.current_limit,
-            "phase1": {
-                "current": round(self.load_current[0], 3),
-                "voltage": round(self.voltage[0], 1),
-                "power": round(self.voltage[0] * self.load_current[0], 3),
-                "load_limit_max": self.load_limit_max[0],
-                "load_limit_min": self.load_limit_min[0],
-            },
-            "phase2": {
-                "current": round(self.load_current[1], 3),
-                "voltage": round(self.voltage[1], 1),
-                "power": round(self.voltage[1] * self.load_current[1], 3),
-                "load_limit_max": self.load_limit_max[1],
-                "load_limit_min": self.load_limit_min[1],
-            },
-            "phase3": {
-                "current": round(self.load_current[2], 3),
-                "voltage": round(self.voltage[2], 1),
-                "power": round(self.voltage[2] * self.load_current[2], 3),
-                "load_limit_max": self.load_limit_max[2],
-                "load_limit_min": self.load_limit_min[2],
-            },
         }
-        return json.dumps(data)
-    
+        for i, phase in enumerate(PHASES):
+            data[phase] = {
+                "current": round(current[i], 3),
+                "voltage": round(voltage[i], 1),
+                "power": round(voltage[i] * current[i], 3),
+                "load_limit_max": limit_max[i],
+                "load_limit_min": limit_min[i],
+            }
+        return data
+
+    def to_json(self):
+        return orjson.dumps(self.to_dict()).decode()
+
     def update_from_json(self, data):
         try:
-            print(data)
+            logger.debug("Updating load settings: %s", data)
             self.update_current_limit(data)
             self.update_phase(data, "phase1", 0)
             self.update_phase(data, "phase2", 1)
             self.update_phase(data, "phase3", 2)
+            if "profile" in data:
+                self.profile = scenario.from_config(data["profile"])
+            # Samples drawn with the old settings are discarded
+            self.samples = None
         except Exception as e:
-            print(e)
+            logger.warning("Invalid load settings %s: %s", data, e)
             return False
         return True
 
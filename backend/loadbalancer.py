@@ -0,0 +1,209 @@
+import numpy as np
+import orjson
+import log
+
+logger = log.get_logger("loadbalancer")
+
+# EV chargers (IEC 61851) cannot signal less than this current (A) without pausing the session
+EV_MIN_CURRENT = 6
+# Load balancing priority of charging the battery from the grid, below the charge points
+BATTERY_PRIORITY = 0
+ALL_PHASES = np.ones((1, 3), dtype=bool)
+
+
+def allocate(headroom, demand, phase_mask, priority, minimum, running, passes=3):
+    """
+    Shares the per-phase current headroom among controllable devices.
+
+    Devices are served by priority, highest first. Within a priority the
+    devices are admitted one by one at their minimum current if it fits on
+    all their phases, those that were running before the others so sessions
+    do not flap; a device that does not fit is skipped and the next one is
+    tried, so it never blocks devices on other phases. The rest of the
+    headroom is then shared equally (max-min fair) in a fixed number of
+    passes, each handing the share left over by devices that are satisfied
+    to the others. The sharing passes are vectorized over the devices, so a
+    call costs O(devices * (priorities + passes)).
+
+    Args:
+        headroom: Current (A) available per phase, shape (3,)
+        demand: Current (A per phase) each device would draw, shape (N,)
+        phase_mask: Phases each device draws from, bool (N, 3)
+        priority: Integer priority of each device, shape (N,)
+        minimum: Current (A) below which a device cannot run, shape (N,)
+        running: Whether each device was allocated current before, bool (N,)
+        passes: Passes sharing out the headroom
+
+    Returns:
+        Allocated current (A per phase) per device, shape (N,); 0 for devices
+        that did not fit
+    """
+    allocation = np.zeros(len(demand))
+    remaining = np.maximum(np.asarray(headroom, dtype=np.float64), 0)
+    wanting = demand > 0
+    for level in sorted(set(priority[wanting].tolist()), reverse=True):
+        members = np.flatnonzero(wanting & (priority == level))
+        members = np.concatenate([members[running[members]], members[~running[members]]])
+        masks = phase_mask[members]
+        floor = np.minimum(minimum[members], demand[members])
+        need = masks * floor[:, None]
+        fits = np.zeros(len(members), dtype=bool)
+        for index in range(len(members)):
+            if (need[index] <= remaining + 1e-9).all():
+                fits[index] = True
+                remaining = np.maximum(remaining - need[index], 0)
+        members, masks = members[fits], masks[fits]
+        allocation[members] = floor[fits]
+        for _ in range(passes):
+            want = demand[members] - allocation[members]
+            open_ = want > 1e-9
+            if not open_.any() or not remaining.any():
+                break
+            sharing = masks & open_[:, None]
+            share = remaining / np.maximum(sharing.sum(axis=0), 1)
+            grant = np.where(open_, np.minimum(want, np.where(sharing, share, np.inf).min(axis=1)), 0)
+            allocation[members] += grant
+            remaining = np.maximum(remaining - (masks * grant[:, None]).sum(axis=0), 0)
+    return allocation
+
+
+class LoadBalancer:
+    """
+    Keeps the grid current of every phase within the connection limit by
+    throttling the controllable devices of a site: the charge points of a
+    charging station and charging the battery from the grid.
+
+    It runs every tick after the load and the solar panel are updated and
+    before the controllable devices draw. The base current of each phase is
+    the load of this tick less the solar power the battery cannot absorb, so
+    it never overestimates the headroom: the battery charging from the sun
+    and discharging only lower the grid current. The headroom up to
+    PowerMeter.current_limit (less a margin) is shared among the devices with
+    allocate(). Charge points get the result as their allowance, the battery
+    as its grid charge limit; both apply to the same tick, so the limit holds
+    on every tick as long as the base load alone stays below it. Points
+    without a vehicle get no allowance, a vehicle that arrives during a tick
+    starts charging on the next one.
+    """
+
+    __slots__ = ("load", "power_meter", "inverter", "charging_station", "enabled", "margin", "battery_priority",
+                 "passes", "headroom", "allocation", "demand")
+
+    def __init__(self, load, power_meter, inverter, charging_station=None, enabled=True, margin=0,
+                 battery_priority=BATTERY_PRIORITY, passes=3):
+        """
+        Args:
+            load: Load of the site, the uncontrolled part of the grid current
+            power_meter: PowerMeter at the grid connection, its current_limit is the per-phase limit
+            inverter: Inverter of the battery
+            charging_station: ChargingStation or None
+            enabled: Whether limits are applied
+            margin: Current (A) kept free below the limit on every phase
+            battery_priority: Priority of grid charging, compared with ChargingStation.priority
+            passes: Passes of allocate()
+        """
+        self.load = load
+        self.power_meter = power_meter
+        self.inverter = inverter
+        self.charging_station = charging_station
+        self.enabled = enabled
+        self.margin = margin
+        self.battery_priority = battery_priority
+        self.passes = passes
+        self.headroom = np.zeros(3)
+        self.allocation = np.zeros(0)
+        self.demand = np.zeros(0)
+
+    def base_current(self):
+        """
+        Grid current per phase (A) of this tick before the controllable
+        devices draw: the load, less the solar power the battery cannot take.
+        """
+        battery = self.inverter.battery
+        solar_power = self.inverter.solar_panel.solar_power
+        if battery.state_of_charge < battery.capacity:
+            solar_power -= battery.max_charge_current * battery.volts
+        return self.load.load_current - max(solar_power, 0) / (3 * self.power_meter.voltage)
+
+    def update(self, now, dt):
+        if not self.enabled:
+            return
+        station = self.charging_station
+        grid_charging = self.inverter.is_charging_from_grid()
+        if not grid_charging:
+            # A limit left from an earlier grid charge would cap the next one before it is balanced
+            self.inverter.battery.grid_charge_limit = float("inf")
+        if not grid_charging and (station is None or not station.active):
+            if station is not None:
+                station.allowance[:] = 0
+            self.allocation = self.demand = np.zeros(0)
+            return
+        meter = self.power_meter
+        battery = self.inverter.battery
+        self.headroom = meter.current_limit - self.margin - self.base_current()
+
+        battery_demand = 0.0
+        if grid_charging:
+            power = battery.max_charge_current * battery.volts - self.inverter.solar_panel.solar_power
+            battery_demand = max(power, 0) / (3 * meter.voltage)
+        if station is not None:
+            demand = np.append(station.demand(), battery_demand)
+            phase_mask = np.concatenate([station.phase_mask, ALL_PHASES])
+            priority = np.append(station.priority, self.battery_priority)
+            minimum = np.append(np.full(len(station.occupied), float(EV_MIN_CURRENT)), 0)
+        else:
+            demand = np.array([battery_demand])
+            phase_mask = ALL_PHASES
+            priority = np.array([self.battery_priority])
+            minimum = np.zeros(1)
+        running = self.allocation > 0 if len(self.allocation) == len(demand) else np.zeros(len(demand), dtype=bool)
+        allocation = allocate(self.headroom, demand, phase_mask, priority, minimum, running, self.passes)
+        self.allocation = allocation
+        self.demand = demand
+
+        if station is not None:
+            points = allocation[:-1]
+            # A charger signals at least the minimum current, even to a vehicle drawing less
+            station.allowance[:] = np.where(points > 0, np.maximum(points, EV_MIN_CURRENT), 0)
+        if grid_charging:
+            battery.grid_charge_limit = allocation[-1] * 3 * meter.voltage / battery.volts
+
+    def to_dict(self):
+        allocation, demand = self.allocation, self.demand
+        return {
+            "enabled": self.enabled,
+            "current_limit": self.power_meter.current_limit,
+            "margin": self.margin,
+            "battery_priority": self.battery_priority,
+            "headroom": [round(value, 3) for value in self.headroom.tolist()],
+            "demand": round(float(demand.sum()), 3),
+            "allocated": round(float(allocation.sum()), 3),
+            "throttled": int(np.count_nonzero(allocation < demand - 1e-6)),
+        }
+
+    def to_json(self):
+        return orjson.dumps(self.to_dict()).decode()
+
+    def update_from_json(self, data):
+        try:
+            if "enabled" in data:
+                self.enabled = bool(data["enabled"])
+                if not self.enabled:
+                    self.release()
+            if "margin" in data:
+                self.margin = float(data["margin"])
+            if "battery_priority" in data:
+                self.battery_priority = int(data["battery_priority"])
+            if "passes" in data:
+                self.passes = int(data["passes"])
+        except (TypeError, ValueError) as e:
+            logger.warning("Invalid load balancer settings %s: %s", data, e)
+            return False
+        return True
+
+    def release(self):
+        """Lifts every limit set by the balancer."""
+        if self.charging_station is not None:
+            self.charging_station.allowance[:] = np.inf
+        self.inverter.battery.grid_charge_limit = float("inf")
+        self.allocation = self.demand = np.zeros(0)
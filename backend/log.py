@@ -0,0 +1,93 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+# Parent of every simulator logger, e.g. energysim.battery
+ROOT = "energysim"
+
+FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+listener = None
+setup_lock = threading.Lock()
+
+
+def get_logger(name):
+    """Returns the logger of a device or subsystem, e.g. get_logger("battery")."""
+    return logging.getLogger(f"{ROOT}.{name}")
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most burst records of the same message template through per
+    interval seconds, per logger. The next record that gets through reports
+    how many were suppressed. Errors are never suppressed.
+
+    Records are keyed on the unformatted message, so the check costs a dict
+    lookup and suppressed records are never formatted.
+    """
+
+    def __init__(self, interval=60, burst=5):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            start, count, suppressed = self.windows.get(key, (now, 0, 0))
+            if now - start >= self.interval:
+                start, count = now, 0
+            if count >= self.burst:
+                self.windows[key] = (start, count, suppressed + 1)
+                return False
+            self.windows[key] = (start, count + 1, 0)
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves formatting to the listener thread.
+
+    The stock handler formats every record on the calling thread so it can be
+    pickled; the queue never leaves the process here, so the tick threads only
+    pay for enqueueing the record.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup(level=None, interval=60, burst=5):
+    """
+    Routes the simulator loggers through a queue to a stderr writer thread.
+
+    The level defaults to the LOG_LEVEL environment variable (INFO). Calling
+    setup again only changes the level.
+    """
+    global listener
+    logger = logging.getLogger(ROOT)
+    logger.setLevel(level or os.environ.get("LOG_LEVEL", "INFO").upper())
+    with setup_lock:
+        if listener is not None:
+            return
+        records = queue.SimpleQueue()
+        handler = DeferredQueueHandler(records)
+        handler.addFilter(RateLimitFilter(interval, burst))
+        output = logging.StreamHandler()
+        output.setFormatter(logging.Formatter(FORMAT))
+        listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+        listener.start()
+        logger.addHandler(handler)
+        logger.propagate = False
+        atexit.register(listener.stop)
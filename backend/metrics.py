@@ -0,0 +1,205 @@
+import bisect
+import os
+import threading
+
+# Set METRICS=0 to turn instrumentation off; call sites check this flag before
+# taking any timestamp, so a disabled metric costs one attribute lookup
+enabled = os.environ.get("METRICS", "1").lower() not in ("0", "false", "no", "off")
+
+# Latency buckets (s), from 100 µs to 10 s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# All metrics of the process by name, rendered by render()
+registry = {}
+registry_lock = threading.Lock()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+class Metric:
+    """
+    Base class of a metric family, optionally split by label values.
+
+    A metric without labels has a single child whose update methods are bound
+    on the metric itself, so COUNTER.inc() costs the same as a labeled
+    child.inc(). Updates are not locked: every metric is updated from one
+    thread (the scheduler or the event loop) and read by render().
+    """
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.label_names:
+            self.bind(self.labels())
+        with registry_lock:
+            registry[name] = self
+
+    def bind(self, child):
+        pass
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """Returns the child for the given label values, creating it on first use."""
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def samples(self):
+        """Yields (suffix, labels, value) for every time series of the family."""
+        for values, child in list(self.children.items()):
+            for suffix, extra, value in child.samples():
+                yield suffix, tuple(zip(self.label_names, values)) + extra, value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield "", (), self.value
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing count, e.g. requests or bytes sent.
+
+    The family is named with a _total suffix (added if missing), as the text
+    format requires the TYPE line and the samples to use the same name.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        if not name.endswith("_total"):
+            name += "_total"
+        super().__init__(name, help, labels)
+
+    def bind(self, child):
+        self.inc = child.inc
+
+    def new_child(self):
+        return CounterChild()
+
+
+class GaugeChild:
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def samples(self):
+        yield "", (), self.function() if self.function is not None else self.value
+
+
+class Gauge(Metric):
+    """
+    Value that goes up and down, e.g. connected clients. With a function the
+    value is computed when the metrics are rendered instead of being tracked.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), function=None):
+        self.function = function
+        super().__init__(name, help, labels)
+
+    def bind(self, child):
+        self.set = child.set
+        self.inc = child.inc
+        self.dec = child.dec
+
+    def new_child(self):
+        return GaugeChild(self.function)
+
+
+class HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield "_bucket", (("le", format_value(bound)),), total
+        total += self.counts[-1]
+        yield "_bucket", (("le", "+Inf"),), total
+        yield "_sum", (), self.sum
+        yield "_count", (), total
+
+
+class Histogram(Metric):
+    """Distribution of observed values over fixed buckets, e.g. latencies in s."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels)
+
+    def bind(self, child):
+        self.observe = child.observe
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+
+def format_value(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+
+def render():
+    """Returns every registered metric in the Prometheus text exposition format."""
+    with registry_lock:
+        metrics = sorted(registry.values(), key=lambda metric: metric.name)
+    return "\n".join(metric.render() for metric in metrics) + "\n"
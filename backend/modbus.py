@@ -1,15 +1,126 @@
-import asyncio
+import struct
 import threading
+import time
+from pymodbus import FramerType
 from pymodbus.datastore import ModbusSlaveContext, ModbusSequentialDataBlock, ModbusServerContext
-from pymodbus.server.async_io import StartAsyncTcpServer
+from pymodbus.server.async_io import ModbusTcpServer
 from pymodbus.device import ModbusDeviceIdentification
+import eventloop
+import log
+import metrics
 
-#import logging
-#logging.basicConfig(level=logging.DEBUG)
+logger = log.get_logger("modbus")
 
-class Modbus:
-    def __init__(self, port, parameters):
+# Highest Modbus unit ID, 0 is reserved for broadcast
+MAX_UNIT_ID = 247
+
+PUBLISH_SECONDS = metrics.Histogram("modbus_publish_duration_seconds", "Time to encode and hand over a register snapshot")
+PUBLISHES = metrics.Counter("modbus_publishes", "Register snapshots published")
+
+
+class UnitContext(ModbusServerContext):
+    """
+    Server context hosting several slave contexts keyed by unit ID.
+
+    While a single slave is hosted it answers every unit ID, like the
+    single=True context a lone inverter used before.
+    """
+
+    def __init__(self):
+        super().__init__(slaves={}, single=False)
+
+    def __contains__(self, slave):
+        return len(self._slaves) == 1 or slave in self._slaves
+
+    def __getitem__(self, slave):
+        if len(self._slaves) == 1:
+            return next(iter(self._slaves.values()))
+        return super().__getitem__(slave)
+
+
+class ModbusTcpHost:
+    """
+    One Modbus TCP listener on the shared event loop, serving many units.
+
+    The constructor waits until the port is bound and raises OSError if it
+    cannot be.
+    """
+
+    def __init__(self, port, timeout=5):
         self.port = port
+        self.context = UnitContext()
+        self.server = None
+        if not eventloop.submit(self.listen()).result(timeout):
+            raise OSError(f"Cannot listen for Modbus TCP on port {port}")
+        logger.info("Modbus server listening on port %d", port)
+
+    async def listen(self):
+        self.server = ModbusTcpServer(self.context, FramerType.SOCKET, get_identity(), ("0.0.0.0", self.port))
+        return await self.server.listen()
+
+    def free_unit_id(self):
+        for unit_id in range(1, MAX_UNIT_ID + 1):
+            if unit_id not in self.context._slaves:
+                return unit_id
+        return None
+
+    def add(self, unit_id, store):
+        self.context[unit_id] = store
+
+    def remove(self, unit_id):
+        del self.context[unit_id]
+        if not self.context._slaves and self.server is not None:
+            eventloop.submit(self.server.shutdown()).result()
+            return True
+        return False
+
+
+hosts = {}
+hosts_lock = threading.Lock()
+
+def attach(store, port, unit_id=None, max_ports=16):
+    """
+    Hosts a slave context on the listener of port and returns (port, unit_id).
+
+    Without an explicit unit ID the first free one is used. When the ID is
+    taken (or all IDs are), or the port cannot be bound, the next port of the
+    range is tried.
+    """
+    with hosts_lock:
+        for candidate in range(port, port + max_ports):
+            host = hosts.get(candidate)
+            if host is None:
+                try:
+                    host = ModbusTcpHost(candidate)
+                except OSError as e:
+                    logger.warning("Skipping Modbus port %d: %s", candidate, e)
+                    continue
+                hosts[candidate] = host
+            free = host.free_unit_id() if unit_id is None else unit_id
+            if free is None or free in host.context._slaves:
+                continue
+            host.add(free, store)
+            return candidate, free
+    raise RuntimeError(f"No free Modbus unit ID {unit_id or ''} on ports {port}-{port + max_ports - 1}")
+
+def count_clients():
+    return sum(len(host.server.active_connections) for host in list(hosts.values()) if host.server is not None)
+
+def count_units():
+    return sum(len(host.context._slaves) for host in list(hosts.values()))
+
+metrics.Gauge("modbus_clients", "Connected Modbus TCP clients", function=count_clients)
+metrics.Gauge("modbus_units", "Hosted Modbus units", function=count_units)
+
+def detach(port, unit_id):
+    with hosts_lock:
+        host = hosts.get(port)
+        if host is not None and host.remove(unit_id):
+            del hosts[port]
+
+
+class Modbus:
+    def __init__(self, port, parameters, unit_id=None):
         self.parameters = parameters
         max_hr_address = 400
         max_ir_address = 400
@@ -27,78 +138,226 @@ class Modbus:
             elif item['function_code'] == 16 and item['address'] > max_fc16_address:
                 max_fc16_address = item['address'] + 10
 
-        print(f'max_hr_address: {max_hr_address}')
-        print(f'max_ir_address: {max_ir_address}')
-        print(f'max_fc6_address: {max_fc6_address}')
-        
+        logger.debug("Register block sizes: hr=%d ir=%d fc6=%d fc16=%d",
+                     max_hr_address, max_ir_address, max_fc6_address, max_fc16_address)
+
         store = ModbusSlaveContext(
-            di=ModbusSequentialDataBlock(0, [0]*100),
-            co=ModbusSequentialDataBlock(0, [0]*100),
-            hr=ModbusSequentialDataBlock(0, [0]*max_hr_address),
-            ir=ModbusSequentialDataBlock(0, [0]*max_ir_address))
-        store.register(6, 'fc6', ModbusSequentialDataBlock(0, [0]*max_fc6_address))  # Data block for function code 6
-        store.register(16, 'fc16', ModbusSequentialDataBlock(0, [0]*max_fc16_address))  # Data block for function code 6
-
-        self.context = ModbusServerContext(slaves=store, single=True)
-
-        async def run_server():
-            await StartAsyncTcpServer(
-                context=self.context,
-                identity=self.get_identity,
-                address=("0.0.0.0", port)
-            )
-
-        self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.loop)
-        self.loop.create_task(run_server())
-        self.server_thread = threading.Thread(target=self.loop.run_forever)
-        self.server_thread.daemon = True
-        self.server_thread.start()
+            di=SnapshotDataBlock(0, [0]*100),
+            co=SnapshotDataBlock(0, [0]*100),
+            hr=SnapshotDataBlock(0, [0]*max_hr_address),
+            ir=SnapshotDataBlock(0, [0]*max_ir_address))
+        store.register(6, 'fc6', SnapshotDataBlock(0, [0]*max_fc6_address))  # Data block for function code 6
+        store.register(16, 'fc16', SnapshotDataBlock(0, [0]*max_fc16_address))  # Data block for function code 6
+
+        self.store = store
+        self.registers = compile_parameters(parameters)
+        self.write_plans = {}
+        set_default_values(self.store, parameters)
+
+        self.loop = eventloop.get_event_loop()
+        self.port, self.unit_id = attach(store, port, unit_id)
+        self.context = hosts[self.port].context
 
     def stop_modbus_server(self):
-        self.loop.call_soon_threadsafe(self.loop.stop)
-        self.server_thread.join()
+        detach(self.port, self.unit_id)
         return True
-    
-    def get_identity(self):
-        identity = ModbusDeviceIdentification()
-        identity.VendorName = 'pymodbus'
-        identity.ProductCode = 'PM'
-        identity.VendorUrl = 'http://github.com/riptideio/pymodbus/'
-        identity.ProductName = 'pymodbus Server'
-        identity.ModelName = 'pymodbus Server'
-        identity.MajorMinorRevision = '1.0'
-        return identity
 
     def find_parameter_by_name(self, name):
-        for param in self.parameters:
-            if param['name'] == name:
-                return param
-        return None
+        register = self.registers.get(name)
+        return register.param if register else None
 
     def get_modbus_server_parameter_value(self, name):
-        param = self.find_parameter_by_name(name)
-        if param:
-            fc, address = param['function_code'], param['address']
-            count = determine_count(param)
-            values = self.context[0].getValues(fc, address, count=count)
-            return parse_values(param, values)
+        register = self.registers.get(name)
+        if register:
+            values = self.store.getValues(register.function_code, register.address, count=register.count)
+            return register.decode(values)
         return None
 
     def set_modbus_server_parameter_value(self, name, value):
-        if isinstance(value, float):
-            value = int(value)
-        param = self.find_parameter_by_name(name)
-        if param:
-            if value >= 0:
-                values = [value]
-            else:
-                values = [0xFFFF + value + 1]
-            set_default_values(self.context[0], [param])
-            self.context[0].setValues(param['function_code'], param['address'], values)
+        register = self.registers.get(name)
+        if register:
+            self.store.setValues(register.function_code, register.address, register.encode(value))
             return True
         return False
 
+    def get_write_plan(self, names):
+        """
+        Groups the registers of a snapshot into runs of contiguous addresses.
+
+        The plan only depends on which parameters are written, so it is built
+        once per set of names and reused for every snapshot.
+        """
+        key = tuple(names)
+        plan = self.write_plans.get(key)
+        if plan is None:
+            registers = sorted((self.registers[name] for name in names if name in self.registers),
+                               key=lambda register: (register.function_code, register.address))
+            plan = []
+            for register in registers:
+                run = plan[-1] if plan else None
+                if run and run[0] == register.function_code and run[1] + run[2] == register.address:
+                    run[2] += register.count
+                    run[3].append(register)
+                else:
+                    plan.append([register.function_code, register.address, register.count, [register]])
+            self.write_plans[key] = plan
+        return plan
+
+    def set_modbus_server_parameter_values(self, values):
+        """
+        Publishes a snapshot {name: value} atomically. Unknown names are ignored.
+
+        The registers are encoded into back buffers of the affected data blocks
+        on the calling thread, then all the blocks are swapped at once on the
+        server event loop. A client therefore sees either the previous or the
+        new snapshot as a whole, never a multi-register value or a set of
+        related values coming from different ticks.
+        """
+        started = time.perf_counter() if metrics.enabled else None
+        store = self.store
+        updates = {}
+        for function_code, address, _, registers in self.get_write_plan(values.keys()):
+            words = []
+            for register in registers:
+                words += register.encode(values[register.name])
+            block = store.store[store.decode(function_code)]
+            if not store.zero_mode:
+                address += 1
+            updates.setdefault(block, []).append((address, words))
+        pending = [(block, block.prepare(runs), runs) for block, runs in updates.items()]
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(swap_buffers, pending)
+        else:
+            swap_buffers(pending)
+        if started is not None:
+            PUBLISH_SECONDS.observe(time.perf_counter() - started)
+            PUBLISHES.inc()
+
+
+def get_identity():
+    identity = ModbusDeviceIdentification()
+    identity.VendorName = 'pymodbus'
+    identity.ProductCode = 'PM'
+    identity.VendorUrl = 'http://github.com/riptideio/pymodbus/'
+    identity.ProductName = 'pymodbus Server'
+    identity.ModelName = 'pymodbus Server'
+    identity.MajorMinorRevision = '1.0'
+    return identity
+
+
+class SnapshotDataBlock(ModbusSequentialDataBlock):
+    """
+    Sequential data block whose value list is never modified in place.
+
+    Every write builds a new list and replaces the reference, so a reader
+    slicing self.values always works on one consistent version. The writes
+    counter lets a prepared back buffer detect that it went stale.
+    """
+
+    def __init__(self, address, values):
+        super().__init__(address, values)
+        self.writes = 0
+
+    def setValues(self, address, values):
+        if not isinstance(values, list):
+            values = [values]
+        start = address - self.address
+        buffer = self.values.copy()
+        buffer[start : start + len(values)] = values
+        self.values = buffer
+        self.writes += 1
+
+    def prepare(self, runs):
+        """Builds a back buffer with the runs [(address, words)] applied."""
+        buffer = self.values.copy()
+        for address, words in runs:
+            start = address - self.address
+            buffer[start : start + len(words)] = words
+        return self.writes, buffer
+
+
+def swap_buffers(pending):
+    """Makes prepared back buffers visible. Runs on the server event loop."""
+    for block, (writes, buffer), runs in pending:
+        if block.writes != writes:
+            # A client wrote to the block since the back buffer was built
+            writes, buffer = block.prepare(runs)
+        block.values = buffer
+        block.writes += 1
+
+
+def encode_u16(value):
+    return [int(value) & 0xFFFF]
+
+def encode_u32(value):
+    value = int(value) & 0xFFFFFFFF
+    return [value & 0xFFFF, value >> 16]
+
+def encode_u64(value):
+    value = int(value) & 0xFFFFFFFFFFFFFFFF
+    return [value & 0xFFFF, (value >> 16) & 0xFFFF, (value >> 32) & 0xFFFF, value >> 48]
+
+def encode_float(value):
+    return list(struct.unpack('>HH', struct.pack('>f', value)))
+
+def decode_unsigned(words):
+    value = 0
+    for shift, word in enumerate(words):
+        value |= word << (16 * shift)
+    return value
+
+def decode_signed(words):
+    value = decode_unsigned(words)
+    bits = 16 * len(words)
+    return value - (1 << bits) if value >> (bits - 1) else value
+
+def decode_float(words):
+    return struct.unpack('>f', struct.pack('>HH', *words))[0]
+
+def decode_string(words):
+    return ''.join(chr(word) for word in words).rstrip('\x00')
+
+# Integers are stored with the least significant word first, floats as big-endian IEEE 754
+ENCODERS = {
+    'u16': (encode_u16, decode_unsigned),
+    'i16': (encode_u16, decode_signed),
+    'u32': (encode_u32, decode_unsigned),
+    'i32': (encode_u32, decode_signed),
+    'u64': (encode_u64, decode_unsigned),
+    'i64': (encode_u64, decode_signed),
+    'float': (encode_float, decode_float),
+}
+
+
+class Register:
+    """A parameter compiled to its address, word count and encoder."""
+
+    def __init__(self, param):
+        self.param = param
+        self.name = param['name']
+        self.function_code = param['function_code']
+        self.address = param['address']
+        self.count = determine_count(param)
+        if param['type'] == 'string':
+            size = self.count
+            self.encode = lambda value: [ord(c) for c in value.ljust(size, '\x00')[:size]]
+            self.decode = decode_string
+        else:
+            self.encode, self.decode = ENCODERS[param['type']]
+
+
+def compile_parameters(parameters):
+    """Compiles a parameter map; raises ValueError if two parameters share a register."""
+    registers = {param['name']: Register(param) for param in parameters}
+    owners = {}
+    for register in registers.values():
+        for address in range(register.address, register.address + register.count):
+            owner = owners.setdefault((register.function_code, address), register.name)
+            if owner != register.name:
+                raise ValueError(f"Parameters {owner} and {register.name} overlap at register "
+                                 f"{address} of function code {register.function_code}")
+    return registers
+
 def determine_count(param):
     if param['type'] == 'string':
         return param['size']
@@ -110,20 +369,5 @@ def determine_count(param):
 
 def set_default_values(store, parameters):
     for param in parameters:
-        fc = param['function_code']
-        address = param['address']
-        default = param['default']
-        if '16' in param:
-            store.setValues(fc, address, [default])
-        elif '32' in param['type']:
-            store.setValues(fc, address, [default & 0xFFFF, (default >> 16) & 0xFFFF])
-        elif param['type'] == 'u64':
-            store.setValues(fc, address, [default & 0xFFFF, (default >> 16) & 0xFFFF, (default >> 32) & 0xFFFF, (default >> 48) & 0xFFFF])
-        elif param['type'] == 'float':
-            import struct
-            packed = struct.pack('>f', default)
-            unpacked = struct.unpack('>HH', packed)
-            store.setValues(fc, address, list(unpacked))
-        elif param['type'] == 'string':
-            values = [ord(c) for c in default.ljust(param['size'], '\x00')]
-            store.setValues(fc, address, values)
\ No newline at end of file
+        register = Register(param)
+        store.setValues(register.function_code, register.address, register.encode(param['default']))
@@ -0,0 +1,321 @@
+import time
+import numpy as np
+import log
+import metrics
+
+logger = log.get_logger("optimizer")
+
+SOLVE_SECONDS = metrics.Histogram("optimizer_solve_duration_seconds", "Time to solve or re-solve a battery schedule")
+SOLVED_SLOTS = metrics.Counter("optimizer_solved_slots", "Schedule slots recomputed by the optimizer")
+REUSED_SLOTS = metrics.Counter("optimizer_reused_slots", "Schedule slots kept from the previous solve")
+
+# Length (s) of a schedule slot; the battery power is held for a slot
+SLOT = 900
+# Steps the battery energy range is divided into
+LEVELS = 60
+# Cost (per kWh) of moving energy through the battery, so it stays idle when cycling does not pay
+CYCLE_COST = 0.01
+# Simulation time (s) between re-solves of the live schedule
+RESOLVE_INTERVAL = 900
+# Inputs that differ by less than this count as unchanged in a warm re-solve
+TOLERANCE = 1e-6
+
+# Night (22:00-06:00 UTC) and day import prices and the feed-in price, per kWh
+IMPORT_PRICES = (0.22,) * 6 + (0.32,) * 16 + (0.22,) * 2
+EXPORT_PRICE = 0.08
+
+
+class Tariff:
+    """Import price per UTC hour of the day and a flat export price, per kWh."""
+
+    def __init__(self, import_prices=IMPORT_PRICES, export_price=EXPORT_PRICE):
+        self.import_prices = np.broadcast_to(np.asarray(import_prices, dtype=np.float64), (24,)).copy()
+        self.export_price = export_price
+
+    def prices(self, times):
+        """Returns the import and export price arrays at the given epoch seconds."""
+        hours = (np.asarray(times, dtype=np.float64) % 86400 // 3600).astype(np.int64)
+        return self.import_prices[hours], np.full(len(hours), float(self.export_price))
+
+    def to_dict(self):
+        return {"import_prices": self.import_prices.tolist(), "export_price": self.export_price}
+
+    def update_from_json(self, data):
+        """Applies new prices; returns False and keeps the old ones if they are invalid."""
+        try:
+            import_prices = self.import_prices
+            if "import_prices" in data:
+                prices = np.asarray(data["import_prices"], dtype=np.float64)
+                if prices.ndim > 1 or prices.size not in (1, 24):
+                    raise ValueError(f"expected one price or 24 hourly prices, got {prices.size}")
+                import_prices = np.broadcast_to(prices, (24,)).copy()
+            export_price = float(data.get("export_price", self.export_price))
+            if not (np.isfinite(import_prices).all() and np.isfinite(export_price)):
+                raise ValueError("prices must be finite")
+        except (TypeError, ValueError) as e:
+            logger.warning("Invalid tariff %s: %s", data, e)
+            return False
+        self.import_prices = import_prices
+        self.export_price = export_price
+        return True
+
+
+DEFAULT_TARIFF = Tariff()
+
+
+def battery_steps(capacity, max_charge_power, max_discharge_power, slot=SLOT, levels=LEVELS):
+    """
+    Discretizes a battery.
+
+    Returns:
+        Energy (Wh) of one level and the level changes the battery can make
+        in one slot, from the largest discharge to the largest charge
+    """
+    step_energy = capacity / levels
+    hours = slot / 3600
+    charge = int(max_charge_power * hours / step_energy + 1e-9)
+    discharge = int(max_discharge_power * hours / step_energy + 1e-9)
+    return step_energy, np.arange(-discharge, charge + 1)
+
+
+def slot_costs(net, import_price, export_price, battery_power, hours, cycle_cost=CYCLE_COST):
+    """
+    Cost of every candidate battery power in every slot.
+
+    Args:
+        net: Forecast load minus PV power (W) per slot, shape (T,)
+        import_price: Import price per kWh per slot, shape (T,)
+        export_price: Export price per kWh per slot, shape (T,)
+        battery_power: Candidate battery powers (W, positive when charging), shape (A,)
+        hours: Slot length (h)
+
+    Returns:
+        Costs of shape (T, A)
+    """
+    grid = (net[:, None] + battery_power) * (hours / 1000)
+    return (np.maximum(grid, 0) * import_price[:, None] - np.maximum(-grid, 0) * export_price[:, None]
+            + np.abs(battery_power) * (hours / 1000 * cycle_cost))
+
+
+def backward(costs, values, policy, transitions, penalty):
+    """
+    Backward induction over the slots of costs, from the last to the first.
+
+    values[t] is the lowest cost from slot t to the end per energy level; its
+    last row holds the terminal values on entry. policy[t] gets the index of
+    the best action per level. transitions[s, a] is the level action a leads
+    to from level s, penalty is inf where that level is out of range. Every
+    slot is one gather and one argmin over all levels and actions.
+    """
+    rows = np.arange(values.shape[1])
+    for t in range(len(costs) - 1, -1, -1):
+        q = values[t + 1][transitions] + penalty + costs[t]
+        best = q.argmin(axis=1)
+        policy[t] = best
+        values[t] = q[rows, best]
+
+
+class DispatchOptimizer:
+    """
+    Battery schedule that minimizes the energy bill over a forecast horizon.
+
+    The battery energy is divided into levels and the horizon into slots of
+    SLOT seconds. Backward dynamic programming gives the best battery power
+    for every slot and level, so the schedule is a policy: the battery
+    follows it from whatever energy it actually has at the start of a slot.
+
+    Slots are aligned to absolute time and the live horizon ends at a fixed
+    time (the end of the next UTC day, or earlier where the forecast ends),
+    so a re-solve can keep the value function from the last slot whose inputs
+    changed to the end and only recompute the slots before it.
+    """
+
+    def __init__(self, slot=SLOT, levels=LEVELS, cycle_cost=CYCLE_COST, phase=None, seed=None):
+        """
+        Args:
+            slot: Slot length (s)
+            levels: Steps the battery energy range is divided into
+            cycle_cost: Cost per kWh moved through the battery
+            phase: Offset (s) of the live re-solves within RESOLVE_INTERVAL, drawn from seed if None
+            seed: Seed of the phase, e.g. the seed of the site
+        """
+        self.slot = slot
+        self.levels = levels
+        self.cycle_cost = cycle_cost
+        self.key = None
+        self.step_energy = None
+        self.steps = None
+        self.battery_power = None
+        self.transitions = None
+        self.penalty = None
+        # Slot start times, inputs (net power, import and export price), values and policy of the last solve
+        self.times = None
+        self.inputs = None
+        self.values = None
+        self.policy = None
+        # Spreads the re-solves of many sites over the interval, reproducibly for a seeded site
+        self.phase = np.random.default_rng(seed).uniform(0, RESOLVE_INTERVAL) if phase is None else phase
+        self.planned_at = None
+        self.held = None
+        self.solved_slots = 0
+        self.solve_time = 0.0
+
+    def configure(self, capacity, max_charge_power, max_discharge_power):
+        key = (capacity, max_charge_power, max_discharge_power, self.slot, self.levels, self.cycle_cost)
+        if key == self.key:
+            return
+        self.key = key
+        self.step_energy, self.steps = battery_steps(capacity, max_charge_power, max_discharge_power,
+                                                     self.slot, self.levels)
+        self.battery_power = self.steps * self.step_energy * 3600 / self.slot
+        transitions = np.arange(self.levels + 1)[:, None] + self.steps
+        self.penalty = np.where((transitions < 0) | (transitions > self.levels), np.inf, 0)
+        self.transitions = np.clip(transitions, 0, self.levels)
+        # A different battery invalidates the previous solve
+        self.times = None
+
+    def solve(self, times, net, import_price, export_price, capacity, max_charge_power, max_discharge_power):
+        """
+        Computes the schedule for the slots starting at times.
+
+        If the previous solve ends at the same time, the slots after the
+        last one whose inputs changed are taken over from it.
+
+        Args:
+            times: Slot start times (epoch seconds), multiples of the slot length apart
+            net: Forecast load minus PV power (W) per slot
+            import_price: Import price per kWh per slot
+            export_price: Export price per kWh per slot
+            capacity: Battery capacity (Wh)
+            max_charge_power: Battery charge limit (W)
+            max_discharge_power: Battery discharge limit (W)
+
+        Returns:
+            Number of slots recomputed
+        """
+        started = time.perf_counter()
+        self.configure(capacity, max_charge_power, max_discharge_power)
+        times = np.asarray(times, dtype=np.float64)
+        inputs = np.column_stack([net, import_price, export_price]).astype(np.float64)
+        count = len(times)
+        values = np.empty((count + 1, self.levels + 1))
+        policy = np.empty((count, self.levels + 1), dtype=np.int16)
+        # Energy left at the end of the horizon is worth what it would sell for
+        values[count] = -np.arange(self.levels + 1) * self.step_energy / 1000 * (inputs[-1, 2] if count else 0)
+        stop = count
+        previous = self.times
+        if previous is not None and count and len(previous) and previous[-1] == times[-1]:
+            offset = int(round((times[0] - previous[0]) / self.slot))
+            if offset >= 0 and len(previous) - offset == count:
+                changed = np.flatnonzero(np.abs(self.inputs[offset:] - inputs).max(axis=1) > TOLERANCE)
+                stop = int(changed[-1]) + 1 if len(changed) else 0
+                values[stop:count] = self.values[offset + stop:offset + count]
+                policy[stop:] = self.policy[offset + stop:]
+        if stop:
+            costs = slot_costs(inputs[:stop, 0], inputs[:stop, 1], inputs[:stop, 2], self.battery_power,
+                               self.slot / 3600, self.cycle_cost)
+            backward(costs, values[:stop + 1], policy[:stop], self.transitions, self.penalty)
+        self.times, self.inputs, self.values, self.policy = times, inputs, values, policy
+        self.held = None
+        self.solved_slots = stop
+        self.solve_time = time.perf_counter() - started
+        if metrics.enabled:
+            SOLVE_SECONDS.observe(self.solve_time)
+            SOLVED_SLOTS.inc(stop)
+            REUSED_SLOTS.inc(count - stop)
+        return stop
+
+    def plan(self, now, solar_panel, load, battery, tariff=DEFAULT_TARIFF):
+        """
+        Solves for the slots from the one of now to the end of the next UTC
+        day, with the PV forecast of the panel's irradiance source, the
+        expected power of the load profile and the tariff. The horizon stops
+        early where the forecast ends, instead of planning on its last value.
+
+        Returns:
+            Number of slots recomputed, None without a forecast covering now
+            (the previous schedule is kept)
+        """
+        self.planned_at = now
+        source = solar_panel.irradiance_source
+        coverage = source.coverage(solar_panel.latitude, solar_panel.longitude)
+        if coverage is None:
+            return None
+        start = now - now % self.slot
+        times = np.arange(start, (now // 86400 + 2) * 86400, self.slot, dtype=np.float64)
+        middle = times + self.slot / 2
+        covered = middle <= coverage
+        times, middle = times[covered], middle[covered]
+        weather = source.series(solar_panel.latitude, solar_panel.longitude, middle) if len(times) else None
+        if weather is None:
+            return None
+        ghi, temperature = weather
+        solar_power = solar_panel.calculate_pv_power(solar_panel.plane_of_array(ghi, middle), temperature)
+        load_power = load.profile.expected_power(load, middle) if load is not None else np.zeros(len(times))
+        import_price, export_price = tariff.prices(middle)
+        return self.solve(times, load_power - solar_power, import_price, export_price, battery.capacity,
+                          battery.max_charge_current * battery.volts, battery.max_discharge_current * battery.volts)
+
+    def needs_plan(self, now):
+        """
+        True before the first plan and once per RESOLVE_INTERVAL, at the
+        phase of this optimizer so the sites of a fleet do not all re-solve on
+        the same tick. A plan that failed or had no forecast is retried at the
+        next interval too, so an offline source is not asked on every tick.
+        """
+        if self.planned_at is None:
+            return True
+        return (now - self.phase) // RESOLVE_INTERVAL != (self.planned_at - self.phase) // RESOLVE_INTERVAL
+
+    def power(self, now, energy):
+        """
+        Battery power (W, positive when charging) planned for the slot of
+        now, for a battery holding energy (Wh) when the slot is entered. The
+        power is then held for the rest of the slot. None outside the schedule.
+        """
+        if self.times is None or not len(self.times):
+            return None
+        t = int((now - self.times[0]) // self.slot)
+        if t < 0 or t >= len(self.times):
+            return None
+        held = self.held
+        if held is not None and held[0] == t:
+            return held[1]
+        level = min(max(int(round(energy / self.step_energy)), 0), self.levels)
+        power = float(self.battery_power[self.policy[t, level]])
+        self.held = (t, power)
+        return power
+
+    def held_power(self):
+        """Battery power (W) held for the current slot, 0 before power() was called in it."""
+        return 0.0 if self.held is None else self.held[1]
+
+    def schedule(self, energy):
+        """
+        Follows the policy through the horizon from a battery energy (Wh).
+
+        Returns:
+            Planned battery power (W) per slot and the energy (Wh) at the start of each slot
+        """
+        level = min(max(int(round(energy / self.step_energy)), 0), self.levels)
+        count = len(self.times)
+        actions = np.empty(count, dtype=np.int64)
+        levels = np.empty(count, dtype=np.int64)
+        policy = self.policy.tolist()
+        steps = self.steps.tolist()
+        for t in range(count):
+            levels[t] = level
+            action = policy[t][level]
+            actions[t] = action
+            level += steps[action]
+        return self.battery_power[actions], levels * self.step_energy
+
+    def to_dict(self):
+        return {
+            "slot": self.slot,
+            "slots": 0 if self.times is None else len(self.times),
+            "horizon_end": None if self.times is None or not len(self.times) else float(self.times[-1] + self.slot),
+            "planned_at": self.planned_at,
+            "solved_slots": self.solved_slots,
+            "solve_ms": round(self.solve_time * 1000, 3),
+        }
@@ -0,0 +1,156 @@
+import time
+
+CRC16_POLY = 0xA001  # CRC-16/ARC (reflected 0x8005), as required by DSMR
+
+
+def make_crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ CRC16_POLY if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+CRC16_TABLE = make_crc16_table()
+
+
+def crc16(data, crc=0):
+    """Table-driven CRC16 of data (bytes), continuing from state crc."""
+    table = CRC16_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+class StaticSegment:
+    """
+    A constant part of the telegram with its CRC contribution precomputed.
+
+    The CRC is linear, so crc16(data, state) == crc16(data) ^ crc16(zeros, state),
+    and the second term is linear in state. It is tabulated per state byte, so
+    the segment is folded into a running CRC with two lookups whatever its length.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.crc = crc16(data)
+        zeros = bytes(len(data))
+        basis = [crc16(zeros, 1 << bit) for bit in range(16)]
+        self.low = make_shift_table(basis[:8])
+        self.high = make_shift_table(basis[8:])
+
+    def update(self, crc):
+        return self.crc ^ self.low[crc & 0xFF] ^ self.high[crc >> 8]
+
+
+def make_shift_table(basis):
+    table = [0] * 256
+    for value in range(1, 256):
+        lowest = value & -value
+        table[value] = table[value ^ lowest] ^ basis[lowest.bit_length() - 1]
+    return table
+
+
+class TelegramTemplate:
+    """
+    Pre-encoded telegram with placeholders for the dynamic fields.
+
+    parts is a list of str (constant text) and field names; build() patches
+    the formatted fields in and only runs the byte-wise CRC over them.
+    """
+
+    def __init__(self, parts, trailer):
+        self.segments = []
+        text = ""
+        for part in parts:
+            if isinstance(part, Field):
+                if text:
+                    self.segments.append(StaticSegment(text.encode('latin-1')))
+                    text = ""
+                self.segments.append(part)
+            else:
+                text += part
+        if text:
+            self.segments.append(StaticSegment(text.encode('latin-1')))
+        self.trailer = trailer
+
+    def build(self, values):
+        chunks = []
+        crc = 0
+        for segment in self.segments:
+            if isinstance(segment, StaticSegment):
+                chunks.append(segment.data)
+                crc = segment.update(crc)
+            else:
+                data = segment.format(values).encode('latin-1')
+                chunks.append(data)
+                crc = crc16(data, crc)
+        chunks.append(f"{crc:04X}\r\n".encode('latin-1'))
+        chunks.append(self.trailer)
+        return b"".join(chunks)
+
+
+class Field:
+    def __init__(self, name, spec=""):
+        self.name = name
+        self.spec = spec
+
+    def format(self, values):
+        return format(values[self.name], self.spec)
+
+
+P1_TEMPLATE = TelegramTemplate([
+    "/FLU5\\253967035_D\r\n",
+    "0-0:96.1.4(50221)\r\n",
+    "1-0:94.32.1(400)\r\n",
+    "0-0:96.1.1(3153414733323030303135363939)\r\n",
+    "0-0:96.1.2()\r\n",
+    "0-0:1.0.0(", Field("timestamp"), ")\r\n",
+    "1-0:1.8.1(", Field("imported_energy", "010.3f"), "*kWh)\r\n",  # Tariff 1 import
+    "1-0:1.8.2(003603.478*kWh)\r\n",
+    "1-0:2.8.1(", Field("exported_energy", "010.3f"), "*kWh)\r\n",  # Tariff 1 export
+    "1-0:2.8.2(001235.763*kWh)\r\n",
+    "0-0:96.14.0(0001)\r\n",
+    "1-0:1.4.0(01.880*kW)\r\n",
+    "1-0:1.6.0(241010204500S)(07.416*kW)\r\n",
+    "0-0:98.1.0(10)(1-0:1.6.0)(1-0:1.6.0)(230901000000S)(230801000000S)(00.000*kW)(240201000000W)(240122083000W)(04.198*kW)(240301000000W)(240223110000W)(04.147*kW)(240401000000S)(240329190000W)(06.511*kW)(240501000000S)(240422063000S)(06.341*kW)(240601000000S)(240503091500S)(04.379*kW)(240701000000S)(240611231500S)(04.524*kW)(240801000000S)(240724220000S)(05.871*kW)(240901000000S)(240811060000S)(06.227*kW)(241001000000S)(240925191500S)(07.529*kW)\r\n",
+    "1-0:1.7.0(", Field("power", "06.3f"), "*kW)\r\n", # Power in kW
+    "1-0:2.7.0(", Field("injected_power", "06.3f"), "*kW)\r\n", # Injected Power in kW
+    "1-0:21.7.0(", Field("power1", "06.3f"), "*kW)\r\n",  # Per phase power and injected power in kW
+    "1-0:41.7.0(", Field("power2", "06.3f"), "*kW)\r\n",
+    "1-0:61.7.0(", Field("power3", "06.3f"), "*kW)\r\n",
+    "1-0:22.7.0(", Field("injected_power1", "06.3f"), "*kW)\r\n",
+    "1-0:42.7.0(", Field("injected_power2", "06.3f"), "*kW)\r\n",
+    "1-0:62.7.0(", Field("injected_power3", "06.3f"), "*kW)\r\n",
+    "1-0:32.7.0(", Field("voltage1", "06.1f"), "*V)\r\n",
+    "1-0:52.7.0(", Field("voltage2", "06.1f"), "*V)\r\n",
+    "1-0:72.7.0(", Field("voltage3", "06.1f"), "*V)\r\n",
+    "1-0:31.7.0(", Field("current1", "06.2f"), "*A)\r\n",
+    "1-0:51.7.0(", Field("current2", "06.2f"), "*A)\r\n",
+    "1-0:71.7.0(", Field("current3", "06.2f"), "*A)\r\n",
+    "0-0:96.3.10(1)\r\n",
+    "0-0:17.0.0(99.999*kW)\r\n",
+    "1-0:31.4.0(999.99*A)\r\n",
+    "0-1:96.3.10(0)\r\n",
+    "0-2:96.3.10(0)\r\n",
+    "0-3:96.3.10(0)\r\n",
+    "0-4:96.3.10(0)\r\n",
+    "0-0:96.13.0()\r\n",
+    "0-1:24.1.0(003)\r\n",
+    "0-1:96.1.1(3753414733373030303031373739)\r\n",
+    "0-1:96.1.2(000000000000000000)\r\n",
+    "0-1:24.4.0(1)\r\n",
+    "0-1:24.2.3(241018091251S)(00465.041*m3)\r\n",
+    "0-2:24.1.0(007)\r\n",
+    "0-2:96.1.1(3853455430303030323135353431)\r\n",
+    "0-2:96.1.2(000000000000000000)\r\n",
+    "0-2:24.2.1(241018091335S)(00044.988*m3)\r\n!",
+], b"\255")
+
+
+def p1_timestamp(now=None):
+    """DSMR timestamp YYMMDDhhmmss with the W(inter)/S(ummer) suffix, in local time."""
+    local = time.localtime(now)
+    suffix = 'W' if local.tm_mon in [1, 2, 3, 10, 11, 12] else 'S'
+    return time.strftime('%y%m%d%H%M%S', local) + suffix
@@ -0,0 +1,177 @@
+import queue
+import threading
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+from inverter import SolarUseMode, BatteryUseMode
+
+SOLAR_USE_MODES = list(SolarUseMode)
+BATTERY_USE_MODES = list(BatteryUseMode)
+
+# Column name and dtype of one recorded tick
+COLUMNS = [
+    ("time", np.float64),
+    ("solar_power", np.float32),
+    ("battery_current", np.float32),
+    ("state_of_charge", np.float32),
+    ("grid_power", np.float32),
+    ("load_power_l1", np.float32),
+    ("load_power_l2", np.float32),
+    ("load_power_l3", np.float32),
+    ("solar_use_mode", np.uint8),
+    ("battery_use_mode", np.uint8),
+]
+
+
+class Recorder:
+    """
+    Records every tick of an EnergyManager to a Parquet or Arrow IPC file.
+
+    Ticks are appended to preallocated NumPy column chunks. A full chunk is
+    handed to a background thread that writes it as one Parquet row group (or
+    Arrow record batch), so the tick thread never waits on compression or
+    disk I/O unless the writer falls several chunks behind. Only a few chunks are
+    in memory, whatever the length of the run.
+
+    The file is created by the constructor, so a bad path raises right away.
+    If writing fails later, the error is kept in self.error, further ticks are
+    dropped (counted in self.dropped) and close() raises it.
+
+    With a list of site ids, one recorder is shared by those sites (e.g. a
+    fleet shard) and every row gets a dictionary-encoded "site" column, so a
+    shard needs one writer thread and one set of chunks whatever its size.
+    All the sites must record from the same thread.
+    """
+
+    def __init__(self, path, format="parquet", chunk_size=65536, buffers=3, sites=None):
+        if format not in ("parquet", "arrow"):
+            raise ValueError(f"Unknown recording format {format}")
+        self.path = path
+        self.format = format
+        self.chunk_size = chunk_size
+        self.sites = None if sites is None else [str(site) for site in sites]
+        fields = ([pa.field("time", pa.timestamp("ms", tz="UTC"))]
+                  + [pa.field(name, pa.from_numpy_dtype(dtype)) for name, dtype in COLUMNS[1:-2]]
+                  + [pa.field(name, pa.dictionary(pa.uint8(), pa.string())) for name, _ in COLUMNS[-2:]])
+        columns = list(COLUMNS)
+        if self.sites is not None:
+            fields.append(pa.field("site", pa.dictionary(pa.uint32(), pa.string())))
+            columns.append(("site", np.uint32))
+        self.schema = pa.schema(fields)
+        self.free = queue.Queue()
+        for _ in range(buffers):
+            self.free.put({name: np.empty(chunk_size, dtype=dtype) for name, dtype in columns})
+        self.full = queue.Queue()
+        self.chunk = self.free.get()
+        self.size = 0
+        self.rows = 0
+        self.dropped = 0
+        self.error = None
+        if format == "parquet":
+            self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+        else:
+            self.writer = ipc.new_file(path, self.schema)
+        self.writer_thread = threading.Thread(target=self.write_chunks)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def record(self, energy_manager, site=0):
+        """Appends the state of energy_manager; site is its index in the sites of a shared recorder."""
+        if self.error is not None:
+            self.dropped += 1
+            return
+        chunk = self.chunk
+        i = self.size
+        battery = energy_manager.battery
+        load = energy_manager.load
+        inverter = energy_manager.inverter
+        chunk["time"][i] = energy_manager.sim_time
+        chunk["solar_power"][i] = energy_manager.solar_panel.solar_power
+        chunk["battery_current"][i] = battery.current
+        chunk["state_of_charge"][i] = battery.state_of_charge * 100 / battery.capacity
+        chunk["grid_power"][i] = energy_manager.power_meter.get_power()
+        chunk["load_power_l1"][i] = load.voltage[0] * load.load_current[0]
+        chunk["load_power_l2"][i] = load.voltage[1] * load.load_current[1]
+        chunk["load_power_l3"][i] = load.voltage[2] * load.load_current[2]
+        chunk["solar_use_mode"][i] = SOLAR_USE_MODES.index(inverter.solar_use_mode)
+        chunk["battery_use_mode"][i] = BATTERY_USE_MODES.index(inverter.battery_use_mode)
+        if self.sites is not None:
+            chunk["site"][i] = site
+        self.size += 1
+        if self.size == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.size:
+            self.full.put((self.chunk, self.size))
+            self.rows += self.size
+            self.chunk = self.free.get()
+            self.size = 0
+
+    def to_batch(self, chunk, size):
+        times = (chunk["time"][:size] * 1000).astype(np.int64)
+        arrays = [pa.array(times, type=pa.timestamp("ms", tz="UTC"))]
+        arrays += [pa.array(chunk[name][:size]) for name, _ in COLUMNS[1:-2]]
+        arrays.append(pa.DictionaryArray.from_arrays(
+            pa.array(chunk["solar_use_mode"][:size]), [mode.name for mode in SOLAR_USE_MODES]))
+        arrays.append(pa.DictionaryArray.from_arrays(
+            pa.array(chunk["battery_use_mode"][:size]), [mode.name for mode in BATTERY_USE_MODES]))
+        if self.sites is not None:
+            arrays.append(pa.DictionaryArray.from_arrays(pa.array(chunk["site"][:size]), self.sites))
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def write_chunks(self):
+        writer = self.writer
+        while True:
+            item = self.full.get()
+            if item is None:
+                break
+            chunk, size = item
+            if self.error is None:
+                try:
+                    batch = self.to_batch(chunk, size)
+                    if self.format == "parquet":
+                        writer.write_batch(batch, row_group_size=size)
+                    else:
+                        writer.write_batch(batch)
+                except Exception as e:
+                    self.error = e
+            # The arrays above may share memory with the chunk, reuse it only now. Chunks keep coming
+            # back after an error too, so the tick thread never waits for a free one forever.
+            self.free.put(chunk)
+        try:
+            writer.close()
+        except Exception as e:
+            self.error = self.error or e
+
+    def close(self):
+        self.flush()
+        self.full.put(None)
+        self.writer_thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def open_run(path, columns=None, site=None):
+    """
+    Opens a finished recording as a pyarrow Table.
+
+    Parquet files are decoded, but only the given columns (all if None).
+    Arrow files are memory mapped without a copy, so only the pages of the
+    columns that are used are read from disk. With a site id only the rows
+    of that site of a shared recording are returned.
+    """
+    if path.endswith(".parquet"):
+        if columns is not None and site is not None:
+            columns = list(columns)
+            read = columns if "site" in columns else columns + ["site"]
+        else:
+            read = columns
+        table = pq.read_table(path, columns=read, memory_map=True)
+    else:
+        table = ipc.open_file(pa.memory_map(path, "r")).read_all()
+    if site is not None:
+        table = table.filter(pc.equal(table["site"].cast(pa.string()), str(site)))
+    return table if columns is None else table.select(columns)
@@ -0,0 +1,251 @@
+import os
+import numpy as np
+import pandas as pd
+from irradiance import to_seconds
+
+# Samples generated at once by a Load, i.e. one hour of ticks at 1 s
+BLOCK = 3600
+
+# Relative household demand per hour of the day, weekdays and weekends
+# (shape of the BDEW H0 standard load profile)
+HOUSEHOLD_WEEKDAY = np.array([
+    0.55, 0.45, 0.40, 0.38, 0.38, 0.42, 0.62, 0.90, 0.95, 0.90, 0.88, 0.92,
+    1.05, 1.00, 0.90, 0.85, 0.88, 1.00, 1.25, 1.45, 1.50, 1.35, 1.10, 0.78])
+HOUSEHOLD_WEEKEND = np.array([
+    0.62, 0.50, 0.43, 0.40, 0.39, 0.40, 0.45, 0.60, 0.85, 1.05, 1.15, 1.25,
+    1.35, 1.25, 1.05, 0.95, 0.95, 1.05, 1.25, 1.42, 1.45, 1.32, 1.12, 0.82])
+
+# Share of the household load on each phase
+PHASE_SHARES = np.array([0.4, 0.35, 0.25])
+
+# name: (power in W, duration in s, events per day, phase, first hour, last hour)
+APPLIANCES = {
+    "kettle": (2000, 180, 3, 0, 6, 22),
+    "washing_machine": (2000, 5400, 0.5, 1, 8, 20),
+    "dishwasher": (1800, 3600, 0.8, 2, 12, 23),
+    "oven": (2500, 2700, 0.6, 0, 11, 20),
+    "fridge": (120, 900, 48, 2, 0, 24),
+}
+
+
+# Profile types from_config understands, besides the path of a trace
+PROFILES = ("uniform", "household", "appliances", "household+appliances", "replay")
+# Files ReplayProfile can read
+REPLAY_EXTENSIONS = (".csv", ".parquet")
+
+
+class LoadProfile:
+    """
+    Generates per-phase load currents as NumPy arrays.
+
+    sample() returns an (n, 3) array of currents in A for the n ticks of dt
+    seconds starting at start. All randomness comes from the Generator that
+    is passed in, so a profile is reproducible from the seed of its Load.
+    """
+
+    def sample(self, load, rng, start, n, dt):
+        raise NotImplementedError
+
+    def expected_power(self, load, times):
+        """Expected total power (W) at the given epoch seconds, used as the load forecast."""
+        raise NotImplementedError
+
+
+class UniformProfile(LoadProfile):
+    """Uniform currents between load_limit_min and load_limit_max of the current limit."""
+
+    def sample(self, load, rng, start, n, dt):
+        low = np.asarray(load.load_limit_min, dtype=np.float64) * load.current_limit / 100
+        high = np.asarray(load.load_limit_max, dtype=np.float64) * load.current_limit / 100
+        return low + rng.random((n, 3)) * (high - low)
+
+    def expected_power(self, load, times):
+        low = np.asarray(load.load_limit_min, dtype=np.float64) * load.current_limit / 100
+        high = np.asarray(load.load_limit_max, dtype=np.float64) * load.current_limit / 100
+        return np.full(len(times), float(np.dot((low + high) / 2, np.asarray(load.voltage, dtype=np.float64))))
+
+
+class HouseholdProfile(LoadProfile):
+    """
+    Standard household profile scaled to an annual consumption, with
+    log-normal noise per sample.
+    """
+
+    def __init__(self, annual_energy=3500, noise=0.3, phase_shares=PHASE_SHARES):
+        self.mean_power = annual_energy * 1000 / 8760
+        self.noise = noise
+        self.phase_shares = np.asarray(phase_shares, dtype=np.float64)
+        self.weekday = HOUSEHOLD_WEEKDAY / HOUSEHOLD_WEEKDAY.mean()
+        self.weekend = HOUSEHOLD_WEEKEND / HOUSEHOLD_WEEKEND.mean()
+
+    def power(self, times):
+        """Expected household power (W) at the given epoch seconds."""
+        hours = (times % 86400) / 3600
+        weekend = ((times // 86400 + 3) % 7) >= 5
+        hour_points = np.arange(25)
+        weekday = np.interp(hours, hour_points, np.append(self.weekday, self.weekday[0]))
+        weekend_power = np.interp(hours, hour_points, np.append(self.weekend, self.weekend[0]))
+        return self.mean_power * np.where(weekend, weekend_power, weekday)
+
+    def expected_power(self, load, times):
+        return self.power(np.asarray(times, dtype=np.float64)) * self.phase_shares.sum()
+
+    def sample(self, load, rng, start, n, dt):
+        times = start + np.arange(n) * dt
+        power = self.power(times)[:, None] * self.phase_shares
+        if self.noise:
+            power *= rng.lognormal(-self.noise**2 / 2, self.noise, (n, 3))
+        return power / np.asarray(load.voltage, dtype=np.float64)
+
+
+class ApplianceProfile(LoadProfile):
+    """
+    Appliance switching events: each appliance starts a Poisson number of
+    runs per day at uniform times within its hours of use. Runs that are
+    still on at the end of a block carry over into the next one.
+    """
+
+    def __init__(self, appliances=APPLIANCES):
+        self.appliances = list(appliances.values())
+        self.carry = []
+
+    def sample(self, load, rng, start, n, dt):
+        steps = np.zeros((n + 1, 3))
+        carry = []
+        for phase, watts, remaining in self.carry:
+            steps[0, phase] += watts
+            steps[min(remaining, n), phase] -= watts
+            if remaining > n:
+                carry.append((phase, watts, remaining - n))
+
+        # Runs are drawn for every day the block touches and only those that
+        # start inside it are kept, which thins the daily Poisson process to
+        # the block without any state beyond the carried runs
+        day_start = start - start % 86400
+        days = int((start + n * dt - day_start) // 86400) + 1
+        for watts, duration, per_day, phase, first_hour, last_hour in self.appliances:
+            counts = rng.poisson(per_day, days)
+            day = np.repeat(np.arange(days), counts)
+            begin = day_start + day * 86400 + rng.uniform(first_hour, last_hour, len(day)) * 3600
+            first = np.ceil((begin - start) / dt).astype(np.int64)
+            first = first[(first >= 0) & (first < n)]
+            last = first + max(int(round(duration / dt)), 1)
+            np.add.at(steps[:, phase], first, watts)
+            np.add.at(steps[:, phase], np.minimum(last, n), -watts)
+            carry.extend((phase, watts, end - n) for end in last[last > n].tolist())
+        self.carry = carry
+        return np.cumsum(steps[:n], axis=0) / np.asarray(load.voltage, dtype=np.float64)
+
+    def expected_power(self, load, times):
+        hours = (np.asarray(times, dtype=np.float64) % 86400) / 3600
+        power = np.zeros(len(hours))
+        for watts, duration, per_day, phase, first_hour, last_hour in self.appliances:
+            # Daily energy of the appliance spread over its hours of use
+            within = (hours >= first_hour) & (hours < last_hour)
+            power += within * (watts * duration * per_day / ((last_hour - first_hour) * 3600))
+        return power
+
+
+class CombinedProfile(LoadProfile):
+    """Sum of several profiles, e.g. a household base load plus appliance events."""
+
+    def __init__(self, *profiles):
+        self.profiles = profiles
+
+    def sample(self, load, rng, start, n, dt):
+        return sum(profile.sample(load, rng, start, n, dt) for profile in self.profiles)
+
+    def expected_power(self, load, times):
+        return sum(profile.expected_power(load, times) for profile in self.profiles)
+
+
+class ReplayProfile(LoadProfile):
+    """
+    Replays a recorded per-phase power trace (W) from a CSV or Parquet file,
+    e.g. a run written by the Recorder. With loop enabled the trace repeats.
+    """
+
+    def __init__(self, path, time_column="time", power_columns=("load_power_l1", "load_power_l2", "load_power_l3"), loop=True):
+        if path.endswith(".parquet"):
+            data = pd.read_parquet(path)
+        else:
+            data = pd.read_csv(path)
+        times = pd.to_datetime(data[time_column], utc=True)
+        self.times = to_seconds(times.dt.tz_localize(None).to_numpy())
+        self.power = data[list(power_columns)].to_numpy(dtype=np.float64)
+        self.loop = loop
+        self.duration = self.times[-1] - self.times[0]
+
+    def sample(self, load, rng, start, n, dt):
+        times = start + np.arange(n) * dt
+        if self.loop and self.duration > 0:
+            times = self.times[0] + (times - self.times[0]) % self.duration
+        power = np.column_stack([np.interp(times, self.times, self.power[:, phase]) for phase in range(3)])
+        return power / np.asarray(load.voltage, dtype=np.float64)
+
+    def expected_power(self, load, times):
+        times = np.asarray(times, dtype=np.float64)
+        if self.loop and self.duration > 0:
+            times = self.times[0] + (times - self.times[0]) % self.duration
+        return np.interp(times, self.times, self.power.sum(axis=1))
+
+
+def from_config(config):
+    """
+    Creates a profile from a short description: "uniform", "household",
+    "appliances", "household+appliances", the path of a recorded trace, or a
+    dict with a "type" key and the keyword arguments of that profile.
+    """
+    if config is None:
+        return UniformProfile()
+    if isinstance(config, str):
+        config = {"type": config}
+    config = dict(config)
+    kind = config.pop("type", "uniform")
+    if kind == "uniform":
+        return UniformProfile()
+    if kind == "household":
+        return HouseholdProfile(**config)
+    if kind == "appliances":
+        return ApplianceProfile(**config)
+    if kind == "household+appliances":
+        return CombinedProfile(HouseholdProfile(**config), ApplianceProfile())
+    if kind == "replay":
+        return ReplayProfile(**config)
+    if kind.endswith(REPLAY_EXTENSIONS) or os.path.isfile(kind):
+        return ReplayProfile(kind, **config)
+    raise ValueError(f"Unknown load profile {kind!r}, expected one of {', '.join(PROFILES)} or the path of a "
+                     f"{' or '.join(REPLAY_EXTENSIONS)} trace")
+
+
+def generate_traces(config, count, start, n, dt=1, seed=None, voltage=230):
+    """
+    Generates count independent load traces of n samples for batch runs.
+
+    Each trace gets its own Generator spawned from seed, so trace i is the same
+    for a given seed no matter how many traces are generated or in which
+    process.
+
+    Returns:
+        Array of shape (count, n, 3) with the per-phase currents in A
+    """
+    load = TraceSettings(voltage)
+    traces = np.empty((count, n, 3))
+    for i, sequence in enumerate(np.random.SeedSequence(seed).spawn(count)):
+        traces[i] = from_config(config).sample(load, np.random.default_rng(sequence), start, n, dt)
+    return traces
+
+
+def trace_power(traces, voltage=230):
+    """Total load power (W) of traces, for batch.simulate."""
+    return traces.sum(axis=-1) * voltage
+
+
+class TraceSettings:
+    """Default Load limits, for generating traces without a Load."""
+
+    def __init__(self, voltage=230):
+        self.current_limit = 30
+        self.voltage = [voltage]*3
+        self.load_limit_max = [10]*3
+        self.load_limit_min = [0]*3
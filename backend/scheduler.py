@@ -0,0 +1,134 @@
+import math
+import threading
+import time
+import log
+import metrics
+
+logger = log.get_logger("scheduler")
+
+TICK_SECONDS = metrics.Histogram("scheduler_tick_duration_seconds", "Time spent advancing all sites by one tick")
+TICK_LATENESS = metrics.Histogram("scheduler_tick_lateness_seconds", "Delay of the start of a tick behind its deadline")
+TICK_DRIFT = metrics.Gauge("scheduler_tick_drift_seconds", "Lateness of the latest tick")
+TICKS = metrics.Counter("scheduler_ticks", "Ticks run")
+SKIPPED_TICKS = metrics.Counter("scheduler_skipped_ticks", "Ticks dropped when a scheduler fell too far behind")
+TICK_ERRORS = metrics.Counter("scheduler_tick_errors", "Site ticks that raised an exception")
+
+# Shortest wall time (s) between two ticks of an accelerated clock
+MIN_TICK_PERIOD = 0.01
+# Fastest simulated clock, an hour per second of wall time
+MAX_TIME_SCALE = 3600
+
+
+class Scheduler:
+    """
+    Drives every registered site from a single simulation clock.
+
+    One thread advances all sites by a fixed step (tick_interval seconds) per
+    tick. Deadlines are computed from a monotonic start time, so the clock does
+    not drift with the time spent inside a tick. If ticks run late the missed
+    steps are caught up, so simulated time always advances in whole steps.
+    A site whose tick raises is logged and skipped for that tick, so it cannot
+    stop the clock of the other sites.
+
+    With a time_scale above 1 simulated time runs that many times faster than
+    wall time, see set_time_scale().
+    """
+
+    def __init__(self, tick_interval=1, max_catch_up=10, time_scale=1):
+        self.tick_interval = tick_interval
+        self.max_catch_up = max_catch_up
+        self.set_time_scale(time_scale)
+        self.sites = []
+        self.tick_count = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def set_time_scale(self, time_scale):
+        """
+        Sets how many simulated seconds pass per second of wall time.
+
+        Ticks keep their step of tick_interval simulated seconds and come
+        time_scale times as often, but no closer than MIN_TICK_PERIOD; beyond
+        that the step grows instead. Can be called while the clock runs.
+
+        A live forecast only covers the next days; once an accelerated clock
+        runs past it, the solar input holds the last forecast value.
+
+        Raises ValueError unless 0 < time_scale <= MAX_TIME_SCALE.
+        """
+        if not (math.isfinite(time_scale) and 0 < time_scale <= MAX_TIME_SCALE):
+            raise ValueError(f"time_scale must be positive and at most {MAX_TIME_SCALE}, got {time_scale}")
+        period = max(self.tick_interval / time_scale, min(MIN_TICK_PERIOD, self.tick_interval))
+        self.time_scale = time_scale
+        # Wall time between ticks and simulated seconds per tick, swapped together
+        self.pace = (period, period * time_scale)
+
+    def add(self, site):
+        with self.lock:
+            self.sites.append(site)
+
+    def remove(self, site):
+        with self.lock:
+            if site in self.sites:
+                self.sites.remove(site)
+
+    def step(self):
+        with self.lock:
+            sites = list(self.sites)
+        started = time.perf_counter() if metrics.enabled else None
+        dt = self.pace[1]
+        for site in sites:
+            try:
+                site.tick(dt)
+            except Exception as e:
+                # Warnings are rate limited, a site failing on every tick does not flood the log
+                logger.warning("Tick of %r failed: %s", site, e, exc_info=True)
+                if metrics.enabled:
+                    TICK_ERRORS.inc()
+        self.tick_count += 1
+        if started is not None:
+            TICK_SECONDS.observe(time.perf_counter() - started)
+            TICKS.inc()
+
+    def run(self, ticks=None):
+        """Advance the clock as fast as possible, without waiting for wall time."""
+        count = 0
+        while ticks is None or count < ticks:
+            if self.stop_event.is_set():
+                break
+            self.step()
+            count += 1
+
+    def run_forever(self):
+        deadline = time.monotonic()
+        while not self.stop_event.is_set():
+            if metrics.enabled:
+                lateness = time.monotonic() - deadline
+                TICK_LATENESS.observe(max(lateness, 0))
+                TICK_DRIFT.set(lateness)
+            self.step()
+            period = self.pace[0]
+            deadline += period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                self.stop_event.wait(delay)
+            elif -delay > self.max_catch_up * period:
+                # Too far behind (e.g. the host was suspended), resynchronize
+                if metrics.enabled:
+                    SKIPPED_TICKS.inc(int(-delay // period))
+                deadline = time.monotonic()
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
@@ -1,33 +1,150 @@
-import threading
-import socket
+import asyncio
 import time
-import json
-import random
+import numpy as np
+import orjson
+import eventloop
+import log
+import metrics
+from p1 import P1_TEMPLATE, p1_timestamp
 
+# Bytes a client may have queued before telegrams are dropped for it
+HIGH_WATER = 64 * 1024
+# Consecutive dropped telegrams after which a stalled client is disconnected
+MAX_DROPPED = 30
+
+CLIENTS = metrics.Gauge("broadcast_clients", "Connected clients", ("server",))
+SENT_BYTES = metrics.Counter("broadcast_sent_bytes", "Bytes written to clients", ("server",))
+SENT_PAYLOADS = metrics.Counter("broadcast_sent_payloads", "Payloads written to clients", ("server",))
+DROPPED_PAYLOADS = metrics.Counter("broadcast_dropped_payloads", "Payloads skipped for slow clients", ("server",))
+DISCONNECTS = metrics.Counter("broadcast_slow_disconnects", "Clients disconnected for not reading", ("server",))
+BROADCAST_SECONDS = metrics.Histogram("broadcast_duration_seconds", "Time to build and write one payload to all clients", ("server",))
+
+
+class BroadcastServer:
+    """
+    TCP server sending the same payload to every connected client.
+
+    The payload is built once per interval and written to each client in a
+    single write. A client that does not read fast enough is skipped while
+    its send buffer is above HIGH_WATER and disconnected after MAX_DROPPED
+    skipped payloads, so it never delays the others.
+    """
+
+    def __init__(self, name, port, build_payload, interval):
+        self.name = name
+        self.port = port
+        self.build_payload = build_payload
+        self.interval = interval
+        self.clients = {}
+        self.server = None
+        self.logger = log.get_logger(name.lower())
+        self.client_count = CLIENTS.labels(name)
+        self.sent_bytes = SENT_BYTES.labels(name)
+        self.sent_payloads = SENT_PAYLOADS.labels(name)
+        self.dropped_payloads = DROPPED_PAYLOADS.labels(name)
+        self.disconnects = DISCONNECTS.labels(name)
+        self.broadcast_seconds = BROADCAST_SECONDS.labels(name)
+        self.future = eventloop.submit(self.serve())
+
+    async def serve(self):
+        try:
+            self.server = await asyncio.start_server(self.handle_client, "0.0.0.0", self.port)
+            self.logger.info("%s server listening on port %d", self.name, self.port)
+        except OSError as e:
+            self.logger.error("Error starting %s server: %s", self.name, e)
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while True:
+            if self.clients:
+                started = time.perf_counter() if metrics.enabled else None
+                self.broadcast(self.build_payload())
+                if started is not None:
+                    self.broadcast_seconds.observe(time.perf_counter() - started)
+            deadline += self.interval
+            await asyncio.sleep(max(0, deadline - loop.time()))
+
+    async def handle_client(self, reader, writer):
+        address = writer.get_extra_info("peername")
+        self.logger.info("Accepted connection from %s", address)
+        self.clients[writer] = 0
+        self.client_count.set(len(self.clients))
+        try:
+            # Clients only listen, wait for them to hang up
+            while await reader.read(1024):
+                pass
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            self.logger.info("Connection with %s lost", address)
+            self.clients.pop(writer, None)
+            self.client_count.set(len(self.clients))
+            writer.close()
+
+    def broadcast(self, payload):
+        sent = dropped = disconnected = 0
+        for writer in list(self.clients):
+            if writer.is_closing():
+                self.clients.pop(writer, None)
+            elif writer.transport.get_write_buffer_size() > HIGH_WATER:
+                dropped += 1
+                self.clients[writer] += 1
+                if self.clients[writer] >= MAX_DROPPED:
+                    disconnected += 1
+                    self.clients.pop(writer, None)
+                    writer.close()
+            else:
+                sent += 1
+                self.clients[writer] = 0
+                writer.write(payload)
+        if metrics.enabled:
+            self.sent_payloads.inc(sent)
+            self.sent_bytes.inc(sent * len(payload))
+            self.dropped_payloads.inc(dropped)
+            self.disconnects.inc(disconnected)
+        self.client_count.set(len(self.clients))
+
+    def stop(self):
+        async def close():
+            self.future.cancel()
+            if self.server is not None:
+                self.server.close()
+            for writer in list(self.clients):
+                writer.close()
+        eventloop.submit(close()).result()
 
-# Set logging level to WARNING to suppress DEBUG logs
 
 class PowerMeter:
-    def __init__(self, current_limit=30, power_meter_cfg=None):
-        print("PowerMeter init")
+    __slots__ = ("current_limit", "inverter_power", "current", "injected_power", "voltage", "port", "rtu_port",
+                 "p1_server", "rtu_server", "time", "imported_energy", "exported_energy", "phase_currents")
+
+    def __init__(self, current_limit=30, power_meter_cfg=None, serve=True):
         self.current_limit = current_limit
         self.inverter_power = 0
         self.current = 0
+        # Grid current per phase (A), positive when importing
+        self.phase_currents = np.zeros(3)
         self.injected_power = 1000
+        # Simulation time of the last update, None until the first tick (wall time is used then)
+        self.time = None
+        # Tariff 1 meter readings (kWh), starting from those of the recorded telegram
+        self.imported_energy = 1870.825
+        self.exported_energy = 2898.216
         if power_meter_cfg:
             self.voltage = power_meter_cfg['voltage']
             self.port = power_meter_cfg['port']
+            self.rtu_port = power_meter_cfg.get('rtu_port', 8764)
         else:
             self.voltage = 230
             self.port = 8765
-        
-        self.broadcast_thread = threading.Thread(target=self.start_tcp_server)
-        self.broadcast_thread.daemon = False
-        self.broadcast_thread.start()
+            self.rtu_port = 8764
 
-        self.modbus_rtu_task = threading.Thread(target=self.start_rtu_server)
-        self.modbus_rtu_task.daemon = False
-        self.modbus_rtu_task.start()
+        if serve:
+            self.start_servers()
+
+    def start_servers(self):
+        self.p1_server = BroadcastServer("P1", self.port, self.get_p1_data_1, 1)
+        self.rtu_server = BroadcastServer("RTU", self.rtu_port, lambda: b"test", 10)
 
     def add_device(self, device):
         self.devices.append(device)
@@ -49,8 +166,25 @@ class PowerMeter:
 
     def set_voltage(self, voltage):
         self.voltage = voltage
-        
-    def to_json(self):
+
+    def update(self, load, inverter, now=None, dt=0, charging_station=None):
+        power = load.get_power()
+        phase_currents = load.load_current
+        if charging_station is not None and charging_station.power:
+            power += charging_station.power
+            phase_currents = phase_currents + charging_station.phase_current
+        self.current = power / self.voltage
+        self.inverter_power = inverter.get_power()
+        # The inverter feeds in symmetrically on all three phases
+        self.phase_currents = phase_currents - self.inverter_power / (3 * self.voltage)
+        self.time = now
+        power = self.get_power()
+        if power > 0:
+            self.imported_energy += power * dt / 3600000
+        else:
+            self.exported_energy -= power * dt / 3600000
+
+    def to_dict(self):
         data = {
             "current_limit": self.current_limit,
             "current": round(self.current, 3),
@@ -58,18 +192,28 @@ class PowerMeter:
             "power": round(self.get_power(), 3) if self.get_power() > 0 else 0,
             "injected_power": -round(self.get_power(), 3) if self.get_power() < 0 else 0,
         }
-        return json.dumps(data)
+        for i, current in enumerate(self.phase_currents.tolist()):
+            data[f"phase{i + 1}"] = {"current": round(current, 3)}
+        return data
+
+    def to_json(self):
+        return orjson.dumps(self.to_dict()).decode()
 
     def update_from_json(self, data):
         try:
+            if "voltage" in data and not (isinstance(data["voltage"], (int, float)) and data["voltage"] > 0):
+                log.get_logger("powermeter").warning("Invalid voltage %s, must be positive", data["voltage"])
+                return False
             if "current_limit" in data:
                 self.current_limit = data["current_limit"]
             if "voltage" in data:
                 self.voltage = data["voltage"]
             if "injected_power" in data:
                 self.injected_power = data["injected_power"]
-        except json.JSONDecodeError as e:
-            print(f"Error decoding JSON: {e}")
+        except orjson.JSONDecodeError as e:
+            log.get_logger("powermeter").warning("Error decoding JSON: %s", e)
+            return False
+        return True
 
     def get_p1_data(self):
         data = [f"/FLU5\\253769484_A\r\n",
@@ -107,117 +251,31 @@ class PowerMeter:
         return data
 
     def get_p1_data_1(self):
-        is_winter_time = time.localtime().tm_mon in [1, 2, 3, 10, 11, 12]
+        """Returns the current P1 telegram as bytes, CRC included."""
         power = 0
         injected_power = 0
         if self.get_power() > 0:
             power = self.get_power()
         else:
             injected_power = -self.get_power()
-            
-        time_suffix = 'W' if is_winter_time else 'S'
-        data = [f"/FLU5\\253967035_D\r\n",
-                "0-0:96.1.4(50221)\r\n",
-                "1-0:94.32.1(400)\r\n",
-                "0-0:96.1.1(3153414733323030303135363939)\r\n",
-                "0-0:96.1.2()\r\n",
-                f"0-0:1.0.0({time.strftime('%y%m%d%H%M%S')}{time_suffix})\r\n",
-                "1-0:1.8.1(001870.825*kWh)\r\n",
-                "1-0:1.8.2(003603.478*kWh)\r\n",
-                "1-0:2.8.1(002898.216*kWh)\r\n",
-                "1-0:2.8.2(001235.763*kWh)\r\n",
-                "0-0:96.14.0(0001)\r\n",
-                "1-0:1.4.0(01.880*kW)\r\n",
-                "1-0:1.6.0(241010204500S)(07.416*kW)\r\n",
-                "0-0:98.1.0(10)(1-0:1.6.0)(1-0:1.6.0)(230901000000S)(230801000000S)(00.000*kW)(240201000000W)(240122083000W)(04.198*kW)(240301000000W)(240223110000W)(04.147*kW)(240401000000S)(240329190000W)(06.511*kW)(240501000000S)(240422063000S)(06.341*kW)(240601000000S)(240503091500S)(04.379*kW)(240701000000S)(240611231500S)(04.524*kW)(240801000000S)(240724220000S)(05.871*kW)(240901000000S)(240811060000S)(06.227*kW)(241001000000S)(240925191500S)(07.529*kW)\r\n",
-                f"1-0:1.7.0({(power / 1000):06.3f}*kW)\r\n", # Power in kW
-                f"1-0:2.7.0({(injected_power / 1000):06.3f}*kW)\r\n", # Injected Power in kW
-                "1-0:21.7.0(00.310*kW)\r\n",
-                "1-0:41.7.0(00.584*kW)\r\n",
-                "1-0:61.7.0(00.094*kW)\r\n",
-                "1-0:22.7.0(00.000*kW)\r\n",
-                "1-0:42.7.0(00.000*kW)\r\n",
-                "1-0:62.7.0(00.000*kW)\r\n",
-                f"1-0:32.7.0({self.voltage:06.1f}*V)\r\n",
-                f"1-0:52.7.0({self.voltage:06.1f}*V)\r\n",
-                f"1-0:72.7.0({self.voltage:06.1f}*V)\r\n",
-                f"1-0:31.7.0({self.current:06.2f}*A)\r\n",
-                f"1-0:51.7.0({self.current:06.2f}*A)\r\n",
-                f"1-0:71.7.0({self.current:06.2f}*A)\r\n",
-                "0-0:96.3.10(1)\r\n",
-                "0-0:17.0.0(99.999*kW)\r\n",
-                "1-0:31.4.0(999.99*A)\r\n",
-                "0-1:96.3.10(0)\r\n",
-                "0-2:96.3.10(0)\r\n",
-                "0-3:96.3.10(0)\r\n",
-                "0-4:96.3.10(0)\r\n",
-                "0-0:96.13.0()\r\n",
-                "0-1:24.1.0(003)\r\n",
-                "0-1:96.1.1(3753414733373030303031373739)\r\n",
-                "0-1:96.1.2(000000000000000000)\r\n",
-                "0-1:24.4.0(1)\r\n",
-                "0-1:24.2.3(241018091251S)(00465.041*m3)\r\n",
-                "0-2:24.1.0(007)\r\n",
-                "0-2:96.1.1(3853455430303030323135353431)\r\n",
-                "0-2:96.1.2(000000000000000000)\r\n",
-                "0-2:24.2.1(241018091335S)(00044.988*m3)\r\n!"
-        ]
-        crc16 = 0
-        for line in data:
-            for char in line:
-                crc16 ^= ord(char)
-                for _ in range(8):
-                    if crc16 & 1:
-                        crc16 = (crc16 >> 1) ^ 0xA001
-                    else:
-                        crc16 >>= 1
-        data.append(f"{crc16:04X}\r\n")
-        data.append("\255")
-        return data
-
-    
-    def start_tcp_server(self):
-        try:
-            print("Starting TCP server")
-            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            server_socket.bind(("0.0.0.0", 8765))
-            server_socket.listen(1)
-            print("TCP server listening on port 8765")
-
-            while True:
-                client_socket, client_address = server_socket.accept()
-                print(f"Accepted connection from {client_address}")
-                try:
-                    while True:
-                        for text in self.get_p1_data_1():
-                            client_socket.sendall(text.encode('latin-1'))
-                            time.sleep(0.01)
-                        time.sleep(1)  # Send data every second
-                except (ConnectionResetError, BrokenPipeError):
-                    print(f"Connection with {client_address} lost")
-                finally:
-                    client_socket.close()
-        except Exception as e:
-            print(f"Error starting TCP server: {e}")
-
-    def start_rtu_server(self):
-        try:
-            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            server_socket.bind(("0.0.0.0", 8764))
-            server_socket.listen(1)
-            print("TCP server listening on port 8764")
-
-            while True:
-                client_socket, client_address = server_socket.accept()
-                print(f"Accepted connection from {client_address}")
-                try:
-                    while True:
-                        p1_data = "test".encode('utf-8')
-                        client_socket.sendall(p1_data)
-                        time.sleep(10)  # Send data every second
-                except (ConnectionResetError, BrokenPipeError):
-                    print(f"Connection with {client_address} lost")
-                finally:
-                    client_socket.close()
-        except Exception as e:
-            print(f"Error in RTU server: {e}")
\ No newline at end of file
+        current1, current2, current3 = self.phase_currents.tolist()
+        kilowatts = self.voltage / 1000
+        return P1_TEMPLATE.build({
+            "timestamp": p1_timestamp(self.time),
+            "imported_energy": self.imported_energy,
+            "exported_energy": self.exported_energy,
+            "power": power / 1000,
+            "injected_power": injected_power / 1000,
+            "power1": max(current1, 0) * kilowatts,
+            "power2": max(current2, 0) * kilowatts,
+            "power3": max(current3, 0) * kilowatts,
+            "injected_power1": max(-current1, 0) * kilowatts,
+            "injected_power2": max(-current2, 0) * kilowatts,
+            "injected_power3": max(-current3, 0) * kilowatts,
+            "voltage1": self.voltage,
+            "voltage2": self.voltage,
+            "voltage3": self.voltage,
+            "current1": abs(current1),
+            "current2": abs(current2),
+            "current3": abs(current3),
+        })
@@ -0,0 +1,253 @@
+import math
+import threading
+import numpy as np
+
+SOLAR_CONSTANT = 1361  # W/m²
+# Below this sun elevation (cos zenith ~ 3.7°) all irradiance is treated as diffuse
+MIN_COS_ZENITH = 0.065
+# Reflectance of the ground in front of the panels
+ALBEDO = 0.2
+# Step (s) of the cached solar position tables and the number of tables kept
+TABLE_STEP = 60
+MAX_TABLES = 4096
+# Tables are shared by locations within this grid (°), about 1 km; the sun is then
+# at most 2.4 s of time early or late
+TABLE_GRID = 0.01
+
+
+def solar_angles(latitude, longitude, seconds):
+    """
+    Declination, hour angle and day of year (NOAA general solar position equations).
+
+    Args:
+        latitude: Latitude (°)
+        longitude: Longitude (°, east positive)
+        seconds: UTC time as seconds since the epoch, scalar or array
+
+    Returns:
+        (declination, hour_angle) in radians and the fractional day of the year
+    """
+    seconds = np.asarray(seconds, dtype=np.float64)
+    utc = seconds.astype('datetime64[s]')
+    day_of_year = (utc - utc.astype('datetime64[Y]')).astype(np.float64) / 86400
+    minutes = (seconds % 86400) / 60
+    gamma = 2 * np.pi / 365 * (day_of_year - 0.5)
+    eqtime = 229.18 * (0.000075 + 0.001868 * np.cos(gamma) - 0.032077 * np.sin(gamma)
+                       - 0.014615 * np.cos(2 * gamma) - 0.040849 * np.sin(2 * gamma))
+    declination = (0.006918 - 0.399912 * np.cos(gamma) + 0.070257 * np.sin(gamma)
+                   - 0.006758 * np.cos(2 * gamma) + 0.000907 * np.sin(2 * gamma)
+                   - 0.002697 * np.cos(3 * gamma) + 0.00148 * np.sin(3 * gamma))
+    hour_angle = np.radians((minutes + eqtime + 4 * longitude) / 4 - 180)
+    return declination, hour_angle, day_of_year
+
+
+def cos_zenith(latitude, longitude, seconds):
+    """Cosine of the solar zenith angle, negative when the sun is below the horizon."""
+    declination, hour_angle, _ = solar_angles(latitude, longitude, seconds)
+    lat = np.radians(latitude)
+    return np.sin(lat) * np.sin(declination) + np.cos(lat) * np.cos(declination) * np.cos(hour_angle)
+
+
+def sun_vector(latitude, longitude, seconds):
+    """
+    Unit vector pointing at the sun in local (east, north, up) coordinates.
+
+    Returns:
+        Array of shape seconds.shape + (3,); the up component is cos(zenith)
+    """
+    declination, hour_angle, _ = solar_angles(latitude, longitude, seconds)
+    lat = np.radians(latitude)
+    cos_declination = np.cos(declination)
+    east = -cos_declination * np.sin(hour_angle)
+    north = np.cos(lat) * np.sin(declination) - np.sin(lat) * cos_declination * np.cos(hour_angle)
+    up = np.sin(lat) * np.sin(declination) + np.cos(lat) * cos_declination * np.cos(hour_angle)
+    return np.stack([east, north, up], axis=-1)
+
+
+def extraterrestrial(seconds):
+    """Irradiance at the top of the atmosphere (W/m²), varying with the Earth-Sun distance."""
+    _, _, day_of_year = solar_angles(0, 0, seconds)
+    return SOLAR_CONSTANT * (1 + 0.033 * np.cos(2 * np.pi * day_of_year / 365))
+
+
+def panel_normals(strings):
+    """
+    Unit normals of panel orientations.
+
+    Args:
+        strings: Sequence of (tilt °, azimuth ° clockwise from north, share)
+
+    Returns:
+        Array of shape (len(strings), 3) in (east, north, up) coordinates
+    """
+    tilt = np.radians([string[0] for string in strings])
+    azimuth = np.radians([string[1] for string in strings])
+    return np.column_stack([np.sin(tilt) * np.sin(azimuth), np.sin(tilt) * np.cos(azimuth), np.cos(tilt)])
+
+
+def diffuse_fraction(clearness):
+    """Share of diffuse irradiance in GHI as a function of the clearness index (Erbs model)."""
+    return np.where(clearness <= 0.22, 1 - 0.09 * clearness,
+                    np.where(clearness <= 0.8,
+                             0.9511 - 0.1604 * clearness + 4.388 * clearness**2
+                             - 16.638 * clearness**3 + 12.336 * clearness**4,
+                             0.165))
+
+
+def plane_of_array(ghi, cos_zenith, cos_incidence, cos_tilt, extraterrestrial, albedo=ALBEDO):
+    """
+    Irradiance on tilted planes from GHI (Erbs decomposition, isotropic sky).
+
+    Args:
+        ghi: Global horizontal irradiance, shape (T,)
+        cos_zenith: Cosine of the solar zenith angle, shape (T,)
+        cos_incidence: Cosine of the angle between the sun and each plane normal, shape (T, K)
+        cos_tilt: Cosine of the tilt of each plane, shape (K,)
+        extraterrestrial: Top of atmosphere irradiance, shape (T,)
+        albedo: Ground reflectance
+
+    Returns:
+        Plane-of-array irradiance (W/m²), shape (T, K). A horizontal plane gets exactly ghi.
+    """
+    ghi = np.asarray(ghi, dtype=np.float64)
+    day = cos_zenith > MIN_COS_ZENITH
+    with np.errstate(divide='ignore', invalid='ignore'):
+        clearness = np.clip(np.where(day, ghi / (extraterrestrial * cos_zenith), 0), 0, 1)
+        dhi = np.where(day, ghi * diffuse_fraction(clearness), ghi)
+        dni = np.where(day, (ghi - dhi) / cos_zenith, 0)
+    beam = dni[:, None] * np.maximum(cos_incidence, 0)
+    sky = dhi[:, None] * (1 + cos_tilt) / 2
+    ground = ghi[:, None] * albedo * (1 - cos_tilt) / 2
+    return beam + sky + ground
+
+
+def plane_of_array_point(ghi, cos_zenith, cos_incidence, cos_tilt, extraterrestrial, albedo=ALBEDO):
+    """Scalar twin of plane_of_array for one sample, used on every live tick; returns a list per plane."""
+    if cos_zenith > MIN_COS_ZENITH:
+        clearness = min(max(ghi / (extraterrestrial * cos_zenith), 0), 1)
+        if clearness <= 0.22:
+            fraction = 1 - 0.09 * clearness
+        elif clearness <= 0.8:
+            fraction = (0.9511 - 0.1604 * clearness + 4.388 * clearness**2
+                        - 16.638 * clearness**3 + 12.336 * clearness**4)
+        else:
+            fraction = 0.165
+        dhi = ghi * fraction
+        dni = (ghi - dhi) / cos_zenith
+    else:
+        dhi, dni = ghi, 0
+    return [dni * max(incidence, 0) + dhi * (1 + tilt) / 2 + ghi * albedo * (1 - tilt) / 2
+            for incidence, tilt in zip(cos_incidence, cos_tilt)]
+
+
+class SolarTable:
+    """
+    Sun position over one UTC day of a location, sampled every step seconds.
+
+    Tables are shared through get_table(), so every panel of a site or grid
+    cell reuses the same trigonometry. The incidence on a set of panel
+    orientations is a matrix product with the sun vectors, computed once per
+    day and orientation set.
+    """
+
+    def __init__(self, latitude, longitude, day, step=TABLE_STEP):
+        self.start = day * 86400
+        self.step = step
+        seconds = self.start + np.arange(86400 // step + 1) * float(step)
+        self.sun = sun_vector(latitude, longitude, seconds)
+        self.cos_zenith = self.sun[:, 2].tolist()
+        self.extraterrestrial = extraterrestrial(seconds).tolist()
+        self.incidence = {}
+        self.lock = threading.Lock()
+
+    def cos_incidence(self, strings):
+        """Per-sample lists of the cosine of incidence on each orientation of strings."""
+        incidence = self.incidence.get(strings)
+        if incidence is None:
+            incidence = (self.sun @ panel_normals(strings).T).tolist()
+            with self.lock:
+                self.incidence[strings] = incidence
+        return incidence
+
+    def point(self, now, strings):
+        """Returns (cos zenith, [cos incidence per orientation], extraterrestrial) interpolated at now."""
+        position = min(max((now - self.start) / self.step, 0), len(self.cos_zenith) - 1.000001)
+        index = int(position)
+        weight = position - index
+        incidence = self.cos_incidence(strings)
+        before, after = incidence[index], incidence[index + 1]
+        return (self.cos_zenith[index] + (self.cos_zenith[index + 1] - self.cos_zenith[index]) * weight,
+                [a + (b - a) * weight for a, b in zip(before, after)],
+                self.extraterrestrial[index])
+
+    def interpolate(self, seconds):
+        """Sun vectors and extraterrestrial irradiance at an array of seconds within the day."""
+        position = np.clip((seconds - self.start) / self.step, 0, len(self.cos_zenith) - 1.000001)
+        index = position.astype(np.int64)
+        weight = (position - index)[:, None]
+        sun = self.sun[index] + (self.sun[index + 1] - self.sun[index]) * weight
+        return sun, np.asarray(self.extraterrestrial)[index]
+
+
+tables = {}
+tables_lock = threading.Lock()
+
+def get_table(latitude, longitude, now, step=TABLE_STEP):
+    """Returns the cached SolarTable of the grid cell of the location and the UTC day of now."""
+    key = (round(latitude / TABLE_GRID), round(longitude / TABLE_GRID), int(now // 86400), step)
+    table = tables.get(key)
+    if table is None:
+        table = SolarTable(key[0] * TABLE_GRID, key[1] * TABLE_GRID, key[2], step)
+        with tables_lock:
+            if len(tables) >= MAX_TABLES:
+                # Drop the oldest half, usually tables of days that are over
+                for old in list(tables)[:MAX_TABLES // 2]:
+                    del tables[old]
+            tables[key] = table
+    return table
+
+
+def sun_positions(latitude, longitude, seconds, step=TABLE_STEP):
+    """
+    Sun vectors and extraterrestrial irradiance over a time axis, interpolated
+    from the cached tables of the days it spans.
+
+    Returns:
+        (sun vectors of shape (T, 3), extraterrestrial irradiance of shape (T,))
+    """
+    seconds = np.asarray(seconds, dtype=np.float64)
+    days = (seconds // 86400).astype(np.int64)
+    sun = np.empty((len(seconds), 3))
+    top = np.empty(len(seconds))
+    # Stable sort keeps a sorted axis as is, every day is then one slice
+    order = np.argsort(days, kind="stable")
+    unique, starts = np.unique(days[order], return_index=True)
+    for day, part in zip(unique.tolist(), np.split(order, starts[1:])):
+        sun[part], top[part] = get_table(latitude, longitude, day * 86400, step).interpolate(seconds[part])
+    return sun, top
+
+
+def array_irradiance(strings, ghi, latitude, longitude, seconds, albedo=ALBEDO):
+    """
+    Share-weighted plane-of-array irradiance of a multi-orientation array over a time axis.
+
+    Args:
+        strings: Sequence of (tilt °, azimuth °, share of the panel area)
+        ghi: Global horizontal irradiance per sample (W/m²)
+        seconds: UTC epoch seconds per sample
+
+    Returns:
+        Irradiance per sample (W/m²) averaged over the panel area
+    """
+    sun, top = sun_positions(latitude, longitude, seconds)
+    normals = panel_normals(strings)
+    poa = plane_of_array(ghi, sun[:, 2], sun @ normals.T, normals[:, 2], top, albedo)
+    return poa @ np.array([string[2] for string in strings], dtype=np.float64)
+
+
+def point_irradiance(strings, ghi, latitude, longitude, now, albedo=ALBEDO):
+    """Share-weighted plane-of-array irradiance at time now, from the cached table of the day."""
+    cos_zenith_now, cos_incidence, top = get_table(latitude, longitude, now).point(now, strings)
+    cos_tilt = [math.cos(math.radians(string[0])) for string in strings]
+    poa = plane_of_array_point(ghi, cos_zenith_now, cos_incidence, cos_tilt, top, albedo)
+    return sum(value * string[2] for value, string in zip(poa, strings))
@@ -0,0 +1,90 @@
+import orjson
+import threading
+from collections import deque
+
+# Messages kept for subscribers that fall behind before they get a full state
+BACKLOG = 32
+
+
+class StateStream:
+    """
+    Server-sent events of the combined device state.
+
+    Each tick publishes the fields that changed since the previous tick. The
+    message is serialized once and the same bytes are handed to every
+    subscriber. A subscriber that missed messages (or just connected) gets
+    the full state instead of a delta.
+
+    source returns the full state for the first subscriber before anything
+    was published. It is called outside the condition, so it may take the
+    lock of the site (which is held while a tick publishes).
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.condition = threading.Condition()
+        self.version = 0
+        self.state = {}
+        self.full = None
+        self.messages = deque(maxlen=BACKLOG)
+        self.subscribers = 0
+
+    def has_subscribers(self):
+        return self.subscribers > 0
+
+    def publish(self, state):
+        delta = {}
+        for device, fields in state.items():
+            previous = self.state.get(device, {})
+            changed = {key: value for key, value in fields.items() if previous.get(key) != value}
+            if changed:
+                delta[device] = changed
+        with self.condition:
+            self.state = state
+            self.full = None
+            if not delta:
+                return
+            self.version += 1
+            self.messages.append((self.version, format_event("delta", self.version, delta)))
+            self.condition.notify_all()
+
+    def full_message(self):
+        """Full state event of the current version; called with the condition held."""
+        if self.full is None:
+            self.full = format_event("state", self.version, self.state)
+        return self.full
+
+    def subscribe(self, timeout=15):
+        """Generator of SSE messages; yields a comment as keep-alive every timeout seconds."""
+        if not self.state:
+            state = self.source()
+            with self.condition:
+                if not self.state:
+                    self.state = state
+                    self.full = None
+        with self.condition:
+            self.subscribers += 1
+            version = self.version
+            message = self.full_message()
+        try:
+            yield message
+            while True:
+                with self.condition:
+                    if self.version == version:
+                        self.condition.wait(timeout)
+                    if self.version == version:
+                        message = b": keep-alive\n\n"
+                    elif self.messages and self.messages[0][0] <= version + 1:
+                        message = b"".join(data for number, data in self.messages if number > version)
+                        version = self.version
+                    else:
+                        message = self.full_message()
+                        version = self.version
+                yield message
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+
+
+def format_event(event, version, data):
+    return b"event: %s\nid: %d\ndata: %s\n\n" % (event.encode(), version, orjson.dumps(data))
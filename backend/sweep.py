@@ -0,0 +1,211 @@
+import argparse
+import itertools
+import multiprocessing
+import time
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+import batch
+import irradiance
+import scenario
+from inverter import SolarPanel, Battery, SolarUseMode
+
+# Sweepable parameters and the device attribute they set, besides tilt and azimuth
+BATTERY_PARAMETERS = ("capacity", "max_charge_current", "max_discharge_current")
+SOLAR_PARAMETERS = ("panel_area", "shading_factor", "panel_efficiency", "inverter_efficiency")
+DEFAULTS = {"capacity": 3000, "solar_use_mode": "SelfUse"}
+
+# Rows of the shared input array
+INPUTS = ("seconds", "ghi", "temperature", "load_power")
+
+# Inputs of the worker process, attached to the shared memory block once
+inputs = None
+
+
+def combinations(grid=None, distributions=None, samples=1, seed=None):
+    """
+    Expands a parameter grid and random distributions into parameter sets.
+
+    Args:
+        grid: Mapping of parameter name to a list of values; every combination is used
+        distributions: Mapping of parameter name to ("uniform", low, high),
+            ("normal", mean, std) or ("choice", [values])
+        samples: Number of random draws per grid combination
+        seed: Seed of the random draws
+
+    Returns:
+        List of parameter dicts
+    """
+    grid = grid or {}
+    distributions = distributions or {}
+    names = list(grid)
+    points = [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+    if not distributions:
+        return points
+    rng = np.random.default_rng(seed)
+    draws = {}
+    for name, (kind, *args) in distributions.items():
+        size = len(points) * samples
+        if kind == "uniform":
+            draws[name] = rng.uniform(args[0], args[1], size).tolist()
+        elif kind == "normal":
+            draws[name] = rng.normal(args[0], args[1], size).tolist()
+        elif kind == "choice":
+            draws[name] = [args[0][i] for i in rng.integers(0, len(args[0]), size)]
+        else:
+            raise ValueError(f"Unknown distribution {kind}")
+    sets = []
+    for i, (point, _) in enumerate(itertools.product(points, range(samples))):
+        sets.append(dict(point, **{name: values[i] for name, values in draws.items()}))
+    return sets
+
+
+def build_devices(parameters, latitude=52.52, longitude=13.41):
+    parameters = dict(DEFAULTS, **parameters)
+    solar_panel = SolarPanel(latitude, longitude, irradiance_source=irradiance.ClearSkySource())
+    battery = Battery(capacity=parameters["capacity"])
+    for name in BATTERY_PARAMETERS:
+        if name in parameters:
+            setattr(battery, name, parameters[name])
+    for name in SOLAR_PARAMETERS:
+        if name in parameters:
+            setattr(solar_panel, name, parameters[name])
+    if "tilt" in parameters or "azimuth" in parameters:
+        solar_panel.update_from_json({name: parameters[name] for name in ("tilt", "azimuth") if name in parameters})
+    battery.state_of_charge = parameters.get("initial_soc", 0) * battery.capacity / 100
+    solar_use_mode = parameters["solar_use_mode"]
+    if isinstance(solar_use_mode, str):
+        solar_use_mode = SolarUseMode[solar_use_mode]
+    return solar_panel, battery, solar_use_mode
+
+
+def kpis(frame, battery):
+    """
+    Key figures of a batch run, energies in kWh.
+
+    Self-consumption is the share of the PV energy used on site, self-sufficiency
+    the share of the load covered without the grid and battery cycles the
+    discharged energy in full battery capacities.
+    """
+    dt = batch.time_steps(batch.to_seconds(frame.index)) / 3600000
+    grid_power = frame["grid_power"].to_numpy()
+    solar = float(np.dot(frame["solar_power"].to_numpy(), dt))
+    load = float(np.dot(frame["load_power"].to_numpy(), dt))
+    grid_import = float(np.dot(np.maximum(grid_power, 0), dt))
+    grid_export = float(np.dot(np.maximum(-grid_power, 0), dt))
+    discharged = frame["feed_out"].iloc[-1] - battery.feed_out if len(frame) else 0
+    return {
+        "solar_energy": solar,
+        "load_energy": load,
+        "grid_import": grid_import,
+        "grid_export": grid_export,
+        "self_consumption": (solar - grid_export) / solar if solar > 0 else 0.0,
+        "self_sufficiency": (load - grid_import) / load if load > 0 else 0.0,
+        "battery_cycles": discharged / battery.capacity if battery.capacity else 0.0,
+    }
+
+
+def run_one(parameters, seconds, ghi, temperature, load_power):
+    solar_panel, battery, solar_use_mode = build_devices(parameters)
+    frame = batch.simulate(seconds, ghi, temperature, load_power, solar_panel, battery, solar_use_mode)
+    return dict(parameters, **kpis(frame, battery))
+
+
+def attach_inputs(name, shape):
+    global inputs
+    block = shared_memory.SharedMemory(name=name)
+    data = np.ndarray(shape, dtype=np.float64, buffer=block.buf)
+    data.flags.writeable = False
+    inputs = (block, data)
+
+
+def run_shared(parameters):
+    return run_one(parameters, *inputs[1])
+
+
+def sweep(parameter_sets, times, ghi, temperature, load_power, processes=None, chunksize=8):
+    """
+    Runs batch.simulate for every parameter set on a process pool.
+
+    The weather and load inputs are copied once into a shared memory block that
+    every worker maps read-only, so each task only ships its parameters.
+
+    Returns:
+        DataFrame with one row per parameter set: the parameters and their KPIs
+    """
+    data = np.vstack([batch.to_seconds(times),
+                      np.broadcast_to(np.asarray(ghi, dtype=np.float64), len(times)),
+                      np.broadcast_to(np.asarray(temperature, dtype=np.float64), len(times)),
+                      np.broadcast_to(np.asarray(load_power, dtype=np.float64), len(times))])
+    if processes == 1:
+        return pd.DataFrame([run_one(parameters, *data) for parameters in parameter_sets])
+
+    block = shared_memory.SharedMemory(create=True, size=data.nbytes)
+    try:
+        np.ndarray(data.shape, dtype=np.float64, buffer=block.buf)[:] = data
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(processes, initializer=attach_inputs, initargs=(block.name, data.shape)) as pool:
+            rows = pool.map(run_shared, parameter_sets, chunksize)
+    finally:
+        block.close()
+        block.unlink()
+    return pd.DataFrame(rows)
+
+
+def parse_values(text):
+    values = []
+    for value in text.split(","):
+        try:
+            values.append(float(value))
+        except ValueError:
+            values.append(value)
+    return values
+
+
+def parse_distribution(text):
+    kind, _, args = text.partition(":")
+    if kind == "choice":
+        return (kind, parse_values(args))
+    return (kind,) + tuple(float(arg) for arg in args.split(":"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Battery and PV sizing sweep over batch simulations")
+    parser.add_argument("--start", default="2024-01-01", help="First day (UTC)")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--step", type=int, default=60, help="Sample interval in s")
+    parser.add_argument("--latitude", type=float, default=52.52)
+    parser.add_argument("--longitude", type=float, default=13.41)
+    parser.add_argument("--weather", default="clearsky", help='"clearsky", "openmeteo" or a recording')
+    parser.add_argument("--load", default="household", help="Load profile, see scenario.from_config")
+    parser.add_argument("--grid", action="append", default=[], metavar="NAME=V1,V2",
+                        help="Values of a parameter, e.g. capacity=3000,5000 or solar_use_mode=SelfUse,Backup")
+    parser.add_argument("--random", action="append", default=[], metavar="NAME=KIND:ARGS",
+                        help="Distribution of a parameter, e.g. panel_area=uniform:10:30")
+    parser.add_argument("--samples", type=int, default=1, help="Random draws per grid point")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--output", help="CSV file for the results (printed if omitted)")
+    args = parser.parse_args(argv)
+
+    grid = dict((name, parse_values(values)) for name, values in (item.split("=", 1) for item in args.grid))
+    distributions = dict((name, parse_distribution(spec)) for name, spec in (item.split("=", 1) for item in args.random))
+    parameter_sets = combinations(grid, distributions, args.samples, args.seed)
+
+    start = pd.Timestamp(args.start).timestamp()
+    seconds = start + np.arange(args.days * 86400 // args.step) * float(args.step)
+    ghi, temperature = irradiance.from_config(args.weather).series(args.latitude, args.longitude, seconds)
+    traces = scenario.generate_traces(args.load, 1, start, len(seconds), args.step, seed=args.seed)
+    load_power = scenario.trace_power(traces)[0]
+
+    began = time.perf_counter()
+    results = sweep(parameter_sets, seconds, ghi, temperature, load_power, args.processes)
+    print(f"{len(parameter_sets)} runs of {len(seconds)} samples in {time.perf_counter() - began:.1f} s")
+    if args.output:
+        results.to_csv(args.output, index=False)
+    else:
+        print(results.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+import os
+
+# Keep the tests offline: sites without an explicit source use the clear-sky model
+os.environ.setdefault("IRRADIANCE_SOURCE", "clearsky")
@@ -0,0 +1,30 @@
+import irradiance
+from app import create_app
+from energymanager import EnergyManager
+from scheduler import Scheduler
+
+
+def create_client():
+    site = EnergyManager(scheduler=Scheduler(), start_time=1718000000, seed=1, servers=False, history=False,
+                         autostart=False, irradiance_source=irradiance.ClearSkySource())
+    site.scheduler.run(10)
+    return site, create_app(site).test_client()
+
+
+def test_state_is_served_from_the_given_site():
+    site, client = create_client()
+    response = client.get("/api/state")
+    assert response.status_code == 200
+    assert client.get("/api/state", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+    assert client.get("/api/clock").json["time"] == site.sim_time
+
+
+def test_invalid_load_settings_are_rejected():
+    _, client = create_client()
+    assert client.post("/api/load", json={"profile": "houshold"}).status_code == 400
+    assert client.post("/api/load", json={"current_limit": 25}).status_code == 200
+
+
+def test_fleet_routes_without_a_fleet():
+    _, client = create_client()
+    assert client.get("/api/sites").status_code == 404
@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+import batch
+
+
+def clamped_cumsum(delta, start, lower, upper):
+    level = np.empty(len(delta))
+    current = start
+    for i, step in enumerate(delta):
+        current = min(max(current + step, lower), upper)
+        level[i] = current
+    return level
+
+
+def test_bounded_cumsum_matches_a_clamp_loop():
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        n = int(rng.integers(1, 3 * batch.WINDOW))
+        # Random drifts make runs that stay inside, hug one bound or swing between both
+        delta = rng.normal(rng.normal(0, 5), rng.uniform(0.1, 50), n)
+        lower, upper = 0.0, float(rng.uniform(10, 2000))
+        start = float(rng.uniform(lower, upper))
+        np.testing.assert_allclose(batch.bounded_cumsum(delta, start, lower, upper),
+                                   clamped_cumsum(delta, start, lower, upper), atol=1e-6)
+
+
+def test_bounded_cumsum_swinging_every_sample():
+    delta = np.tile([100.0, -100.0], 5000)
+    np.testing.assert_allclose(batch.bounded_cumsum(delta, 5, 0, 10), clamped_cumsum(delta, 5, 0, 10))
+
+
+def test_to_seconds():
+    times = pd.date_range("2024-01-01", periods=3, freq="1min")
+    np.testing.assert_array_equal(batch.to_seconds(times), 1704067200 + np.arange(3) * 60.0)
+    np.testing.assert_array_equal(batch.to_seconds([1, 2]), [1.0, 2.0])
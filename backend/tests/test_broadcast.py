@@ -0,0 +1,94 @@
+import socket
+import time
+from smartmeter import BroadcastServer, HIGH_WATER, MAX_DROPPED
+
+
+class Transport:
+    def __init__(self):
+        self.buffered = 0
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+
+class Writer:
+    """StreamWriter stand-in that queues what it is given like a client that does not read."""
+
+    def __init__(self):
+        self.transport = Transport()
+        self.written = []
+        self.closed = False
+
+    def is_closing(self):
+        return self.closed
+
+    def write(self, data):
+        self.written.append(data)
+
+    def close(self):
+        self.closed = True
+
+
+def connect(port, timeout=5):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return socket.create_connection(("127.0.0.1", port), timeout=timeout)
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.02)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_slow_client_is_skipped_then_disconnected():
+    # The serving loop broadcasts once an hour, the test drives broadcast() itself
+    server = BroadcastServer("Test", 15551, lambda: b"", 3600)
+    try:
+        fast, slow = Writer(), Writer()
+        server.clients = {fast: 0, slow: 0}
+        slow.transport.buffered = HIGH_WATER + 1
+        for i in range(MAX_DROPPED - 1):
+            server.broadcast(b"%d" % i)
+        assert len(fast.written) == MAX_DROPPED - 1
+        assert slow.written == [] and not slow.closed
+        assert server.clients[slow] == MAX_DROPPED - 1
+        # A client that catches up is served again and its count starts over
+        slow.transport.buffered = 0
+        server.broadcast(b"caught up")
+        assert slow.written == [b"caught up"] and server.clients[slow] == 0
+        slow.transport.buffered = HIGH_WATER + 1
+        for i in range(MAX_DROPPED):
+            server.broadcast(b"%d" % i)
+        assert slow.closed and slow not in server.clients
+        assert fast in server.clients and len(fast.written) == 2 * MAX_DROPPED
+    finally:
+        server.clients.clear()
+        server.stop()
+
+
+def test_clients_receive_the_payload_and_leave():
+    payloads = []
+
+    def build():
+        payloads.append(b"telegram %d\n" % len(payloads))
+        return payloads[-1]
+
+    server = BroadcastServer("Test", 15550, build, 0.02)
+    try:
+        first, second = connect(15550), connect(15550)
+        assert wait_for(lambda: len(server.clients) == 2)
+        assert first.recv(1024).startswith(b"telegram")
+        assert second.recv(1024).startswith(b"telegram")
+        first.close()
+        assert wait_for(lambda: len(server.clients) == 1)
+        second.close()
+        assert wait_for(lambda: not server.clients)
+    finally:
+        server.stop()
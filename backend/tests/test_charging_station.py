@@ -0,0 +1,23 @@
+import pytest
+from charging_station import ChargingStation, DEFAULT_SOC
+
+
+def plug_in(station, vehicle):
+    return station.update_from_json({"points": {"0": {"vehicle": vehicle}}})
+
+
+def test_vehicle_without_charge_is_plugged_in_at_the_default_soc():
+    station = ChargingStation(charge_points=1)
+    assert plug_in(station, {"max_capacity": 40})
+    vehicle = station.to_dict()["points"][0]["vehicle"]
+    assert vehicle["state_of_charge"] == DEFAULT_SOC
+    station.update(0, 60)
+    assert station.get_power() > 0
+    assert station.to_dict()["points"][0]["vehicle"]["current_capacity"] > vehicle["current_capacity"]
+
+
+def test_vehicle_charge_as_state_of_charge():
+    station = ChargingStation(charge_points=1)
+    assert plug_in(station, {"max_capacity": 60, "state_of_charge": 50})
+    assert station.to_dict()["points"][0]["vehicle"]["current_capacity"] == pytest.approx(30)
+    assert not plug_in(station, {"max_capacity": 60, "state_of_charge": 150})
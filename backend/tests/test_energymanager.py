@@ -0,0 +1,66 @@
+import irradiance
+from energymanager import EnergyManager
+from scheduler import Scheduler
+
+
+def create_site(history=False, **kwargs):
+    return EnergyManager(scheduler=Scheduler(), start_time=1718000000, seed=1, servers=False, history=history,
+                         autostart=False, irradiance_source=irradiance.ClearSkySource(), **kwargs)
+
+
+def test_self_use_covers_the_load_of_the_same_tick():
+    site = create_site()
+    site.battery.update_from_json({"state_of_charge": 50})
+    for _ in range(100):
+        site.tick(1)
+        battery = site.battery
+        if abs(battery.current) < battery.max_discharge_current:
+            assert abs(site.power_meter.get_power()) < 1e-6
+
+
+def test_snapshot_changes_with_ticks_and_settings():
+    site = create_site()
+    site.tick(1)
+    etag, body = site.get_snapshot()
+    assert site.get_snapshot() == (etag, body)
+    site.update_device("battery", {"capacity": 5000})
+    changed, body = site.get_snapshot()
+    assert changed != etag
+    assert b'"capacity":5000' in body
+    site.tick(1)
+    assert site.get_snapshot()[0] != changed
+
+
+def test_snapshot_waits_for_the_tick():
+    import threading
+    site = create_site()
+    site.lock.acquire()
+    result = []
+    reader = threading.Thread(target=lambda: result.append(site.get_snapshot()))
+    reader.start()
+    reader.join(0.2)
+    assert reader.is_alive()
+    site.lock.release()
+    reader.join()
+    assert result
+
+
+def test_strings_without_share_are_rejected():
+    site = create_site()
+    strings = site.solar_panel.strings
+    assert site.update_device("solar_panel", {"strings": [{"tilt": 30, "share": 0}, {"tilt": 30, "share": 0}]}) is False
+    assert site.solar_panel.strings == strings
+    site.tick(1)
+    assert site.update_device("solar_panel", {"strings": [{"tilt": 30, "share": 1}, {"tilt": 30, "share": 3}]}) is True
+    assert [share for _, _, share in site.solar_panel.strings] == [0.25, 0.75]
+
+
+def test_charging_station_is_opt_in():
+    site = create_site(history=True)
+    assert site.charging_station is None
+    assert "charging" not in site.get_state()
+    assert "charging_power" not in site.history.signals
+    site = create_site(history=True, charge_points=2)
+    site.scheduler.run(3)
+    assert site.charging_station is not None
+    assert site.history.query(["charging_power"], 0, site.sim_time, 1)["signals"]["charging_power"]["mean"]
@@ -0,0 +1,25 @@
+import fleet
+
+
+def create_sites():
+    return {"1": fleet.create_site({"id": 1, "seed": 1})}
+
+
+def test_invalid_settings_are_answered_not_raised():
+    sites = create_sites()
+    reply = fleet.handle_command(sites, ("post", "1", "battery", {"capacity": 0}))
+    assert "error" in reply
+    assert fleet.handle_command(sites, ("post", "1", "battery", {"capacity": 5000})) is True
+    assert fleet.handle_command(sites, ("get", "2", "battery")) is None
+    assert fleet.handle_command(sites, ("get", "1", "nothing")) is None
+
+
+def test_fleet_survives_a_failing_command():
+    sites = fleet.Fleet([{"seed": 1}, {"seed": 2}], processes=1)
+    try:
+        reply = sites.update(0, "solar", {"strings": "not a list"})
+        assert "error" in reply
+        assert sites.update(0, "battery", {"capacity": 5000}) is True
+        assert '"capacity":5000' in sites.get(0, "battery")
+    finally:
+        sites.stop()
@@ -0,0 +1,93 @@
+import threading
+import time
+import numpy as np
+import requests
+import forecast
+from forecast import Forecast, ForecastService
+
+
+class StubService(ForecastService):
+    """ForecastService answering from a flat forecast instead of Open-Meteo."""
+
+    def __init__(self, **kwargs):
+        super().__init__(session=requests.Session(), **kwargs)
+        self.batches = []
+        self.error = None
+        self.gate = None
+
+    def fetch(self, cells, fetched_at):
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.fetch_count += 1
+        self.batches.append(list(cells))
+        if self.error is not None:
+            raise self.error
+        now = time.time()
+        times = np.array([now - 900, now + 86400])
+        return [Forecast(times, np.full(2, 100.0 * cell[0]), np.full(2, 20.0), fetched_at) for cell in cells]
+
+
+def test_cells_are_fetched_together_in_batches():
+    service = StubService(batch_size=2, background=False)
+    service.subscribe(52.52, 13.41)
+    service.subscribe(52.53, 13.42)  # same 0.1 degree cell
+    service.subscribe(48.14, 11.58)
+    service.subscribe(50.94, 6.96)
+    ghi, temperature = service.get(52.52, 13.41, time.time())
+    assert sorted(len(batch) for batch in service.batches) == [1, 2]
+    assert ghi == 100.0 * 525 and temperature == 20.0
+    # Every cell is fresh for the rest of the window
+    service.get(48.14, 11.58, time.time())
+    service.series(50.94, 6.96, [time.time()])
+    assert service.fetch_count == 2
+
+
+def test_failed_fetch_backs_off():
+    service = StubService(background=False, retry_interval=60)
+    service.error = OSError("unreachable")
+    assert service.get(52.52, 13.41, time.time()) is None
+    assert service.get(52.52, 13.41, time.time()) is None
+    assert service.fetch_count == 1
+    service.error = None
+    service.failed_until = time.time() - 1
+    assert service.get(52.52, 13.41, time.time()) is not None
+    assert service.fetch_count == 2
+
+
+def test_fetch_does_not_block_the_caller():
+    service = StubService()
+    service.gate = threading.Event()
+    started = time.perf_counter()
+    assert service.get(52.52, 13.41, time.time()) is None
+    assert service.coverage(52.52, 13.41) is None
+    assert time.perf_counter() - started < 1
+    service.gate.set()
+    deadline = time.monotonic() + 5
+    while service.get(52.52, 13.41, time.time()) is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert service.coverage(52.52, 13.41) > time.time()
+    assert service.fetch_count == 1
+
+
+def test_simulated_time_does_not_age_the_forecast():
+    service = StubService(background=False)
+    now = time.time()
+    for offset in (0, 3600, -86400, 10 * 86400):
+        service.get(52.52, 13.41, now + offset)
+    service.series(52.52, 13.41, [now])
+    assert service.fetch_count == 1
+
+
+def test_forecast_is_refetched_by_its_age(monkeypatch):
+    start = 1000 * 900.0 - 1
+    wall_time = [start]
+    monkeypatch.setattr(forecast.time, "time", lambda: wall_time[0])
+    service = StubService(background=False, window=900)
+    # An hour of simulated time per second, across a multiple of 900 s on the wall clock
+    for second in range(3):
+        wall_time[0] = start + second
+        service.get(52.52, 13.41, wall_time[0] + second * 3600)
+    assert service.fetch_count == 1
+    wall_time[0] += 900
+    service.get(52.52, 13.41, wall_time[0])
+    assert service.fetch_count == 2
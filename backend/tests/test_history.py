@@ -0,0 +1,24 @@
+import numpy as np
+from history import History
+
+
+def test_rebucketed_mean_is_weighted_by_samples():
+    history = History(["power"], resolutions=((10, 100),))
+    # Bucket 0 holds one sample of 0, bucket 10 nine samples of 10
+    history.record(5, [0.0])
+    for time in range(11, 20):
+        history.record(time, [10.0])
+    result = history.query(["power"], 0, 20, 20)
+    assert result["time"] == [0.0]
+    assert np.isclose(result["signals"]["power"]["mean"][0], 9.0)
+    assert result["signals"]["power"]["min"] == [0.0]
+    assert result["signals"]["power"]["max"] == [10.0]
+
+
+def test_query_at_native_resolution():
+    history = History(["a", "b"], resolutions=((1, 10),))
+    for time in range(15):
+        history.record(time, [time, -time])
+    result = history.query(["b"], 10, 14, 1)
+    assert result["time"] == [10.0, 11.0, 12.0, 13.0, 14.0]
+    assert result["signals"]["b"]["mean"] == [-10.0, -11.0, -12.0, -13.0, -14.0]
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import irradiance
+
+# 2024-06-21 00:00 UTC
+MIDSUMMER = 1718928000
+
+
+def test_clear_sky_noon_and_night():
+    source = irradiance.ClearSkySource()
+    # Solar noon in Berlin is about 11:07 UTC, midnight is dark
+    ghi, temperature = source.series(52.52, 13.41, [MIDSUMMER + 11 * 3600, MIDSUMMER])
+    assert 750 < ghi[0] < 950
+    assert ghi[1] == 0
+    assert temperature[0] > temperature[1]
+    # Live panels interpolate the same model from the cached day
+    assert source.get(52.52, 13.41, MIDSUMMER + 11 * 3600)[0] == pytest.approx(ghi[0], rel=0.01)
+    assert source.coverage(52.52, 13.41) == float("inf")
+
+
+def test_clear_sky_accepts_datetimes():
+    source = irradiance.ClearSkySource()
+    seconds = MIDSUMMER + np.arange(0, 86400, 3600)
+    ghi, _ = source.series(52.52, 13.41, seconds.astype("datetime64[s]"))
+    assert np.allclose(ghi, source.series(52.52, 13.41, seconds)[0])
+
+
+@pytest.fixture
+def recording(tmp_path):
+    path = tmp_path / "weather.csv"
+    path.write_text("time,ghi,temperature\n"
+                    "2024-06-21T00:00:00Z,0,10\n"
+                    "2024-06-21T01:00:00Z,100,20\n"
+                    "2024-06-21T02:00:00Z,300,30\n")
+    return str(path)
+
+
+def test_replay_interpolates_and_loops(recording):
+    source = irradiance.ReplaySource(recording)
+    assert source.get(0, 0, MIDSUMMER + 1800) == (50, 15)
+    ghi, temperature = source.series(0, 0, [MIDSUMMER + 5400, MIDSUMMER + 7200 + 1800])
+    assert ghi.tolist() == [200, 50]
+    assert temperature.tolist() == [25, 15]
+    assert source.coverage(0, 0) == float("inf")
+
+
+def test_replay_without_loop_holds_the_last_value(recording):
+    source = irradiance.ReplaySource(recording, loop=False)
+    assert source.series(0, 0, [MIDSUMMER + 86400])[0].tolist() == [300]
+    assert source.coverage(0, 0) == MIDSUMMER + 7200
+
+
+def test_from_config(recording):
+    assert isinstance(irradiance.from_config("clearsky"), irradiance.ClearSkySource)
+    assert isinstance(irradiance.from_config(recording), irradiance.ReplaySource)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+import irradiance
+from energymanager import EnergyManager
+from loadbalancer import allocate
+from scheduler import Scheduler
+
+L1, L2 = [True, False, False], [False, True, False]
+
+
+def test_device_that_does_not_fit_does_not_block_other_phases():
+    allocation = allocate(np.array([10.0, 16, 16]), np.full(3, 10.0), np.array([L1, L1, L2]),
+                          np.zeros(3, dtype=int), np.full(3, 6.0), np.zeros(3, dtype=bool))
+    assert allocation.tolist() == [10, 0, 10]
+
+
+def test_running_devices_are_admitted_first():
+    allocation = allocate(np.array([12.0, 12, 12]), np.full(3, 16.0), np.array([L1, L1, L1]),
+                          np.zeros(3, dtype=int), np.full(3, 6.0), np.array([False, True, True]))
+    assert allocation.tolist() == [0, 6, 6]
+
+
+def test_higher_priority_is_served_first():
+    allocation = allocate(np.array([20.0, 20, 20]), np.full(2, 16.0), np.array([L1, L1]),
+                          np.array([0, 1]), np.full(2, 6.0), np.zeros(2, dtype=bool))
+    assert allocation.tolist() == [0, 16]
+
+
+def test_headroom_is_shared_fairly():
+    allocation = allocate(np.array([20.0, 20, 20]), np.array([16.0, 4, 16]), np.array([L1, L1, L1]),
+                          np.zeros(3, dtype=int), np.zeros(3), np.zeros(3, dtype=bool))
+    assert np.allclose(allocation, [8, 4, 8])
+
+
+@pytest.mark.parametrize("modes", [{}, {"solar_use_mode": "Manual", "battery_use_mode": "Charge"}])
+def test_phase_currents_stay_within_the_limit(modes):
+    site = EnergyManager(scheduler=Scheduler(), start_time=1718000000, seed=1, servers=False, history=False,
+                         autostart=False, irradiance_source=irradiance.ClearSkySource(), charge_points=4,
+                         load_profile="household+appliances")
+    site.power_meter.current_limit = 25
+    site.inverter.update_from_json(modes)
+    site.charging_station.plug(np.arange(4), 60, 10, 0.9)
+    site.charging_station.update_from_json({"arrival_rate": 2})
+    peak = 0
+    for _ in range(2000):
+        site.tick(1)
+        peak = max(peak, site.power_meter.phase_currents.max())
+    assert peak <= 25 + 1e-9
+    assert site.charging_station.delivered_energy > 0
+
+
+def test_grid_charge_limit_is_lifted_when_grid_charging_stops():
+    site = EnergyManager(scheduler=Scheduler(), start_time=1718000000, seed=1, servers=False, history=False,
+                         autostart=False, irradiance_source=irradiance.ClearSkySource(), charge_points=2)
+    site.power_meter.current_limit = 10
+    site.battery.update_from_json({"state_of_charge": 10})
+    site.charging_station.plug(np.arange(2), 60, 10, 0.9)
+    site.inverter.update_from_json({"solar_use_mode": "Manual", "battery_use_mode": "Charge"})
+    site.tick(1)
+    assert site.battery.grid_charge_limit < site.battery.max_charge_current
+    site.inverter.update_from_json({"solar_use_mode": "SelfUse"})
+    site.tick(1)
+    assert site.battery.grid_charge_limit == float("inf")
@@ -0,0 +1,60 @@
+import logging
+import queue
+import log
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def create_logger(name, monkeypatch, clock, interval=60, burst=2):
+    monkeypatch.setattr(log.time, "monotonic", lambda: clock[0])
+    handler = ListHandler()
+    handler.addFilter(log.RateLimitFilter(interval, burst))
+    logger = logging.getLogger(f"test.{name}")
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    return logger, handler.records
+
+
+def test_repeated_messages_are_suppressed_per_template(monkeypatch):
+    clock = [0.0]
+    logger, records = create_logger("suppress", monkeypatch, clock)
+    for i in range(5):
+        logger.warning("Value %d out of range", i)
+    logger.warning("Other message")
+    assert [record.getMessage() for record in records] == [
+        "Value 0 out of range", "Value 1 out of range", "Other message"]
+
+    clock[0] = 60
+    logger.warning("Value %d out of range", 5)
+    assert records[-1].getMessage() == "Value 5 out of range (3 similar messages suppressed)"
+    logger.warning("Value %d out of range", 6)
+    assert records[-1].getMessage() == "Value 6 out of range"
+
+
+def test_errors_are_never_suppressed(monkeypatch):
+    logger, records = create_logger("errors", monkeypatch, [0.0], burst=1)
+    for _ in range(10):
+        logger.error("Write failed")
+    assert len(records) == 10
+
+
+def test_records_are_formatted_by_the_listener():
+    records = queue.SimpleQueue()
+    handler = log.DeferredQueueHandler(records)
+    logger = logging.getLogger("test.deferred")
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.warning("Battery at %d%%", 42)
+    record = records.get_nowait()
+    # Enqueued as is, the message is only merged with its arguments when it is written
+    assert record.msg == "Battery at %d%%"
+    assert record.args == (42,)
+    assert record.getMessage() == "Battery at 42%"
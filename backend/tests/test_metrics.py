@@ -0,0 +1,12 @@
+import metrics
+
+
+def test_counter_type_line_matches_its_samples():
+    counter = metrics.Counter("test_requests", "Requests", labels=("code",))
+    counter.labels(200).inc(3)
+    metrics.registry.pop(counter.name)
+    assert counter.render().splitlines() == [
+        "# HELP test_requests_total Requests",
+        "# TYPE test_requests_total counter",
+        'test_requests_total{code="200"} 3',
+    ]
@@ -0,0 +1,108 @@
+import pytest
+import modbus
+from inverter import solax_parameters
+
+
+def test_solax_map_has_no_overlapping_registers():
+    registers = modbus.compile_parameters(solax_parameters)
+    assert registers["battery_power"].count == 1
+    assert registers["grid_power"].count == 1
+
+
+def test_overlapping_parameters_are_rejected():
+    parameters = [
+        {"name": "power", "function_code": 4, "address": 22, "type": "i32", "default": 0},
+        {"name": "connected", "function_code": 4, "address": 23, "type": "u16", "default": 0},
+    ]
+    with pytest.raises(ValueError, match="connected"):
+        modbus.compile_parameters(parameters)
+
+
+def test_negative_power_is_one_twos_complement_word():
+    register = modbus.compile_parameters(solax_parameters)["battery_power"]
+    words = register.encode(-500)
+    assert words == [0x10000 - 500]
+    assert register.decode(words) == -500
+
+
+def test_inverter_publishes_every_register_through_the_snapshot():
+    from inverter import Inverter, SolarPanel, Battery
+    import irradiance
+    from smartmeter import PowerMeter
+
+    class Recorder:
+        def __init__(self):
+            self.snapshots = []
+            self.store = None
+
+        def set_modbus_server_parameter_values(self, values):
+            self.snapshots.append(values)
+
+    inverter = Inverter(SolarPanel(52.52, 13.41, irradiance.ClearSkySource()), Battery(3000),
+                        PowerMeter(serve=False), modbus_port=None)
+    inverter.modbus = Recorder()
+    inverter.update_modbus_context()
+    assert inverter.modbus.snapshots[0]["inverter_state"] == 6
+    assert modbus.compile_parameters(solax_parameters)["inverter_state"].address == 0x100
+
+
+def test_taken_unit_id_moves_to_the_next_port():
+    first = modbus.Modbus(15520, solax_parameters, unit_id=3)
+    second = modbus.Modbus(15520, solax_parameters, unit_id=3)
+    try:
+        assert (first.port, first.unit_id) == (15520, 3)
+        assert (second.port, second.unit_id) == (15521, 3)
+        assert modbus.hosts[15520].context[3] is first.store
+    finally:
+        first.stop_modbus_server()
+        second.stop_modbus_server()
+
+
+def test_port_in_use_is_skipped():
+    import socket
+    with socket.socket() as blocker:
+        blocker.bind(("0.0.0.0", 15530))
+        blocker.listen()
+        unit = modbus.Modbus(15530, solax_parameters)
+        try:
+            assert unit.port == 15531
+        finally:
+            unit.stop_modbus_server()
+
+
+def test_readers_never_see_a_torn_snapshot():
+    import threading
+    from pymodbus.client import ModbusTcpClient
+    parameters = [
+        {"name": "energy", "function_code": 4, "address": 10, "type": "u32", "default": 0},
+        {"name": "power", "function_code": 4, "address": 12, "type": "float", "default": 0},
+        {"name": "sequence", "function_code": 4, "address": 14, "type": "u16", "default": 0},
+    ]
+    unit = modbus.Modbus(15540, parameters)
+    stop = threading.Event()
+
+    def publish():
+        i = 0
+        while not stop.is_set():
+            i = (i + 1) % 0x10000
+            # Every word of every value changes with each snapshot
+            unit.set_modbus_server_parameter_values({"energy": i * 0x10001, "power": i + 0.5, "sequence": i})
+
+    publisher = threading.Thread(target=publish)
+    publisher.start()
+    client = ModbusTcpClient("127.0.0.1", port=15540)
+    try:
+        assert client.connect()
+        seen = set()
+        for _ in range(300):
+            words = client.read_input_registers(10, 5, slave=unit.unit_id).registers
+            sequence = words[4]
+            assert modbus.decode_unsigned(words[0:2]) == sequence * 0x10001
+            assert modbus.decode_float(words[2:4]) == sequence + 0.5 or sequence == 0
+            seen.add(sequence)
+        assert len(seen) > 10
+    finally:
+        stop.set()
+        publisher.join()
+        client.close()
+        unit.stop_modbus_server()
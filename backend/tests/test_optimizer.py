@@ -0,0 +1,103 @@
+import numpy as np
+import irradiance
+import optimizer
+from optimizer import DispatchOptimizer, Tariff, SLOT, RESOLVE_INTERVAL
+from energymanager import EnergyManager
+from inverter import SolarPanel, Battery
+from scheduler import Scheduler
+
+START = 1718000000 - 1718000000 % 86400
+CAPACITY = 3000
+POWER = 1440
+
+
+def inputs(count, seed):
+    rng = np.random.default_rng(seed)
+    times = START + np.arange(count) * float(SLOT)
+    net = rng.normal(0, 800, count)
+    import_price, export_price = Tariff().prices(times + SLOT / 2)
+    return times, net, import_price, export_price
+
+
+def test_warm_resolve_matches_a_cold_solve():
+    times, net, import_price, export_price = inputs(192, 0)
+    warm = DispatchOptimizer(phase=0)
+    warm.solve(times, net, import_price, export_price, CAPACITY, POWER, POWER)
+    # Two slots later, with a new forecast for the next few slots
+    net = net.copy()
+    net[2:10] += 500
+    solved = warm.solve(times[2:], net[2:], import_price[2:], export_price[2:], CAPACITY, POWER, POWER)
+    assert solved == 8
+    cold = DispatchOptimizer(phase=0)
+    assert cold.solve(times[2:], net[2:], import_price[2:], export_price[2:], CAPACITY, POWER, POWER) == 190
+    assert np.array_equal(warm.values, cold.values)
+    assert np.array_equal(warm.policy, cold.policy)
+
+
+def test_schedule_follows_the_battery_limits():
+    times, net, import_price, export_price = inputs(96, 1)
+    dispatch = DispatchOptimizer(phase=0)
+    dispatch.solve(times, net, import_price, export_price, CAPACITY, POWER, POWER)
+    power, energy = dispatch.schedule(1500)
+    assert len(power) == len(energy) == 96
+    assert energy[0] == 1500
+    assert np.allclose(np.diff(energy), power[:-1] * SLOT / 3600)
+    assert (energy >= 0).all() and (energy <= CAPACITY).all()
+    assert (np.abs(power) <= POWER + 1e-9).all()
+    # The first slot follows the policy of the level the battery is at
+    assert power[0] == dispatch.power(times[0], 1500)
+
+
+class ShortForecast(irradiance.ClearSkySource):
+    def __init__(self, end):
+        super().__init__()
+        self.end = end
+
+    def coverage(self, latitude, longitude):
+        return self.end
+
+
+def plan(source, now):
+    dispatch = DispatchOptimizer(phase=0)
+    panel = SolarPanel(52.52, 13.41, irradiance_source=source)
+    return dispatch, dispatch.plan(now, panel, None, Battery(CAPACITY))
+
+
+def test_horizon_stops_at_the_end_of_the_forecast():
+    dispatch, solved = plan(irradiance.ClearSkySource(), START + 3600)
+    assert dispatch.times[-1] + SLOT == START + 2 * 86400
+    dispatch, solved = plan(ShortForecast(START + 86400), START + 3600)
+    assert solved == len(dispatch.times) == 92
+    assert dispatch.times[-1] + SLOT == START + 86400
+
+
+def test_plan_without_forecast_backs_off():
+    dispatch, solved = plan(ShortForecast(None), START)
+    assert solved is None
+    assert dispatch.times is None
+    assert not dispatch.needs_plan(START + 60)
+    assert dispatch.needs_plan(START + RESOLVE_INTERVAL)
+
+
+def test_invalid_tariff_is_rejected():
+    tariff = Tariff()
+    assert tariff.update_from_json({"import_prices": [0.3] * 12}) is False
+    assert tariff.update_from_json({"import_prices": [0.3] * 24, "export_price": "free"}) is False
+    assert tariff.import_prices.tolist() == list(optimizer.IMPORT_PRICES)
+    assert tariff.update_from_json({"import_prices": 0.25, "export_price": 0.05}) is True
+    assert tariff.import_prices.tolist() == [0.25] * 24
+    assert tariff.export_price == 0.05
+
+
+def test_resolve_phase_follows_the_site_seed():
+    assert DispatchOptimizer(seed=1).phase == DispatchOptimizer(seed=1).phase
+    assert DispatchOptimizer(seed=1).phase != DispatchOptimizer(seed=2).phase
+    phases = []
+    for _ in range(2):
+        site = EnergyManager(scheduler=Scheduler(), start_time=START, seed=3, servers=False, history=False,
+                             autostart=False, irradiance_source=irradiance.ClearSkySource())
+        site.inverter.update_from_json({"solar_use_mode": "Optimized"})
+        site.tick(1)
+        phases.append(site.inverter.optimizer.phase)
+    assert phases[0] == phases[1]
+    assert 0 <= phases[0] < RESOLVE_INTERVAL
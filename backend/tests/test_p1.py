@@ -0,0 +1,61 @@
+import random
+import re
+import pytest
+import p1
+from p1 import P1_TEMPLATE, StaticSegment, crc16
+
+FIELDS = {
+    "imported_energy": 1e5, "exported_energy": 1e5, "power": 99, "injected_power": 99,
+    "power1": 99, "power2": 99, "power3": 99, "injected_power1": 99, "injected_power2": 99, "injected_power3": 99,
+    "voltage1": 9999, "voltage2": 9999, "voltage3": 9999, "current1": 999, "current2": 999, "current3": 999,
+}
+
+
+def bitwise_crc16(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+
+def random_values(rng):
+    values = {name: rng.uniform(0, high) for name, high in FIELDS.items()}
+    values["timestamp"] = p1.p1_timestamp(rng.uniform(0, 2e9))
+    return values
+
+
+def test_crc_matches_a_bitwise_crc():
+    assert bitwise_crc16(b"123456789") == crc16(b"123456789") == 0xBB3D
+    rng = random.Random(0)
+    for _ in range(200):
+        telegram = P1_TEMPLATE.build(random_values(rng))
+        body, crc = re.fullmatch(rb"(/.*!)([0-9A-F]{4})\r\n.*", telegram, re.S).groups()
+        assert int(crc, 16) == bitwise_crc16(body)
+
+
+def test_static_segment_folds_into_any_state():
+    rng = random.Random(1)
+    for _ in range(100):
+        data = bytes(rng.randrange(256) for _ in range(rng.randrange(1, 200)))
+        state = rng.randrange(0x10000)
+        assert StaticSegment(data).update(state) == crc16(data, state)
+
+
+@pytest.mark.parametrize("name, value, text", [
+    ("imported_energy", 1.5, "000001.500"),
+    ("power", 0.25, "00.250"),
+    ("voltage1", 230, "0230.0"),
+    ("current2", 7.126, "007.13"),
+])
+def test_fields_keep_their_width(name, value, text):
+    values = random_values(random.Random(2))
+    values[name] = value
+    telegram = P1_TEMPLATE.build(values).decode("latin-1")
+    assert f"({text}*" in telegram
+
+
+def test_telegram_length_does_not_depend_on_the_values():
+    lengths = {len(P1_TEMPLATE.build(random_values(random.Random(seed)))) for seed in range(50)}
+    assert len(lengths) == 1
@@ -0,0 +1,78 @@
+import os
+import threading
+import pytest
+import irradiance
+import recorder
+from energymanager import EnergyManager
+from scheduler import Scheduler
+
+
+def create_site():
+    return EnergyManager(scheduler=Scheduler(), start_time=1718000000, seed=1, servers=False, history=False,
+                         autostart=False, irradiance_source=irradiance.ClearSkySource())
+
+
+@pytest.mark.parametrize("format", ["parquet", "arrow"])
+def test_recording_round_trip(tmp_path, format):
+    site = create_site()
+    path = str(tmp_path / f"run.{format}")
+    site.start_recording(path, format)
+    site.recorder.chunk_size = 1000
+    site.scheduler.run(2500)
+    site.stop_recording()
+    table = recorder.open_run(path, ["time", "state_of_charge"])
+    assert table.num_rows == 2500
+    assert table.column_names == ["time", "state_of_charge"]
+
+
+def test_bad_path_raises_at_start():
+    site = create_site()
+    with pytest.raises(OSError):
+        site.start_recording("/nonexistent/dir/run.parquet")
+    assert site.recorder is None
+    site.scheduler.run(3)
+
+
+def test_write_error_drops_rows_without_blocking(tmp_path):
+    run = recorder.Recorder(str(tmp_path / "run.parquet"), chunk_size=4, buffers=2)
+    run.to_batch = lambda chunk, size: 1 / 0
+    site = create_site()
+    worker = threading.Thread(target=lambda: [run.record(site) for _ in range(100)])
+    worker.start()
+    worker.join(5)
+    assert not worker.is_alive()
+    assert isinstance(run.error, ZeroDivisionError)
+    assert run.dropped > 0
+    with pytest.raises(ZeroDivisionError):
+        run.close()
+
+
+def test_stop_recording_while_ticking(tmp_path):
+    site = create_site()
+    site.start_recording(str(tmp_path / "run.arrow"), "arrow")
+    ticker = threading.Thread(target=site.scheduler.run, args=(20000,))
+    ticker.start()
+    site.stop_recording()
+    ticker.join()
+    assert site.tick_count == 20000
+    assert os.path.getsize(tmp_path / "run.arrow") > 0
+
+
+@pytest.mark.parametrize("format", ["parquet", "arrow"])
+def test_sites_share_one_recorder(tmp_path, format):
+    path = str(tmp_path / f"shard.{format}")
+    run = recorder.Recorder(path, format, chunk_size=100, sites=["a", "b"])
+    scheduler = Scheduler()
+    sites = [EnergyManager(scheduler=scheduler, start_time=1718000000, seed=seed, servers=False, history=False,
+                           autostart=False, irradiance_source=irradiance.ClearSkySource()) for seed in (1, 2)]
+    for index, site in enumerate(sites):
+        site.attach_recorder(run, index)
+    scheduler.run(250)
+    for site in sites:
+        assert site.detach_recorder() is run
+    run.close()
+    assert recorder.open_run(path).num_rows == 500
+    for name, site in zip(["a", "b"], sites):
+        table = recorder.open_run(path, ["time", "load_power_l1"], site=name)
+        assert table.column_names == ["time", "load_power_l1"]
+        assert table.num_rows == 250
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+import scenario
+from load import Load
+
+
+def test_known_profiles():
+    assert isinstance(scenario.from_config(None), scenario.UniformProfile)
+    assert isinstance(scenario.from_config("household"), scenario.HouseholdProfile)
+    assert isinstance(scenario.from_config({"type": "appliances"}), scenario.ApplianceProfile)
+
+
+def test_unknown_profile_names_the_valid_ones():
+    with pytest.raises(ValueError, match="household"):
+        scenario.from_config("houshold")
+
+
+def test_trace_path_is_replayed(tmp_path):
+    path = tmp_path / "trace.csv"
+    path.write_text("time,load_power_l1,load_power_l2,load_power_l3\n"
+                    "2024-06-10T00:00:00Z,100,200,300\n2024-06-10T01:00:00Z,300,200,100\n")
+    profile = scenario.from_config(str(path))
+    assert isinstance(profile, scenario.ReplayProfile)
+    assert profile.duration == 3600
+
+
+def test_load_redraws_samples_when_tick_length_changes():
+    load = Load(profile={"type": "household", "noise": 0})
+    start = 1718000000
+    load.update(start, 1)
+    load.update(start + 1, 900)
+    load.update(start + 901, 900)
+    expected = load.profile.power(np.array([start + 901]))[0] * load.profile.phase_shares / 230
+    assert load.load_current == pytest.approx(expected)
+
+
+def test_invalid_profile_is_rejected():
+    load = Load()
+    assert load.update_from_json({"profile": "houshold"}) is False
+    assert isinstance(load.profile, scenario.UniformProfile)
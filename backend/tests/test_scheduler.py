@@ -0,0 +1,51 @@
+import pytest
+import irradiance
+from energymanager import EnergyManager
+from scheduler import Scheduler, MAX_TIME_SCALE
+
+
+class CountingSite:
+    def __init__(self):
+        self.ticks = 0
+
+    def tick(self, dt):
+        self.ticks += 1
+
+
+class FailingSite:
+    def tick(self, dt):
+        raise ZeroDivisionError("division by zero")
+
+
+def test_failing_site_does_not_stop_the_others():
+    scheduler = Scheduler()
+    before, after = CountingSite(), CountingSite()
+    scheduler.add(before)
+    scheduler.add(FailingSite())
+    scheduler.add(after)
+    scheduler.run(5)
+    assert scheduler.tick_count == 5
+    assert before.ticks == 5
+    assert after.ticks == 5
+
+
+def test_zero_capacity_and_voltage_are_rejected():
+    scheduler = Scheduler()
+    site = EnergyManager(scheduler=scheduler, start_time=1718000000, seed=1, servers=False, history=False,
+                         autostart=False, irradiance_source=irradiance.ClearSkySource())
+    assert site.battery.update_from_json({"capacity": 0}) is False
+    assert site.battery.update_from_json({"voltage": -48}) is False
+    assert site.power_meter.update_from_json({"voltage": 0}) is False
+    assert site.battery.capacity == 3000
+    assert site.power_meter.voltage == 230
+    scheduler.run(3)
+    assert site.tick_count == 3
+
+
+@pytest.mark.parametrize("time_scale", [0, -1, float("nan"), float("inf"), MAX_TIME_SCALE * 2])
+def test_invalid_time_scale_is_rejected(time_scale):
+    scheduler = Scheduler()
+    with pytest.raises(ValueError):
+        scheduler.set_time_scale(time_scale)
+    assert scheduler.time_scale == 1
+    assert scheduler.pace == (1, 1)
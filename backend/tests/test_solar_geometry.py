@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+import solar_geometry
+
+LATITUDE, LONGITUDE = 52.52, 13.41
+# 2024-06-10, every 5 minutes
+SECONDS = 1717977600 + np.arange(288) * 300.0
+
+
+def test_horizontal_plane_gets_ghi():
+    ghi = np.linspace(0, 900, len(SECONDS))
+    sun = solar_geometry.sun_vector(LATITUDE, LONGITUDE, SECONDS)
+    normals = solar_geometry.panel_normals([(0, 180, 1)])
+    poa = solar_geometry.plane_of_array(ghi, sun[:, 2], sun @ normals.T, normals[:, 2],
+                                        solar_geometry.extraterrestrial(SECONDS))
+    np.testing.assert_allclose(poa[:, 0], ghi, atol=1e-9)
+    for i in range(0, len(SECONDS), 7):
+        point = solar_geometry.plane_of_array_point(float(ghi[i]), float(sun[i, 2]), [float(sun[i, 2])], [1.0],
+                                                    float(solar_geometry.extraterrestrial(SECONDS[i])))
+        assert point[0] == pytest.approx(ghi[i])
+
+
+def test_erbs_diffuse_fraction():
+    clearness = np.linspace(0, 1, 1001)
+    fraction = solar_geometry.diffuse_fraction(clearness)
+    assert fraction[0] == 1
+    assert np.all((fraction > 0) & (fraction <= 1))
+    # Overcast skies are diffuse, clear ones mostly beam
+    assert np.all(np.diff(fraction) <= 1e-3)
+    assert solar_geometry.diffuse_fraction(0.9) == pytest.approx(0.165)
+    # The pieces meet at the breakpoints
+    for breakpoint in (0.22, 0.8):
+        below, above = solar_geometry.diffuse_fraction(np.array([breakpoint - 1e-9, breakpoint + 1e-9]))
+        assert below == pytest.approx(above, abs=2e-3)
+
+
+def test_night_irradiance_is_diffuse():
+    normals = solar_geometry.panel_normals([(90, 180, 1)])
+    poa = solar_geometry.plane_of_array(np.array([10.0]), np.array([-0.2]), np.array([[0.5]]), normals[:, 2],
+                                        np.array([1400.0]), albedo=0)
+    assert poa[0, 0] == pytest.approx(5)
+
+
+def test_nearby_locations_share_a_table():
+    assert solar_geometry.get_table(LATITUDE, LONGITUDE, SECONDS[0]) is \
+        solar_geometry.get_table(LATITUDE + 0.001, LONGITUDE - 0.002, SECONDS[0])
+    assert solar_geometry.get_table(LATITUDE, LONGITUDE, SECONDS[0]) is not \
+        solar_geometry.get_table(LATITUDE + 0.1, LONGITUDE, SECONDS[0])
+
+
+def test_array_irradiance_matches_the_exact_sun_position():
+    strings = [(30, 180, 0.6), (45, 90, 0.4)]
+    seconds = SECONDS[0] - 86400 + np.arange(3 * 86400 // 47) * 47.0
+    ghi = np.full(len(seconds), 600.0)
+    sun = solar_geometry.sun_vector(LATITUDE, LONGITUDE, seconds)
+    normals = solar_geometry.panel_normals(strings)
+    exact = solar_geometry.plane_of_array(ghi, sun[:, 2], sun @ normals.T, normals[:, 2],
+                                          solar_geometry.extraterrestrial(seconds)) @ np.array([0.6, 0.4])
+    np.testing.assert_allclose(solar_geometry.array_irradiance(strings, ghi, LATITUDE, LONGITUDE, seconds),
+                               exact, atol=1.0)
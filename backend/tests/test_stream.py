@@ -0,0 +1,68 @@
+import threading
+import orjson
+from stream import StateStream, BACKLOG
+from test_energymanager import create_site
+
+
+def events(message):
+    """(event, id, data) of every event in an SSE message."""
+    parsed = []
+    for block in message.decode().strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.split("\n"))
+        parsed.append((fields["event"], int(fields["id"]), orjson.loads(fields["data"])))
+    return parsed
+
+
+def state(power, soc=50):
+    return {"battery": {"power": power, "state_of_charge": soc}, "load": {"power": 100}}
+
+
+def test_delta_holds_only_changed_fields():
+    stream = StateStream(lambda: {})
+    stream.publish(state(0))
+    subscriber = stream.subscribe(timeout=0.01)
+    assert events(next(subscriber)) == [("state", 1, state(0))]
+    stream.publish(state(0))
+    assert stream.version == 1
+    assert next(subscriber) == b": keep-alive\n\n"
+    stream.publish(state(10))
+    assert events(next(subscriber)) == [("delta", 2, {"battery": {"power": 10}})]
+
+
+def test_subscriber_behind_gets_the_backlog_in_order():
+    stream = StateStream(lambda: {})
+    stream.publish(state(0))
+    subscriber = stream.subscribe()
+    next(subscriber)
+    for power in range(1, 4):
+        stream.publish(state(power))
+    assert [(event, number) for event, number, _ in events(next(subscriber))] == [
+        ("delta", 2), ("delta", 3), ("delta", 4)]
+
+
+def test_subscriber_past_the_backlog_gets_the_full_state():
+    stream = StateStream(lambda: {})
+    stream.publish(state(0))
+    subscriber = stream.subscribe()
+    next(subscriber)
+    for power in range(1, BACKLOG + 3):
+        stream.publish(state(power, soc=power))
+    assert events(next(subscriber)) == [("state", BACKLOG + 3, state(BACKLOG + 2, soc=BACKLOG + 2))]
+    # Back on deltas afterwards
+    stream.publish(state(0, soc=BACKLOG + 2))
+    assert events(next(subscriber))[0][:2] == ("delta", BACKLOG + 4)
+
+
+def test_first_subscriber_reads_the_site_between_ticks():
+    site = create_site()
+    site.tick(1)
+    subscriber = site.stream.subscribe()
+    ticked = threading.Event()
+    with site.lock:
+        # A subscriber must wait for the lock instead of reading a site in the middle of a tick
+        reader = threading.Thread(target=lambda: (next(subscriber), ticked.set()))
+        reader.start()
+        assert not ticked.wait(0.2)
+    reader.join(5)
+    assert ticked.is_set()
+    assert site.stream.state["battery"] == site.battery.to_dict()
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+import irradiance
+import sweep
+
+LATITUDE, LONGITUDE = 52.52, 13.41
+
+
+def inputs(days=2, step=600):
+    seconds = pd.Timestamp("2024-06-10").timestamp() + np.arange(days * 86400 // step) * float(step)
+    ghi, temperature = irradiance.ClearSkySource().series(LATITUDE, LONGITUDE, seconds)
+    return seconds, ghi, temperature, np.full(len(seconds), 400.0)
+
+
+def test_combinations_expand_grid_and_draws():
+    sets = sweep.combinations({"capacity": [3000, 5000], "tilt": [20, 40]}, {"panel_area": ("uniform", 10, 30)},
+                              samples=3, seed=1)
+    assert len(sets) == 12
+    assert {(s["capacity"], s["tilt"]) for s in sets} == {(3000, 20), (3000, 40), (5000, 20), (5000, 40)}
+    assert all(10 <= s["panel_area"] <= 30 for s in sets)
+    assert sets == sweep.combinations({"capacity": [3000, 5000], "tilt": [20, 40]},
+                                      {"panel_area": ("uniform", 10, 30)}, samples=3, seed=1)
+
+
+def test_small_sweep_kpis():
+    results = sweep.sweep([{"capacity": 1000}, {"capacity": 10000}], *inputs(), processes=1)
+    assert list(results["capacity"]) == [1000, 10000]
+    for row in results.itertuples():
+        assert row.load_energy == pytest.approx(0.4 * 48)
+        assert row.solar_energy > 0
+        assert 0 <= row.self_consumption <= 1
+        assert 0 <= row.self_sufficiency <= 1
+        assert row.self_sufficiency == pytest.approx(1 - row.grid_import / row.load_energy)
+    small, large = results.itertuples()
+    # A larger battery stores more of the midday surplus for the night
+    assert large.self_consumption > small.self_consumption
+    assert large.grid_import < small.grid_import
+
+
+def test_process_pool_matches_serial_run():
+    parameter_sets = sweep.combinations({"capacity": [2000, 6000], "solar_use_mode": ["SelfUse", "Backup"]})
+    data = inputs(days=1)
+    serial = sweep.sweep(parameter_sets, *data, processes=1)
+    pooled = sweep.sweep(parameter_sets, *data, processes=2, chunksize=1)
+    pd.testing.assert_frame_equal(serial, pooled)
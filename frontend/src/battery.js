@@ -1,5 +1,6 @@
 // battery.js
-import React, { useEffect, useState } from 'react';
+import React, { useState } from 'react';
+import { useDeviceState } from './stream';
 import { Card, Flex, Switch } from 'antd';
 
 
@@ -13,23 +14,7 @@ const Battery = () => {
     manual_mode: 0,
   });
 
-  useEffect(() => {
-    fetch('/api/battery')
-      .then(response => response.json())
-      .then(data => setBatteryData(data))
-      .catch(error => console.error('Error fetching power meter data:', error));
-  }, []);
-
-  useEffect(() => {
-    const interval = setInterval(() => {
-      fetch('/api/battery')
-        .then(response => response.json())
-        .then(data => setBatteryData(data))
-        .catch(error => console.error('Error fetching power meter data:', error));
-    }, 1000); // Fetch data every 5 seconds
-
-    return () => clearInterval(interval); // Cleanup interval on component unmount
-  }, []);
+  useDeviceState('battery', setBatteryData);
 
   const handleDoubleClick = (field) => {
     const newValue = prompt(`Enter new value for ${field}:`, batteryData[field]);
@@ -1,5 +1,6 @@
 // inverter.js
-import React, { useEffect, useState } from 'react';
+import React, { useState } from 'react';
+import { useDeviceState } from './stream';
 import { Card, Flex, Switch, Select } from 'antd';
 
 
@@ -11,23 +12,7 @@ const Inverter = () => {
     manual_mode: 0,
   });
 
-  useEffect(() => {
-    fetch('/api/inverter')
-      .then(response => response.json())
-      .then(data => setInverterData(data))
-      .catch(error => console.error('Error fetching power meter data:', error));
-  }, []);
-
-  useEffect(() => {
-    const interval = setInterval(() => {
-      fetch('/api/inverter')
-        .then(response => response.json())
-        .then(data => setInverterData(data))
-        .catch(error => console.error('Error fetching power meter data:', error));
-    }, 1000); // Fetch data every 5 seconds
-
-    return () => clearInterval(interval); // Cleanup interval on component unmount
-  }, []);
+  useDeviceState('inverter', setInverterData);
 
   const handleDoubleClick = (field) => {
     const newValue = prompt(`Enter new value for ${field}:`, inverterData[field]);
@@ -1,5 +1,6 @@
 // load.js
-import React, { useEffect, useState } from 'react';
+import React, { useState } from 'react';
+import { useDeviceState } from './stream';
 
 import Table from '@mui/material/Table';
 import TableBody from '@mui/material/TableBody';
@@ -39,23 +40,7 @@ const Load = () => {
     }
   });
 
-  useEffect(() => {
-    fetch('/api/load')
-      .then(response => response.json())
-      .then(data => setLoadData(data))
-      .catch(error => console.error('Error fetching load data:', error));
-  }, []);
-
-  useEffect(() => {
-    const interval = setInterval(() => {
-      fetch('/api/load')
-        .then(response => response.json())
-        .then(data => setLoadData(data))
-        .catch(error => console.error('Error fetching load data:', error));
-    }, 3000); // Fetch data every 5 seconds
-
-    return () => clearInterval(interval); // Cleanup interval on component unmount
-  }, []);
+  useDeviceState('load', setLoadData);
 
   const handleDoubleClick = (field) => {
     const fieldParts = field.split('.');
@@ -1,5 +1,6 @@
 // SmartMeter.js
-import React, { useEffect, useState } from 'react';
+import React, { useState } from 'react';
+import { useDeviceState } from './stream';
 import { Card, Flex, Slider } from 'antd';
 
 
@@ -14,23 +15,7 @@ const SmartMeter = () => {
     load_limit_min: 0
   });
 
-  useEffect(() => {
-    fetch('/api/powermeter')
-      .then(response => response.json())
-      .then(data => setPowerMeterData(data))
-      .catch(error => console.error('Error fetching power meter data:', error));
-  }, []);
-
-  useEffect(() => {
-    const interval = setInterval(() => {
-      fetch('/api/powermeter')
-        .then(response => response.json())
-        .then(data => setPowerMeterData(data))
-        .catch(error => console.error('Error fetching power meter data:', error));
-    }, 1000); // Fetch data every 5 seconds
-
-    return () => clearInterval(interval); // Cleanup interval on component unmount
-  }, []);
+  useDeviceState('powermeter', setPowerMeterData);
 
   const handleDoubleClick = (field) => {
     const newValue = prompt(`Enter new value for ${field}:`, powerMeterData[field]);
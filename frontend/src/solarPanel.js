@@ -1,5 +1,6 @@
 // solarPanel.js
-import React, { useEffect, useState } from 'react';
+import React, { useState } from 'react';
+import { useDeviceState } from './stream';
 import { Card, Flex, Switch } from 'antd';
 
 
@@ -12,23 +13,7 @@ const SolarPanel = () => {
     manual_mode: 0
   });
 
-  useEffect(() => {
-    fetch('/api/solar')
-      .then(response => response.json())
-      .then(data => setsolarPanelData(data))
-      .catch(error => console.error('Error fetching power meter data:', error));
-  }, []);
-
-  useEffect(() => {
-    const interval = setInterval(() => {
-      fetch('/api/solar')
-        .then(response => response.json())
-        .then(data => setsolarPanelData(data))
-        .catch(error => console.error('Error fetching power meter data:', error));
-    }, 30000); // Fetch data every 5 seconds
-
-    return () => clearInterval(interval); // Cleanup interval on component unmount
-  }, []);
+  useDeviceState('solar', setsolarPanelData);
 
   const handleDoubleClick = (field) => {
     const newValue = prompt(`Enter new value for ${field}:`, solarPanelData[field]);
@@ -0,0 +1,40 @@
+// stream.js
+import { useEffect } from 'react';
+
+// One EventSource per page, shared by all components
+let source = null;
+let state = {};
+const listeners = {};
+
+const dispatch = (data) => {
+  Object.entries(data).forEach(([device, fields]) => {
+    state[device] = { ...state[device], ...fields };
+    (listeners[device] || []).forEach(listener => listener(state[device]));
+  });
+};
+
+const connect = () => {
+  source = new EventSource('/api/stream');
+  source.addEventListener('state', event => {
+    state = {};
+    dispatch(JSON.parse(event.data));
+  });
+  source.addEventListener('delta', event => dispatch(JSON.parse(event.data)));
+  source.onerror = error => console.error('Error in state stream:', error);
+};
+
+// Calls setData with the device state (e.g. 'battery') whenever the backend pushes a change
+export const useDeviceState = (device, setData) => {
+  useEffect(() => {
+    if (source === null) {
+      connect();
+    }
+    listeners[device] = [...(listeners[device] || []), setData];
+    if (state[device]) {
+      setData(state[device]);
+    }
+    return () => {
+      listeners[device] = listeners[device].filter(listener => listener !== setData);
+    };
+  }, [device, setData]);
+};